@@ -0,0 +1,10 @@
+import importlib
+
+__all__ = ["async_forge", "forge", "toolbox"]
+
+
+def __getattr__(name):
+    """Import the submodules when they are first used, so that importing mdf_forge alone stays fast."""
+    if name in __all__:
+        return importlib.import_module("mdf_forge." + name)
+    raise AttributeError("module '" + __name__ + "' has no attribute '" + name + "'")
@@ -0,0 +1,44 @@
+import importlib
+
+
+class LazyModule:
+    """Stand in for a module, importing it when one of its attributes is first used.
+    Importing mdf_forge then stays fast for code that never needs its heavier dependencies.
+    """
+
+    def __init__(self, name):
+        """Initialize the LazyModule.
+
+        Arguments:
+        name (str): The full name of the module.
+        """
+        self.__name = name
+        self.__module = None
+
+
+    def __getattr__(self, attr):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attr)
+
+
+    def __repr__(self):
+        return "<lazy module '" + self.__name + "'>"
+
+
+def lazy_function(module, name):
+    """Return a function that calls `name` from a module, importing the module on the first call.
+
+    Arguments:
+    module (str): The full name of the module.
+    name (str): The name of the function (or class) in the module.
+
+    Returns:
+    function: The stand-in.
+    """
+    lazy_module = LazyModule(module)
+
+    def call(*args, **kwargs):
+        return getattr(lazy_module, name)(*args, **kwargs)
+    call.__name__ = name
+    return call
@@ -0,0 +1,337 @@
+import asyncio
+from collections import deque
+import json
+
+from mdf_forge import forge, toolbox
+from mdf_forge.forge import Query, SEARCH_LIMIT
+
+# aiohttp is only required for AsyncForge
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# asyncio.get_running_loop() is new in Python 3.7; in a coroutine, get_event_loop() is equivalent before then
+_get_running_loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)
+
+
+class AsyncForge:
+    """Fetch metadata from Globus Search and files from the Materials Data Facility, from asyncio code.
+    AsyncForge is the asyncio counterpart to Forge. Queries are built with the same methods,
+    and the search and retrieval methods are coroutines (or async generators) that do not block the event loop.
+    All requests made through one AsyncForge share an HTTP session, and at most `concurrency` run at once.
+
+    AsyncForge requires the aiohttp package.
+
+    Methods:
+    __init__ handles authentication with Globus Auth.
+    match_term adds simple terms to the query.
+    match_field adds a field:value pair to the query.
+    match_sources specifies `source_name`s to search for results in.
+    match_elements specifies element abbreviations to match.
+    reset_query destroys the current query and starts a fresh one.
+    search executes a search.
+    aggregate executes a search and returns all results.
+    aggregate_iter executes a search and yields all results as they arrive.
+    http_stream yields data files in sequence.
+    close closes the HTTP session.
+    """
+    __index = "mdf"
+    __services = ["mdf", "search"]
+    __app_name = "MDF_Forge"
+    __search_url = "https://search.api.globus.org/"
+
+    def __init__(self, **kwargs):
+        """Initialize the AsyncForge instance.
+
+        Keyword Arguments:
+        index (str): The Globus Search index to search on.
+        services (list of str): The services to authenticate for.
+        concurrency (int): The maximum number of HTTP requests to run at once. Default 8.
+        search_url (str): The base URL of Globus Search. Default the production Search service.
+        search_authorizer (GlobusAuthorizer): The authorizer for Search requests.
+        mdf_authorizer (GlobusAuthorizer): The authorizer for MDF data requests.
+                                           Each authorizer that is not given comes from toolbox.CLIENTS,
+                                           shared with every Forge in the process.
+        scroll_plans (bool or str): Where aggregations remember scroll windows. See Forge.__init__() for details.
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncForge requires aiohttp. Install it with 'pip install aiohttp'.")
+        self.__index = kwargs.get("index", self.__index)
+        self.__services = kwargs.get("services", self.__services)
+        self.__search_url = kwargs.get("search_url", self.__search_url).rstrip("/") + "/"
+        self.__search_authorizer = kwargs.get("search_authorizer", None)
+        self.__mdf_authorizer = kwargs.get("mdf_authorizer", None)
+        if self.__search_authorizer is None:
+            self.__search_authorizer = toolbox.CLIENTS.get("search", self.__app_name, self.__services, self.__index).authorizer
+        if self.__mdf_authorizer is None and "mdf" in self.__services:
+            self.__mdf_authorizer = toolbox.CLIENTS.get("mdf", self.__app_name, self.__services)
+        self.__concurrency = kwargs.get("concurrency", 8)
+        scroll_plans = kwargs.get("scroll_plans", None)
+        self.__scroll_plans = forge.SCROLL_PLAN_PATH if scroll_plans is True else (scroll_plans or None)
+        # The session and semaphore are created on first use, inside the running event loop
+        self.__session = None
+        self.__semaphore = None
+
+        self.__query = Query(None)
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+    async def close(self):
+        """Close the HTTP session. The AsyncForge may still be used afterwards; a new session will be opened."""
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+#################################################
+##  Query building
+#################################################
+
+    def match_term(self, term, required=True, new_group=False):
+        """Add a term to the query.
+        See Forge.match_term() for details.
+
+        Returns:
+        self (AsyncForge): For chaining.
+        """
+        self.__query.match_term(term, required, new_group)
+        return self
+
+
+    def match_field(self, field, value, required=True, new_group=False):
+        """Add a field:value term to the query.
+        See Forge.match_field() for details.
+
+        Returns:
+        self (AsyncForge): For chaining.
+        """
+        self.__query.match_field(field, value, required, new_group)
+        return self
+
+
+    def match_sources(self, sources):
+        """Add sources to match to the query.
+        See Forge.match_sources() for details.
+
+        Returns:
+        self (AsyncForge): For chaining.
+        """
+        self.__query.match_sources(sources)
+        return self
+
+
+    def match_elements(self, elements, match_all=True):
+        """Add elemental abbreviations to the query.
+        See Forge.match_elements() for details.
+
+        Returns:
+        self (AsyncForge): For chaining.
+        """
+        self.__query.match_elements(elements, match_all)
+        return self
+
+
+    def reset_query(self):
+        """Destroy the current query and create a fresh, clean one."""
+        self.__query = Query(None)
+
+#################################################
+##  Search functions
+#################################################
+
+    async def search(self, q=None, advanced=False, limit=SEARCH_LIMIT, info=False, reset_query=True, fields=None):
+        """Execute a search and return the results.
+        See Forge.search() for details.
+
+        Returns:
+        list (if info=False): The results.
+        tuple (if info=True): The results, and a dictionary of query information.
+        """
+        query = self.__query
+        if reset_query:
+            self.reset_query()
+        q, key = query.resolve(q)
+        if not q:
+            print("Error: No query specified")
+            return ([], {"error": "No query specified"}) if info else []
+        if advanced is None or query.advanced:
+            advanced = query.advanced
+        qu = {
+            "q": q,
+            "advanced": advanced,
+            "limit": min(limit or SEARCH_LIMIT, SEARCH_LIMIT)
+            }
+        res = toolbox.gmeta_pop(await self.__search(qu), info=info, fields=fields)
+        if info:
+            res[1]["query"] = qu
+        return res
+
+
+    async def aggregate(self, q=None, scroll_size=SEARCH_LIMIT, reset_query=True, workers=1, fields=None):
+        """Perform an advanced query, and return all matching results.
+        See Forge.aggregate() for details.
+
+        Returns:
+        list of dict: All matching records
+        """
+        output = []
+        async for records in self.aggregate_iter(q=q, scroll_size=scroll_size, reset_query=reset_query,
+                                                 workers=workers, pages=True, fields=fields):
+            output.extend(records)
+        return output
+
+
+    def aggregate_iter(self, q=None, scroll_size=SEARCH_LIMIT, reset_query=True, workers=1, pages=False, fields=None):
+        """Perform an advanced query, and yield all matching results as they arrive.
+        See Forge.aggregate_iter() for details.
+
+        Returns:
+        async generator: All matching records (or pages of records).
+        """
+        # Resolve the query now, so that later changes to the query do not affect the results
+        q, key = self.__query.resolve_aggregate(q)
+        if reset_query:
+            self.reset_query()
+        return self.__aggregate_gen(q, key, scroll_size, workers, pages, fields)
+
+
+    async def __aggregate_gen(self, q, key, scroll_size, workers, pages, fields):
+        """Async generator backing aggregate_iter()."""
+        if not q:
+            return
+        total = (await self.__search({"q": q, "advanced": True, "limit": 0}))["total"]
+
+        # Remembered scroll windows live on disk, which must not block the event loop
+        loop = _get_running_loop()
+        planner = await loop.run_in_executor(None, forge._scroll_planner, self.__index, key,
+                                             scroll_size, self.__scroll_plans)
+        found = 0
+        scroll_pos = 1
+        pending = deque()
+        try:
+            while found < total:
+                # Keep the next windows in line in flight
+                while len(pending) < max(workers, 1):
+                    width, known = planner.plan(scroll_pos)
+                    pending.append(asyncio.ensure_future(self.__fetch_window(q, scroll_pos, width, planner, known, fields)))
+                    scroll_pos += width
+                # Windows are consumed in submission order to keep the results ordered
+                records = await pending.popleft()
+                found += len(records)
+                if pages:
+                    yield records
+                else:
+                    for record in records:
+                        yield record
+        finally:
+            for task in pending:
+                task.cancel()
+            await loop.run_in_executor(None, planner.save)
+
+
+    async def __fetch_window(self, q, start, width, planner, known, fields):
+        """Fetch all records in the scroll window [start, start + width).
+        The searches are planned by forge._window_searches(), shared with Forge.
+        """
+        searches = forge._window_searches(q, start, width, planner, known)
+        try:
+            request = next(searches)
+            while True:
+                res = await self.__search(request)
+                request = searches.send((toolbox.gmeta_pop(res, fields=fields), res["total"], res["count"]))
+        except StopIteration as e:
+            return e.value
+
+#################################################
+##  Data retrieval functions
+#################################################
+
+    async def http_stream(self, results, verbose=True):
+        """Yield data files from the provided results using HTTPS.
+        Up to `concurrency` files are downloaded ahead of the consumer.
+
+        Arguments:
+        results (dict): The records from which files should be fetched.
+                        This should be the return value of a search method.
+        verbose (bool): If True, status and progress messages will be printed.
+                        If False, only error messages will be printed.
+                        Default True.
+
+        Yields:
+        str: Text of each data file.
+        """
+        # If results have info attached, remove it
+        if type(results) is tuple:
+            results = results[0]
+        urls = []
+        for res in results:
+            for dl in res["mdf"]["links"].values():
+                host = dl.get("http_host", None) if type(dl) is dict else None
+                if host:
+                    urls.append(host + dl["path"])
+
+        pending = deque()
+        urls = iter(urls)
+        try:
+            while True:
+                for url in urls:
+                    pending.append((url, asyncio.ensure_future(self.__request("GET", url, self.__mdf_authorizer))))
+                    if len(pending) >= self.__concurrency:
+                        break
+                if not pending:
+                    break
+                url, task = pending.popleft()
+                status, body = await task
+                # Handle errors by passing the buck to the user
+                if status != 200:
+                    print("Error", status, " when attempting to access '", url, "'", sep="")
+                else:
+                    yield body.decode("utf-8", "replace")
+        finally:
+            for url, task in pending:
+                task.cancel()
+
+#################################################
+##  HTTP helpers
+#################################################
+
+    async def __search(self, body):
+        """POST a GSearchRequest to the index and return the decoded result."""
+        url = self.__search_url + "v1/index/" + self.__index + "/search"
+        status, data = await self.__request("POST", url, self.__search_authorizer, json_body=body)
+        if status != 200:
+            raise ValueError("Search error " + str(status) + ": " + data.decode("utf-8", "replace"))
+        return json.loads(data.decode("utf-8"))
+
+
+    async def __request(self, method, url, authorizer, json_body=None):
+        """Make an authorized HTTP request, retrying once with fresh authorization on 401.
+
+        Returns:
+        tuple: The status code and body bytes of the response.
+        """
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession()
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.__concurrency)
+        loop = _get_running_loop()
+        async with self.__semaphore:
+            for attempt in range(2):
+                headers = {}
+                if authorizer is not None:
+                    # Authorizers may block to refresh tokens, so keep them off the event loop
+                    await loop.run_in_executor(None, authorizer.set_authorization_header, headers)
+                async with self.__session.request(method, url, headers=headers, json=json_body) as response:
+                    status = response.status
+                    body = await response.read()
+                if status != 401 or attempt or authorizer is None:
+                    break
+                await loop.run_in_executor(None, authorizer.handle_missing_authorization)
+        return status, body
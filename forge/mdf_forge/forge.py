@@ -1,16 +1,55 @@
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import os
-
-import requests
-import globus_sdk
-from tqdm import tqdm
+import shutil
+import time
+import zlib
 
 from mdf_forge import toolbox
+from mdf_forge._lazy import LazyModule, lazy_function
+
+# These are imported when first used, so that importing Forge stays fast
+gzip = LazyModule("gzip")
+tempfile = LazyModule("tempfile")
+globus_sdk = LazyModule("globus_sdk")
+requests = LazyModule("requests")
+tqdm = lazy_function("tqdm", "tqdm")
 
-# Maximum recommended number of HTTP file transfers
-# Large transfers are much better suited to Globus Transfer use
+# Deprecated: http_download() and http_stream() no longer limit the number of results. Kept for compatibility.
 HTTP_NUM_LIMIT = 10
+# Default number of files http_download() fetches at once, in total and from each host
+HTTP_WORKERS = 8
+HTTP_HOST_LIMIT = 4
+# Default number of byte ranges http_download() fetches a large file in at once, and the size in bytes of files
+# that count as large
+HTTP_SEGMENTS = 4
+HTTP_SEGMENT_THRESHOLD = 256 * 2**20
+# Default number of files http_stream() fetches ahead of the one being consumed
+HTTP_PREFETCH = 4
+# The first bytes of every gzip file
+GZIP_MAGIC = b"\x1f\x8b"
+# Checksums a file link may carry, by hashlib algorithm name, in the order they are preferred
+CHECKSUM_ALGORITHMS = ("sha512", "sha256", "sha1", "md5")
+# Maximum number of files, and approximate request size in bytes, of each Globus Transfer task globus_download() submits
+# Larger submissions can time out while uploading
+TRANSFER_ITEM_LIMIT = 25000
+TRANSFER_BYTES_LIMIT = 8 * 2**20
+# Number of transfer tasks submitted at once, and seconds between checks on their progress
+TRANSFER_WORKERS = 4
+TRANSFER_POLL_INTERVAL = 10
+# Globus Transfer sync level used by globus_download(sync=True): only transfer files that are missing at the destination,
+# differ in size, or are newer at the source
+TRANSFER_SYNC_LEVEL = "mtime"
+# Name of the manifest http_download(sync=True) keeps in the destination directory
+SYNC_MANIFEST_NAME = ".mdf_sync_manifest.json"
+# Maximum number of task IDs Globus Transfer accepts in one task list filter
+TASK_FILTER_LIMIT = 50
 # Maximum number of results per search allowed by Globus Search
 SEARCH_LIMIT = 10000
+# Default maximum number of values counted per field by facets()
+FACET_SIZE = 100
+# Where aggregations remember the scroll windows that fit each query, when enabled with Forge(scroll_plans=True)
+SCROLL_PLAN_PATH = os.path.expanduser("~/mdf/cache/scroll_plans.json")
 
 
 class Forge:
@@ -21,6 +60,8 @@ class Forge:
 
     Public Variables:
     local_ep is the endpoint ID of the local Globus Connect Personal endpoint.
+    cache is the SearchCache holding search and aggregate results, if caching is enabled.
+    data_cache is the DataCache holding data files fetched with HTTPS, if data caching is enabled.
 
     Methods:
     __init__ handles authentication with Globus Auth.
@@ -29,12 +70,19 @@ class Forge:
     match_sources specifies `source_name`s to search for results in.
     match_elements specifies element abbreviations to match.
     search executes a search.
+    search_many executes many searches concurrently.
+    count returns the number of results of a search.
+    facets returns the number of results of a search for each value of some fields.
+    aggregate executes a search and returns all results.
+    aggregate_iter executes a search and yields all results as they arrive.
     search_by_elements executes a search for given elements in given sources.
     aggregate_source returns all records for a given source.
+    aggregate_source_iter yields all records for a given source as they arrive.
     reset_query destroys the current query and starts a fresh one.
+    plan_download decides where the data files associated with results will be saved.
     http_download saves the data files associated with results to disk with HTTPS.
     globus_download saves the data files associated with results to disk with Globus Transfer.
-    http_stream yields a generator to fetch data files in sequence.
+    http_stream yields a generator to fetch data files in sequence, prefetching the next files.
     http_return returns all the data files at once.
     """
     __index = "mdf"
@@ -48,20 +96,36 @@ class Forge:
         index (str): The Globus Search index to search on.
         services (list of str): The services to authenticate for.
         local_ep (str): The endpoint ID of the local Globus Connect Personal endpoint.
+        cache (bool or SearchCache): If True, will keep search and aggregate results in the default on-disk cache
+                                     under ~/mdf/cache. A SearchCache may be given to control its location, TTL, and size.
+                                     Default None, which disables caching.
+        data_cache (bool or DataCache): If True, will keep data files fetched with HTTPS in the default on-disk cache
+                                        under ~/mdf/cache/data. A DataCache may be given to control its location,
+                                        size, and how often files are checked for changes.
+                                        Default None, which disables data caching.
+        scroll_plans (bool or str): If True, aggregations will remember the scroll windows that fit each query
+                                    in SCROLL_PLAN_PATH, so repeating them takes fewer requests.
+                                    A path may be given to keep them elsewhere.
+                                    Default None, which keeps them in memory for one aggregation only.
         """
         self.__index = kwargs.get('index', self.__index)
         self.__services = kwargs.get('services', self.__services)
         self.local_ep = kwargs.get("local_ep", None)
+        cache = kwargs.get("cache", None)
+        self.__cache = toolbox.SearchCache() if cache is True else (cache or None)
+        data_cache = kwargs.get("data_cache", None)
+        self.__data_cache = toolbox.DataCache() if data_cache is True else (data_cache or None)
+        scroll_plans = kwargs.get("scroll_plans", None)
+        self.__scroll_plans = SCROLL_PLAN_PATH if scroll_plans is True else (scroll_plans or None)
 
-        clients = toolbox.login(credentials={
-                                "app_name": self.__app_name,
-                                "services": self.__services,
-                                "index": self.__index})
-        self.__search_client = clients["search"]
-        self.__transfer_client = clients["transfer"]
-        self.__mdf_authorizer = clients["mdf"]
+        # Clients are shared with every other Forge in the process; the transfer client is only created when first used.
+        # In a child process, the shared clients and the HTTP pool open their own connections
+        self.__search_client = toolbox.CLIENTS.get("search", self.__app_name, self.__services, self.__index)
+        self.__mdf_authorizer = toolbox.CLIENTS.get("mdf", self.__app_name, self.__services)
+        self.__transfer_client = None
+        self.__http = toolbox.HTTPPool(self.__mdf_authorizer)
 
-        self.__query = Query(self.__search_client)
+        self.__query = Query(self.__search_client, cache=self.__cache, scroll_plans=self.__scroll_plans)
 
 
     @property
@@ -71,6 +135,8 @@ class Forge:
 
     @property
     def transfer_client(self):
+        if self.__transfer_client is None:
+            self.__transfer_client = toolbox.CLIENTS.get("transfer", self.__app_name, self.__services)
         return self.__transfer_client
 
 
@@ -78,6 +144,16 @@ class Forge:
     def mdf_authorizer(self):
         return self.__mdf_authorizer
 
+
+    @property
+    def cache(self):
+        return self.__cache
+
+
+    @property
+    def data_cache(self):
+        return self.__data_cache
+
 #################################################
 ##  Core functions
 #################################################
@@ -93,13 +169,7 @@ class Forge:
         Returns:
         self (Forge): For chaining.
         """
-        # If not the start of the query string, add an AND or OR
-        if self.__query.query != "(":
-            if required:
-                self.__query.and_join(new_group)
-            else:
-                self.__query.or_join(new_group)
-        self.__query.term(term)
+        self.__query.match_term(term, required, new_group)
         return self
 
 
@@ -119,20 +189,12 @@ class Forge:
         Returns:
         self (Forge): For chaining.
         """
-        # If not the start of the query string, add an AND or OR
-        if self.__query.query != "(":
-            if required:
-                self.__query.and_join(new_group)
-            else:
-                self.__query.or_join(new_group)
-        # Add default namespacing if not present
-        if "." not in field:
-            field = "mdf." + field
-        self.__query.field(field, value)
+        self.__query.match_field(field, value, required, new_group)
         return self
 
 
-    def search(self, q=None, advanced=False, limit=SEARCH_LIMIT, info=False, reset_query=True):
+    def search(self, q=None, advanced=False, limit=SEARCH_LIMIT, info=False, reset_query=True,
+               use_cache=True, refresh_cache=False, fields=None):
         """Execute a search and return the results.
 
         Arguments:
@@ -147,18 +209,80 @@ class Forge:
                      Default False.
         reset_query (bool): If True, will destroy the query after execution and start a fresh one. Does nothing if False.
                             Default True.
+        use_cache (bool): If True, will use the cache, if Forge was created with one. If False, will bypass the cache.
+                          Default True.
+        refresh_cache (bool): If True, will ignore any cached results and replace them with fresh ones. Default False.
+        fields (list of str): The fields to return from each record, as dot-separated paths (for example, "mdf.links").
+                              Default None, to return whole records.
 
         Returns:
         list (if info=False): The results.
         tuple (if info=True): The results, and a dictionary of query information.
         """
-        res = self.__query.search(q=q, advanced=advanced, limit=limit, info=info)
+        res = self.__query.search(q=q, advanced=advanced, limit=limit, info=info,
+                                  use_cache=use_cache, refresh_cache=refresh_cache, fields=fields)
         if reset_query:
             self.reset_query()
         return res
 
 
-    def aggregate(self, q=None, scroll_size=SEARCH_LIMIT, reset_query=True):
+    def search_many(self, queries, advanced=False, limit=SEARCH_LIMIT, info=False, workers=8, use_cache=True,
+                    fields=None):
+        """Execute many searches concurrently, and return the results of each.
+        Identical queries are only executed once. This method does not use or change the current query.
+
+        Arguments:
+        queries (list): The queries to execute. Each query may be:
+                        A query string,
+                        A dict of search() arguments ("q", and optionally "advanced" and "limit"), or
+                        A Query built with the Query methods.
+        advanced (bool): The default advanced mode for queries that do not set it. Default False.
+        limit (int): The default limit for queries that do not set it. Default SEARCH_LIMIT.
+        info (bool): If False, each result will be a list of records.
+                     If True, each result will be a tuple containing the records list, and other information about the query.
+                     Default False.
+        workers (int): The number of searches to run at once. Default 8.
+        use_cache (bool): If True, will use the cache, if Forge was created with one. If False, will bypass the cache.
+                          Default True.
+        fields (list of str): The fields to return from each record, for every query. See search() for details.
+
+        Returns:
+        list: The results of each query, in the same order as the queries.
+              Results of identical queries are the same object.
+        """
+        # Collapse identical queries into one search each
+        unique = {}
+        keys = []
+        for query in queries:
+            if isinstance(query, Query):
+                tree = query.tree()
+                search = {"q": tree.compile(), "advanced": advanced or query.advanced, "limit": limit}
+                key = tree.canonical()
+            else:
+                if not isinstance(query, dict):
+                    query = {"q": query}
+                search = {"q": query["q"], "advanced": query.get("advanced", advanced),
+                          "limit": query.get("limit", limit)}
+                key = _clean_query_string(search["q"])
+            key = (key, search["advanced"], search["limit"])
+            unique.setdefault(key, search)
+            keys.append(key)
+
+        if hasattr(self.__search_client, "set_pool_size"):
+            self.__search_client.set_pool_size(max(workers, 1))
+
+        def run(search):
+            return Query(self.__search_client, cache=self.__cache).search(info=info, use_cache=use_cache,
+                                                                          fields=fields, **search)
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = {key: executor.submit(run, search) for key, search in unique.items()}
+            results = {key: future.result() for key, future in futures.items()}
+        return [results[key] for key in keys]
+
+
+    def aggregate(self, q=None, scroll_size=SEARCH_LIMIT, reset_query=True, workers=1,
+                  use_cache=True, refresh_cache=False, fields=None):
         """Perform an advanced query, and return all matching results.
         Will automatically preform multiple queries in order to retrieve all results.
 
@@ -166,14 +290,110 @@ class Forge:
 
         Arguments:
         q (str): The query to execute. Defaults to the current query, if any. There must be some query to execute.
-        scroll_size (int): Minimum number of records returned per query
+        scroll_size (int): Target number of records requested per query
         reset_query (bool): If True, will destroy the query after execution and start a fresh one. Does nothing if False.
                             Default True.
+        workers (int): The number of scroll windows to fetch concurrently.
+                       Large aggregations are bound by request latency, so more workers finish proportionally faster.
+                       Default 1.
+        use_cache (bool): If True, will use the cache, if Forge was created with one. If False, will bypass the cache.
+                          Default True.
+        refresh_cache (bool): If True, will ignore any cached results and replace them with fresh ones. Default False.
+        fields (list of str): The fields to return from each record, as dot-separated paths (for example, "mdf.links").
+                              Default None, to return whole records.
 
         Returns:
         list of dict: All matching records
         """
-        res = self.__query.aggregate(q=q, scroll_size=scroll_size)
+        res = self.__query.aggregate(q=q, scroll_size=scroll_size, workers=workers,
+                                     use_cache=use_cache, refresh_cache=refresh_cache, fields=fields)
+        if reset_query:
+            self.reset_query()
+        return res
+
+
+    def aggregate_iter(self, q=None, scroll_size=SEARCH_LIMIT, reset_query=True, workers=1, pages=False,
+                       use_cache=True, refresh_cache=False, fields=None):
+        """Perform an advanced query, and yield all matching results as they arrive.
+        This is the streaming form of aggregate(); memory use is bounded by the scroll windows in flight
+        rather than the size of the result set.
+
+        Note that all aggregate queries run in advanced mode.
+
+        Arguments:
+        q (str): The query to execute. Defaults to the current query, if any. There must be some query to execute.
+        scroll_size (int): Target number of records requested per query
+        reset_query (bool): If True, will destroy the query after execution and start a fresh one. Does nothing if False.
+                            Default True.
+        workers (int): The number of scroll windows to fetch concurrently. Default 1.
+        pages (bool): If True, will yield the list of records in each scroll window.
+                      If False, will yield records one at a time.
+                      Default False.
+        use_cache (bool): If True, will use the cache, if Forge was created with one. If False, will bypass the cache.
+                          Default True.
+        refresh_cache (bool): If True, will ignore any cached results and replace them with fresh ones. Default False.
+        fields (list of str): The fields to return from each record, as dot-separated paths (for example, "mdf.links").
+                              Default None, to return whole records.
+
+        Returns:
+        generator: All matching records (or pages of records).
+        """
+        res = self.__query.aggregate_iter(q=q, scroll_size=scroll_size, workers=workers, pages=pages,
+                                          use_cache=use_cache, refresh_cache=refresh_cache, fields=fields)
+        if reset_query:
+            self.reset_query()
+        return res
+
+
+    def count(self, q=None, advanced=False, reset_query=True, use_cache=True, refresh_cache=False):
+        """Count the results of a search without transferring any records.
+
+        Arguments:
+        q (str): The query to count. Defaults to the current query, if any. There must be some query to count.
+        advanced (bool): If True, will submit query in "advanced" mode, which enables searches other than basic fulltext.
+                         If False, only basic fulltext term matches will be supported.
+                         Default False.
+                         This value can change to True automatically if the query is built using advanced features, such as match_field.
+        reset_query (bool): If True, will destroy the query after execution and start a fresh one. Does nothing if False.
+                            Default True.
+        use_cache (bool): If True, will use the cache, if Forge was created with one. If False, will bypass the cache.
+                          Default True.
+        refresh_cache (bool): If True, will ignore any cached results and replace them with fresh ones. Default False.
+
+        Returns:
+        int: The number of matching results, or -1 if there is no query.
+        """
+        res = self.__query.count(q=q, advanced=advanced, use_cache=use_cache, refresh_cache=refresh_cache)
+        if reset_query:
+            self.reset_query()
+        return res
+
+
+    def facets(self, fields=["mdf.source_name", "mdf.elements", "mdf.resource_type"], q=None, advanced=False,
+               size=FACET_SIZE, reset_query=True, use_cache=True, refresh_cache=False):
+        """Count the results of a search by the values of some fields, without transferring any records.
+
+        Arguments:
+        fields (str or list of str): The fields to count values of.
+                                     Default ["mdf.source_name", "mdf.elements", "mdf.resource_type"].
+        q (str): The query to count. Defaults to the current query, if any. There must be some query to count.
+        advanced (bool): If True, will submit query in "advanced" mode, which enables searches other than basic fulltext.
+                         If False, only basic fulltext term matches will be supported.
+                         Default False.
+                         This value can change to True automatically if the query is built using advanced features, such as match_field.
+        size (int): The maximum number of values to count for each field, starting with the most common. Default FACET_SIZE.
+        reset_query (bool): If True, will destroy the query after execution and start a fresh one. Does nothing if False.
+                            Default True.
+        use_cache (bool): If True, will use the cache, if Forge was created with one. If False, will bypass the cache.
+                          Default True.
+        refresh_cache (bool): If True, will ignore any cached results and replace them with fresh ones. Default False.
+
+        Returns:
+        dict: The counts of each value, indexed by field and then value.
+              For example, {"mdf.source_name": {"oqmd": 100, "cip": 10}}
+        """
+        res = self.__query.facets(fields, q=q, advanced=advanced, size=size,
+                                  use_cache=use_cache, refresh_cache=refresh_cache)
         if reset_query:
             self.reset_query()
         return res
@@ -182,7 +402,7 @@ class Forge:
     def reset_query(self):
         """Destroy the current query and create a fresh, clean one."""
         del self.__query
-        self.__query = Query(self.__search_client)
+        self.__query = Query(self.__search_client, cache=self.__cache, scroll_plans=self.__scroll_plans)
 
 
 #################################################
@@ -198,12 +418,7 @@ class Forge:
         Returns:
         self (Forge): For chaining.
         """
-        if not sources:
-            print("Error: No sources specified.")
-            return self
-        if not isinstance(sources, list):
-            sources = [sources]
-        self.match_field(field="mdf.source_name", value=",".join(sources), required=True, new_group=True)
+        self.__query.match_sources(sources)
         return self
 
 
@@ -217,20 +432,7 @@ class Forge:
         Returns:
         self (Forge): For chaining.
         """
-        if not elements:
-            print("Error: No elements specified.")
-            return self
-        if not isinstance(elements, list):
-            elements = [elements]
-
-        if match_all:
-            # First source should be in separate group (and required)
-            self.match_field(field="mdf.elements", value=elements[0], required=True, new_group=True)
-            # Other sources should stay in that group
-            for element in elements[1:]:
-                self.match_field(field="mdf.elements", value=element, required=match_all, new_group=False)
-        else:
-            self.match_field(field="mdf.elements", value=",".join(elements), required=True, new_group=True)
+        self.__query.match_elements(elements, match_all)
         return self
 
 
@@ -259,27 +461,49 @@ class Forge:
         return self.match_elements(elements, match_all=match_all).match_sources(sources).search(limit=limit, info=info)
 
 
-    def aggregate_source(self, sources):
+    def aggregate_source(self, sources, workers=1, fields=None):
         """Aggregate all records from a given source.
         There is no limit to the number of results returned.
         Please beware of aggregating very large datasets.
 
         Arguments:
         sources (str or list of str): The source to aggregate.
-        
+        workers (int): The number of scroll windows to fetch concurrently. Default 1.
+        fields (list of str): The fields to return from each record. See aggregate() for details.
+
         Returns:
         list of dict: All of the records from the source.
         """
-        return self.match_sources(sources).aggregate()
+        return self.match_sources(sources).aggregate(workers=workers, fields=fields)
+
+
+    def aggregate_source_iter(self, sources, workers=1, pages=False, fields=None):
+        """Yield all records from a given source as they arrive.
+        aggregate_source_iter(x) is equivalent to match_sources(x).aggregate_iter()
+
+        Arguments:
+        sources (str or list of str): The source to aggregate.
+        workers (int): The number of scroll windows to fetch concurrently. Default 1.
+        pages (bool): If True, will yield the list of records in each scroll window.
+                      If False, will yield records one at a time.
+                      Default False.
+        fields (list of str): The fields to return from each record. See aggregate() for details.
+
+        Returns:
+        generator: All of the records (or pages of records) from the source.
+        """
+        return self.match_sources(sources).aggregate_iter(workers=workers, pages=pages, fields=fields)
 
 
 #################################################
 ##  Data retrieval functions
 #################################################
 
-    def http_download(self, results, dest=".", preserve_dir=False, verbose=True):
-        """Download data files from the provided results using HTTPS.
-        For more than HTTP_NUM_LIMIT (defined above) files, you should use globus_download(), which uses Globus Transfer.
+    def plan_download(self, results, dest=".", preserve_dir=False, service="http", sync=False):
+        """Decide where the data files associated with results will be saved, without downloading anything.
+        Files linked from more than one record (for example, a dataset archive shared by every record)
+        are only planned once, and every record that links to them maps to the same local file.
+        A plan can be passed to http_download() or globus_download() in place of the results.
 
         Arguments:
         results (dict): The records from which files should be fetched.
@@ -287,184 +511,273 @@ class Forge:
         dest (str): The destination path for the data files on the local machine. Default current directory.
         preserve_dir (bool): If True, the directory structure for the data files will be recreated at the destination.
                              If False, only the data files themselves will be saved.
+                             Default False.
+        service (str): The service that will fetch the files, either "http" or "globus". Default "http".
+        sync (bool): If True, files already at the destination are planned under their own names,
+                     to be refreshed by a download with sync=True.
+                     If False, names taken by files already at the destination are renamed (e.g., myfile(1).ext).
+                     Default False.
+
+        Returns:
+        DownloadPlan: The unique files to fetch, and the local path of each file of each record.
+        """
+        # If results have info attached, remove it
+        if type(results) is tuple:
+            results = results[0]
+        return _plan_downloads(results, dest, preserve_dir, service, sync=bool(sync))
+
+
+    def http_download(self, results, dest=".", preserve_dir=False, verbose=True, workers=HTTP_WORKERS, per_host=HTTP_HOST_LIMIT,
+                      use_cache=True, sync=False, segments=HTTP_SEGMENTS, segment_threshold=HTTP_SEGMENT_THRESHOLD,
+                      callback=None, info=False, verify=True):
+        """Download data files from the provided results using HTTPS.
+        Files are fetched concurrently over a shared pool of connections, and streamed to disk.
+        Large files are split into byte ranges, which are fetched at once and written in place.
+        Each file is saved as <name>.part until it is complete; an interrupted download resumes from the .part file
+        when the same results are downloaded to the same destination again.
+        A file linked from several records is only downloaded once.
+        For very large numbers of files, globus_download(), which uses Globus Transfer, may still be faster.
+
+        Arguments:
+        results (dict or DownloadPlan): The records from which files should be fetched.
+                        This should be the return value of a search method, or of plan_download(service="http").
+        dest (str): The destination path for the data files on the local machine. Default current directory.
+                    Ignored if results is a DownloadPlan.
+        preserve_dir (bool): If True, the directory structure for the data files will be recreated at the destination.
+                             If False, only the data files themselves will be saved.
+                             Ignored if results is a DownloadPlan.
                             Default False.
         verbose (bool): If True, status and progress messages will be printed.
                         If False, only error messages will be printed.
                         Default True.
+        workers (int): The maximum number of files to fetch at once. Default HTTP_WORKERS.
+        per_host (int): The maximum number of files to fetch at once from any one server. Default HTTP_HOST_LIMIT.
+        use_cache (bool): If True, will copy files from the data cache, if Forge was created with one,
+                          fetching them into the cache first if needed. If False, will bypass the data cache.
+                          Sync downloads always bypass the data cache.
+                          Default True.
+        sync (bool): If True, files that were downloaded to the destination before and have not changed
+                     (on the server or locally) since are not downloaded again.
+                     What was downloaded is recorded in a manifest (SYNC_MANIFEST_NAME) at the destination.
+                     If False, every file is downloaded, and files already at the destination are not replaced.
+                     Default False.
+        segments (int): The number of byte ranges to fetch each large file in at once. 1 fetches every file in one stream.
+                        Default HTTP_SEGMENTS.
+        segment_threshold (int): The minimum size of a file, in bytes, to fetch it in segments. Default HTTP_SEGMENT_THRESHOLD.
+        callback (function): A function to call with the metrics of each file as it finishes.
+                             See toolbox.TransferMetrics for details. Default None.
+        info (bool): If False, http_download will return the local paths of the files.
+                     If True, http_download will return a tuple containing the local paths, and a toolbox.DownloadSummary
+                     of the download (files, bytes, throughput and latency per host, and retries).
+                     Default False.
+        verify (bool): If True, files whose links carry a checksum (see CHECKSUM_ALGORITHMS) are checked against it
+                       once downloaded, and a file that does not match is an error and is not saved.
+                       If False, only the size of each file is checked.
+                       Default True.
+
+        Returns:
+        list of dict (if info=False): For each record, the local path of each of its files, by link name.
+        tuple (if info=True): The local paths, and the summary of the download.
         """
-        # If results have info attached, remove it
-        if type(results) is tuple:
-            results = results[0]
-        if len(results) > HTTP_NUM_LIMIT:
-            print("Error: Too many results supplied. Use globus_download() for fetching more than " + str(HTTP_NUM_LIMIT) + " entries.")
-            return {
-                "success": False,
-                "message": "Too many results supplied. Use globus_download() for fetching more than " + str(HTTP_NUM_LIMIT) + " entries."
-                }
-        for res in tqdm(results, desc="Fetching files", disable= not verbose):
-            for key in tqdm(res["mdf"]["links"].keys(), desc="Fetching files", disable=True):  # not verbose):
-                dl = res["mdf"]["links"][key]
-                host = dl.get("http_host", None) if type(dl) is dict else None
-                if host:
-                    remote_path = dl["path"]
-                    # local_path should be either dest + whole path or dest + filename, depending on preserve_dir
-                    local_path = os.path.normpath(dest + "/" + dl["path"]) if preserve_dir else os.path.normpath(dest + "/" + os.path.basename(dl["path"]))
-                    # Make dirs for storing the file if they don't exist
-                    # preserve_dir doesn't matter; local_path has accounted for it already
-                    try:
-                        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-                    # If dest is current dir and preserve_dir=False, there are no dirs to make and os.makedirs() will raise FileNotFoundError.
-                    # Since it means all dirs required exist, it can be swallowed.
-                    except FileNotFoundError:
-                        pass
-                    # Check if file already exists, change filename if necessary
-                    collisions = 0
-                    while os.path.exists(local_path):
-                        # Find period marking extension, if exists
-                        # Will be after last slash
-                        index = local_path.rfind(".", local_path.rfind("/"))
-                        if index < 0:
-                            ext = ""
-                        else:
-                            ext = local_path[index:]
-                            local_path = local_path[:index]
-                        # Check if already added number to end
-                        old_add = "("+str(collisions)+")"
-                        collisions += 1
-                        new_add = "("+str(collisions)+")"
-                        if local_path.endswith(old_add):
-                            local_path = local_path[:-len(old_add)] + new_add + ext
-                        else:
-                            local_path = local_path + new_add + ext
-                    headers = {}
-                    self.__mdf_authorizer.set_authorization_header(headers)
-                    response = requests.get(host+remote_path, headers=headers)
-                    # Handle first 401 by regenerating auth headers
-                    if response.status_code == 401:
-                        self.__mdf_authorizer.handle_missing_authorization()
-                        self.__mdf_authorizer.set_authorization_header(headers)
-                        self.response = requests.get(host+remote_path, headers=headers)
-                    # Handle other errors by passing the buck to the user
-                    if response.status_code != 200:
-                        print("Error", response.status_code, " when attempting to access '", host+remote_path, "'", sep="")
-                    else:
-                        # Write out the binary response content
-                        with open(local_path, 'wb') as output:
-                            output.write(response.content)
+        plan = results if isinstance(results, DownloadPlan) else self.plan_download(results, dest, preserve_dir, "http", sync)
+        if plan.service != "http":
+            print("Error: http_download() requires a plan made with service='http'")
+            return ([], toolbox.TransferMetrics().summary()) if info else []
+        _make_download_dirs(plan)
+        jobs = [(host + remote_path, local_path, plan.checksums.get((host, remote_path)) if verify else None)
+                for (host, remote_path), local_path in plan.files.items()]
+
+        manifest = None
+        segmenting = {"segments": segments, "segment_threshold": segment_threshold}
+        if sync or plan.sync:
+            manifest = toolbox.SyncManifest(os.path.join(plan.dest, SYNC_MANIFEST_NAME))
+            def fetch(url, local_path, checksum):
+                return self.__http.download(url, local_path, checksum=checksum,
+                                            headers=manifest.conditions(url, local_path), info=True, **segmenting)
+        elif self.__data_cache is not None and use_cache:
+            def fetch(url, local_path, checksum):
+                return self.__cached_download(url, local_path, checksum=checksum, **segmenting)
+        else:
+            def fetch(url, local_path, checksum):
+                return self.__http.download(url, local_path, checksum=checksum, info=True, **segmenting)
+        metrics = toolbox.TransferMetrics(callback)
+        unchanged = 0
+        downloads = self.__http.map(fetch, jobs, workers=workers, per_host=per_host)
+        try:
+            for (url, local_path, checksum), (status, download_info) in tqdm(downloads, total=len(jobs),
+                                                                             desc="Fetching files", disable= not verbose):
+                metrics.record_file(url, local_path, status, download_info)
+                if manifest is not None:
+                    if status == 304:
+                        unchanged += 1
+                        continue
+                    if status == 200:
+                        manifest.record(url, local_path, download_info)
+                # Handle errors by passing the buck to the user
+                if status != 200:
+                    print("Error", status, " when attempting to access '", url, "'", sep="")
+        finally:
+            if manifest is not None:
+                manifest.save()
+        if manifest is not None and verbose:
+            print(unchanged, "of", len(jobs), "files were already up to date")
+        if info:
+            return plan.record_paths, metrics.summary()
+        return plan.record_paths
+
 
+    def __cached_download(self, url, local_path, **kwargs):
+        """Save a file from the data cache, fetching it into the cache first if needed.
 
-    def globus_download(self, results, dest=".", dest_ep=None, preserve_dir=False, wait_for_completion=True, verbose=True):
+        Returns:
+        tuple: The result, and the "bytes" copied and "seconds" taken (the server's latency and retries are unknown).
+        """
+        start = time.time()
+        size = 0
+        with self.__data_cache.pinned(self.__http, url, **kwargs) as status:
+            if status == 200:
+                try:
+                    shutil.copyfile(self.__data_cache.file_path(url), local_path)
+                    size = os.path.getsize(local_path)
+                except OSError as e:
+                    status = e
+        return status, {"bytes": size, "seconds": time.time() - start, "latency": None, "retries": 0}
+
+
+    def globus_download(self, results, dest=".", dest_ep=None, preserve_dir=False, wait_for_completion=True, verbose=True,
+                        sync=False, callback=None, info=False):
         """Download data files from the provided results using Globus Transfer.
         This method requires Globus Connect to be installed on the destination endpoint.
+        Files are split into tasks of at most TRANSFER_ITEM_LIMIT files (and TRANSFER_BYTES_LIMIT bytes of request)
+        per source endpoint, which are submitted concurrently. A file linked from several records is only transferred once.
+        To find out where each record's files were saved, make a plan with plan_download(service="globus") and pass it here.
 
         Arguments:
-        results (dict): The records from which files should be fetched.
-                        This should be the return value of a search method.
+        results (dict or DownloadPlan): The records from which files should be fetched.
+                        This should be the return value of a search method, or of plan_download(service="globus").
         dest (str): The destination path for the data files on the local machine. Default current directory.
+                    Ignored if results is a DownloadPlan.
         preserve_dir (bool): If True, the directory structure for the data files will be recreated at the destination.
                                 The path to tne new files will be relative to the `dest` path
                              If False, only the data files themselves will be saved.
+                             Ignored if results is a DownloadPlan.
                              Default False.
-        wait_for_completion (bool): If True, will block until the transfer is finished.
+        wait_for_completion (bool): If True, will block until all of the transfers are finished, showing their combined progress.
                                     If False, will not block.
                                     Default True.
         verbose (bool): If True, status and progress messages will be printed.
                         If False, only error messages will be printed.
                         Default True.
+        sync (bool or str): If True, files already at the destination are only transferred again if they differ from the source,
+                            as decided by Globus Transfer with TRANSFER_SYNC_LEVEL. A sync level ("exists", "size", "mtime",
+                            or "checksum") may be given instead of True.
+                            If False, every file is transferred, and files already at the destination are not replaced.
+                            Default False.
+        callback (function): A function to call with the status of each task when it is submitted, and each time it is checked.
+                             See toolbox.TransferMetrics for details. Default None.
+        info (bool): If False, globus_download will return the task IDs.
+                     If True, globus_download will return a tuple containing the task IDs, and a toolbox.DownloadSummary
+                     of the download (files, bytes, throughput per source endpoint, and the status of each task).
+                     Default False.
 
         Returns:
-        list of str: task IDs of the Gloubs transfers
+        list of str (if info=False): task IDs of the Gloubs transfers
+        tuple (if info=True): The task IDs, and the summary of the download.
         """
-        dest = os.path.abspath(dest)
-        # If results have info attached, remove it
-        if type(results) is tuple:
-            results = results[0]
+        plan = results if isinstance(results, DownloadPlan) else self.plan_download(results, dest, preserve_dir, "globus", sync)
+        if plan.service != "globus":
+            print("Error: globus_download() requires a plan made with service='globus'")
+            return ([], toolbox.TransferMetrics().summary()) if info else []
+        _make_download_dirs(plan)
         if not dest_ep:
             if not self.local_ep:
-                self.local_ep = toolbox.get_local_ep(self.__transfer_client)
+                self.local_ep = toolbox.get_local_ep(self.transfer_client)
             dest_ep = self.local_ep
 
-        # Assemble the transfer data
-        tasks = {}
-        filenames = set()
-        for res in tqdm(results, desc="Processing records", disable= not verbose):
-            for key in tqdm(res["mdf"]["links"].keys(), desc="Fetching files", disable=True): 
+        # Assemble the transfer items for each endpoint
+        items = {}
+        for (host, remote_path), local_path in plan.files.items():
+            items.setdefault(host, []).append((remote_path, local_path))
 
-                # Get the location of the data
-                dl = res["mdf"]["links"][key]
-                host = dl.get("globus_endpoint", None) if type(dl) is dict else None
+        # Split the items into bounded tasks, and submit them concurrently
+        batches = [(host, batch) for host, host_items in items.items() for batch in _batch_transfer_items(host_items)]
+        if isinstance(sync, str):
+            sync_level = sync
+        else:
+            sync_level = TRANSFER_SYNC_LEVEL if sync or plan.sync else None
 
-                # If the data is on a Globus Endpoint
-                #   LW 9Aug17: Should we at least throw a warning if the data isn't on an endpoint?
-                if host:
-                    remote_path = dl["path"]
-                    # local_path should be either dest + whole path or dest + filename, depending on preserve_dir
-                    if preserve_dir:
-                        local_path = os.path.abspath(dest + remote_path) # remote_path is absolute, so os.path.join does not work!
-                    else:
-                        local_path = os.path.abspath(os.path.join(dest, os.path.basename(remote_path)))
-
-                    # Make dirs for storing the file if they don't exist
-                    # preserve_dir doesn't matter; local_path has accounted for it already
-                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
-                    try:
-                        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-                    # If dest is current dir and preserve_dir=False, there are no dirs to make and os.makedirs() will raise FileNotFoundError.
-                    # Since it means all dirs required exist, it can be swallowed.
-                    except FileNotFoundError:
-                        pass
-
-                    if not preserve_dir:
-                        # Check if file already exists, change filename if necessary
-                        #   The pattern is to add a number just before the extension (e.g., myfile(1).ext)
-                        collisions = 0
-                        while os.path.exists(local_path) or local_path in filenames:
-                            # Find period marking extension, if exists
-                            # Will be after last slash
-                            index = local_path.rfind(".", local_path.rfind("/"))
-                            if index < 0:
-                                ext = ""
-                            else:
-                                ext = local_path[index:]
-                                local_path = local_path[:index]
-                            # Check if already added number to end
-                            old_add = "("+str(collisions)+")"
-                            collisions += 1
-                            new_add = "("+str(collisions)+")"
-                            if local_path.endswith(old_add):
-                                local_path = local_path[:-len(old_add)] + new_add + ext
-                            else:
-                                local_path = local_path + new_add + ext
-
-                    # Add data to a transfer data object
-                    #   LW 11Aug17: TODO, handle transfers with huge number of files
-                    #      - If a TransferData object is too large. Globus might timeout before it can be completely uploaded
-                    #        So, we need to be able to check the size of the TD object, and - if need be - send it early
-                    if host not in tasks.keys():
-                        tasks[host] = globus_sdk.TransferData(self.__transfer_client, host, dest_ep, verify_checksum=True)
-                    tasks[host].add_item(remote_path, local_path)
-                    filenames.add(local_path)
-
-        # Submit the jobs
+        def submit(host, batch):
+            td = globus_sdk.TransferData(self.transfer_client, host, dest_ep, sync_level=sync_level, verify_checksum=True)
+            for remote_path, local_path in batch:
+                td.add_item(remote_path, local_path)
+            return self.transfer_client.submit_transfer(td)
+
+        metrics = toolbox.TransferMetrics(callback)
         submissions = []
-        for td in tqdm(tasks.values(), desc="Submitting transfers", disable= not verbose):
-            result = self.__transfer_client.submit_transfer(td)
-            if result["code"] != "Accepted":
-                print("Error submitting transfer:", result["message"])
-            else:
-                if wait_for_completion:
-                    while not self.__transfer_client.task_wait(result["task_id"], timeout=60, polling_interval=10):
-                        if verbose:
-                            print("Transferring...")
-                submissions.append(result["task_id"])
+        with ThreadPoolExecutor(max_workers=TRANSFER_WORKERS) as executor:
+            futures = [(host, batch, executor.submit(submit, host, batch)) for host, batch in batches]
+            for host, batch, future in tqdm(futures, desc="Submitting transfers", disable= not verbose):
+                result = future.result()
+                if result["code"] != "Accepted":
+                    print("Error submitting transfer:", result["message"])
+                else:
+                    submissions.append(result["task_id"])
+                    metrics.record_task({"task_id": result["task_id"], "status": "ACTIVE", "source_endpoint_id": host,
+                                         "files": len(batch)})
         if verbose:
             print("All transfers submitted")
             print("Task IDs:", "\n".join(submissions))
+        if wait_for_completion:
+            self.__wait_for_transfers(submissions, verbose, metrics)
+        if info:
+            return submissions, metrics.summary()
         return submissions
 
-    def http_stream(self, results, verbose=True):
+
+    def __wait_for_transfers(self, task_ids, verbose, metrics=None):
+        """Wait for Globus Transfer tasks to finish, checking on all of them together.
+
+        Arguments:
+        task_ids (list of str): The tasks to wait for.
+        verbose (bool): If True, the combined progress of the tasks will be shown.
+        metrics (TransferMetrics): Where to record the state of the tasks each time they are checked. Default None.
+        """
+        files = {}
+        files_done = {}
+        remaining = list(task_ids)
+        with tqdm(total=0, desc="Transferring files", unit="files", disable= not verbose) as pbar:
+            while remaining:
+                finished = set()
+                returned = set()
+                for i in range(0, len(remaining), TASK_FILTER_LIMIT):
+                    batch = remaining[i:i + TASK_FILTER_LIMIT]
+                    for task in self.transfer_client.task_list(num_results=len(batch),
+                                                                 filter="task_id:" + ",".join(batch)):
+                        returned.add(task["task_id"])
+                        files[task["task_id"]] = task["files"]
+                        files_done[task["task_id"]] = task["files_transferred"] + task["files_skipped"]
+                        if metrics is not None:
+                            metrics.record_task(task)
+                        if task["status"] != "ACTIVE":
+                            finished.add(task["task_id"])
+                            if task["status"] != "SUCCEEDED":
+                                print("Error: Transfer task", task["task_id"], "finished with status", task["status"])
+                # Tasks that are not listed (a wrong ID, or another identity's task) would otherwise be waited on forever
+                for task_id in remaining:
+                    if task_id not in returned:
+                        finished.add(task_id)
+                        print("Error: Transfer task", task_id, "was not found")
+                pbar.total = sum(files.values())
+                pbar.update(sum(files_done.values()) - pbar.n)
+                remaining = [task_id for task_id in remaining if task_id not in finished]
+                if remaining:
+                    time.sleep(TRANSFER_POLL_INTERVAL)
+
+
+    def http_stream(self, results, verbose=True, use_cache=True, output="text", prefetch=HTTP_PREFETCH, decompress=False):
         """Yield data files from the provided results using HTTPS, through a generator.
-        For more than HTTP_NUM_LIMIT (defined above) files, you should use globus_download(), which uses Globus Transfer.
+        The next `prefetch` files are downloaded in the background while the current one is consumed.
+        For very large numbers of files, globus_download(), which uses Globus Transfer, may be faster.
 
         Arguments:
         results (dict): The records from which files should be fetched.
@@ -472,43 +785,111 @@ class Forge:
         verbose (bool): If True, status and progress messages will be printed.
                         If False, only error messages will be printed.
                         Default True.
+        use_cache (bool): If True, will read files from the data cache, if Forge was created with one,
+                          fetching them into the cache first if needed. If False, will bypass the data cache.
+                          Default True.
+        output (str): "text" to yield the text of each file.
+                      "bytes" to yield the contents of each file.
+                      "file" to yield each file as a binary file object, read from disk instead of memory.
+                      The caller should close each file object.
+                      Default "text".
+        prefetch (int): The number of files to fetch ahead of the consumer. Default HTTP_PREFETCH.
+        decompress (bool): If True, gzipped files will be decompressed. Default False.
 
         Yields:
-        str: Text of each data file.
+        str, bytes, or file: Each data file, in the order of the results.
         """
+        if output not in ("text", "bytes", "file"):
+            raise ValueError("output must be 'text', 'bytes', or 'file'")
         # If results have info attached, remove it
         if type(results) is tuple:
             results = results[0]
-        if len(results) > HTTP_NUM_LIMIT:
-            print("Too many results supplied. Use globus_download() for fetching more than " + str(HTTP_NUM_LIMIT) + " entries.")
-            return {
-                "success": False,
-                "message": "Too many results supplied. Use globus_download() for fetching more than " + str(HTTP_NUM_LIMIT) + " entries."
-                }
+        urls = []
         for res in results:
             for key in res["mdf"]["links"].keys():
                 dl = res["mdf"]["links"][key]
                 host = dl.get("http_host", None) if type(dl) is dict else None
                 if host:
-                    remote_path = dl["path"]
-                    headers = {}
-                    self.__mdf_authorizer.set_authorization_header(headers)
-                    response = requests.get(host+remote_path, headers=headers)
-                    # Handle first 401 by regenerating auth headers
-                    if response.status_code == 401:
-                        self.__mdf_authorizer.handle_missing_authorization()
-                        self.__mdf_authorizer.set_authorization_header(headers)
-                        self.response = requests.get(host+remote_path, headers=headers)
-                    # Handle other errors by passing the buck to the user
-                    if response.status_code != 200:
-                        print("Error", response.status_code, " when attempting to access '", host+remote_path, "'", sep="")
+                    urls.append(host+dl["path"])
+
+        urls = iter(urls)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as executor:
+            try:
+                while True:
+                    # Keep the current file and the next `prefetch` in flight
+                    for url in urls:
+                        pending.append((url, executor.submit(self.__fetch_file, url, output, decompress, use_cache)))
+                        if len(pending) > prefetch:
+                            break
+                    if not pending:
+                        break
+                    url, future = pending.popleft()
+                    status, data = future.result()
+                    # Handle errors by passing the buck to the user
+                    if status != 200:
+                        print("Error", status, " when attempting to access '", url, "'", sep="")
                     else:
-                        yield response.text
+                        yield data
+            finally:
+                # Files fetched ahead that the consumer will never see must be closed here
+                for url, future in pending:
+                    if future.cancel():
+                        continue
+                    status, data = future.result()
+                    if data is not None and output == "file":
+                        data.close()
+
 
+    def __fetch_file(self, url, output, decompress, use_cache):
+        """Fetch one data file for http_stream().
 
-    def http_return(self, results, verbose=True):
+        Returns:
+        tuple: The HTTP status code (or the error), and the file in the requested output form (None on error).
+        """
+        try:
+            if self.__data_cache is not None and use_cache:
+                # The file must not be evicted before it is open
+                with self.__data_cache.pinned(self.__http, url) as status:
+                    if status != 200:
+                        return status, None
+                    path = self.__data_cache.file_path(url)
+                    if output == "file":
+                        with open(path, "rb") as f:
+                            gzipped = f.read(2) == GZIP_MAGIC
+                        return status, gzip.open(path, "rb") if decompress and gzipped else open(path, "rb")
+                    # Read straight from the mapped file
+                    with self.__data_cache.open(url) as data:
+                        if decompress and data[:2] == GZIP_MAGIC:
+                            data = gzip.decompress(data)
+                        return status, str(data, "utf-8", "replace") if output == "text" else bytes(data)
+
+            with self.__http.get(url, stream=True) as response:
+                if response.status_code != 200:
+                    return response.status_code, None
+                if output != "file":
+                    data = response.content
+                    if decompress and data[:2] == GZIP_MAGIC:
+                        data = gzip.decompress(data)
+                    return 200, str(data, response.encoding or "utf-8", "replace") if output == "text" else data
+                # Spool to a temporary file, decompressing on the way if needed
+                f = tempfile.TemporaryFile()
+                decompressor = None
+                for chunk in response.iter_content(toolbox.HTTPPool.CHUNK_SIZE):
+                    if decompressor is None:
+                        decompressor = zlib.decompressobj(31) if decompress and chunk[:2] == GZIP_MAGIC else False
+                    f.write(decompressor.decompress(chunk) if decompressor else chunk)
+                if decompressor:
+                    f.write(decompressor.flush())
+                f.seek(0)
+                return 200, f
+        except (OSError, zlib.error, requests.RequestException) as e:
+            return e, None
+
+
+    def http_return(self, results, verbose=True, use_cache=True):
         """Return data files from the provided results using HTTPS.
-        For more than HTTP_NUM_LIMIT (defined above) files, you should use globus_download(), which uses Globus Transfer.
+        For very large numbers of files, globus_download(), which uses Globus Transfer, may be faster.
 
         Arguments:
         results (dict): The records from which files should be fetched.
@@ -516,12 +897,334 @@ class Forge:
         verbose (bool): If True, status and progress messages will be printed.
                         If False, only error messages will be printed.
                         Default True.
+        use_cache (bool): If True, will read files from the data cache, if Forge was created with one.
+                          If False, will bypass the data cache.
+                          Default True.
 
         Returns:
         list of str: Text data of the data files.
         """
-        return list(self.http_stream(results, verbose=verbose))
+        return list(self.http_stream(results, verbose=verbose, use_cache=use_cache))
+
+
+
+class DownloadPlan(namedtuple("DownloadPlan", ["service", "dest", "sync", "files", "record_paths", "checksums"])):
+    """Where the data files of some results will be saved, made by Forge.plan_download().
+
+    Fields:
+    service (str): The service the plan was made for, "http" or "globus".
+    dest (str): The destination directory.
+    sync (bool): Whether the plan reuses the names of files already at the destination, for a sync download.
+    files (OrderedDict): The local path of each unique file, by (host, remote path),
+                         where the host is the HTTP host or Globus endpoint ID.
+    record_paths (list of dict): For each record, in order, the local path of each of its files, by link name.
+    checksums (dict): The (hashlib algorithm, hex digest) of each unique file whose link carries a checksum,
+                      by (host, remote path).
+    """
+    __slots__ = ()
+
+
+def _plan_downloads(results, dest, preserve_dir, service, sync=False):
+    """Plan the download of the files linked from some records, fetching each unique (host, path) once.
+    See Forge.plan_download() for details.
+    """
+    if service == "http":
+        host_field = "http_host"
+    elif service == "globus":
+        host_field = "globus_endpoint"
+        # Globus Transfer requires absolute paths
+        dest = os.path.abspath(dest)
+    else:
+        raise ValueError("Unknown download service '" + str(service) + "'")
+    files = OrderedDict()
+    record_paths = []
+    checksums = {}
+    destinations = toolbox.DestinationIndex(existing=not sync)
+    for res in results:
+        paths = {}
+        for key, dl in res["mdf"]["links"].items():
+            host = dl.get(host_field, None) if type(dl) is dict else None
+            if not host:
+                continue
+            remote_path = dl["path"]
+            local_path = files.get((host, remote_path))
+            if local_path is None:
+                # local_path should be either dest + whole path or dest + filename, depending on preserve_dir
+                if service == "globus" and preserve_dir:
+                    local_path = os.path.abspath(dest + remote_path) # remote_path is absolute, so os.path.join does not work!
+                elif preserve_dir:
+                    local_path = os.path.normpath(dest + "/" + remote_path)
+                else:
+                    local_path = os.path.normpath(os.path.join(dest, os.path.basename(remote_path)))
+                # Change filename if the file already exists (or will, from a different remote file)
+                #   The pattern is to add a number just before the extension (e.g., myfile(1).ext)
+                local_path = destinations.claim(local_path, rename=service == "http" or not preserve_dir)
+                files[(host, remote_path)] = local_path
+                checksum = _link_checksum(dl)
+                if checksum:
+                    checksums[(host, remote_path)] = checksum
+            paths[key] = local_path
+        record_paths.append(paths)
+    return DownloadPlan(service, dest, sync, files, record_paths, checksums)
+
+
+def _link_checksum(link):
+    """Return the (hashlib algorithm, hex digest) of the most preferred checksum a file link carries, or None."""
+    for algorithm in CHECKSUM_ALGORITHMS:
+        if link.get(algorithm):
+            return algorithm, link[algorithm]
+    return None
+
+
+def _make_download_dirs(plan):
+    """Make the directories for storing the files of a DownloadPlan, if they don't exist."""
+    for directory in sorted({os.path.dirname(local_path) for local_path in plan.files.values()}):
+        # If dest is the current dir and preserve_dir=False, there are no dirs to make
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+
+def _clean_query_string(q):
+    """Clean up a query string built by hand or by the legacy string-appending Query."""
+    q = q.strip().replace("()", "")
+    if q.endswith("("):
+        q = q[:-1]
+    # Remove misplaced AND/OR at end
+    if q[-3:] == "AND":
+        q = q[:-3]
+    elif q[-2:] == "OR":
+        q = q[:-2]
+
+    # Balance parentheses
+    imbalance = q.count("(") - q.count(")")
+    if imbalance > 0:
+        q += ")" * imbalance
+    elif imbalance < 0:
+        q = "(" * -imbalance + q
+
+    return q
+
+
+def _field_list(fields):
+    """Normalize a field projection into a sorted list, or None for whole records, so equivalent projections share cache entries."""
+    if not fields:
+        return None
+    if isinstance(fields, str):
+        fields = [fields]
+    return sorted(set(fields))
+
+
+def _batch_transfer_items(items, max_items=None, max_bytes=None):
+    """Split transfer items into batches small enough to submit as one Globus Transfer task each.
+
+    Arguments:
+    items (list of tuple): The (source path, destination path) of each item.
+    max_items (int): The maximum number of items in a batch. Default TRANSFER_ITEM_LIMIT.
+    max_bytes (int): The maximum approximate size of a batch's submission, in bytes. Default TRANSFER_BYTES_LIMIT.
+
+    Yields:
+    list of tuple: Each batch of items.
+    """
+    max_items = max_items or TRANSFER_ITEM_LIMIT
+    max_bytes = max_bytes or TRANSFER_BYTES_LIMIT
+    batch = []
+    size = 0
+    for item in items:
+        # Each item is sent as a small JSON document holding both paths
+        item_size = len(item[0]) + len(item[1]) + 100
+        if batch and (len(batch) >= max_items or size + item_size > max_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(item)
+        size += item_size
+    if batch:
+        yield batch
+
+
+def _scroll_planner(index, key, scroll_size, path=None):
+    """Create the ScrollPlanner for an aggregation.
+
+    Arguments:
+    index (str): The name of the index searched.
+    key (str): The canonical form of the query.
+    scroll_size (int): The target number of records in each scroll window.
+    path (str): The JSON file to remember scroll windows in, or None to not remember them. Default None.
+
+    Returns:
+    ScrollPlanner: The planner.
+    """
+    return toolbox.ScrollPlanner(key=str(index) + "|" + key, target=min(scroll_size, SEARCH_LIMIT), path=path)
+
+
+def _window_searches(q, start, width, planner, known):
+    """Plan the searches that fetch all records in the scroll window [start, start + width).
+    The searches are not executed here, so that Query and AsyncForge can share this plan: each GSearchRequest
+    is yielded, and must be answered with send() and the (records, total, count) of its result.
+    The records in the window are returned when the generator stops (see _run_searches()).
+
+    `scroll_id`s are unique to each dataset. If multiple datasets match a certain query,
+    the number of matching records in a window may exceed the maximum that Search will return,
+    even if the window is much smaller than that maximum. In that case the window is
+    fetched in smaller pieces.
+
+    Arguments:
+    q (str): The cleaned query to execute.
+    start (int): The first scroll_id in the window.
+    width (int): The width of the window.
+    planner (ScrollPlanner): The planner to report window sizes to.
+    known (bool): If True, the planner already knows the window fits.
+                  If False, the window is sized with a count-only probe before fetching any records.
+    """
+    def window_query(lo, hi, limit):
+        return {"q": "(" + q + ") AND mdf.scroll_id:>=%d AND mdf.scroll_id:<%d" % (lo, hi),
+                "advanced": True, "limit": limit}
+
+    records = []
+    end = start + width
+    window_total = None
+    if not known:
+        page, window_total, count = yield window_query(start, end, 0)
+        planner.observe(start, end, window_total)
+        if window_total == 0:
+            return records
+        # Split the window evenly into pieces that should each fit
+        pieces = -(-window_total // planner.target)
+        width = -(-width // pieces)
+
+    # Stop once every record in the window is found, so empty pieces at the end are never requested
+    while start < end and (window_total is None or len(records) < window_total):
+        width = min(width, end - start)
+        page, total, count = yield window_query(start, start + width, SEARCH_LIMIT)
+        planner.observe(start, start + width, total)
+        # Without a probe, the first request covers the whole window
+        if window_total is None:
+            window_total = total
+
+        # Check to make sure that all the matching records were returned
+        # If not, reduce the width and try again
+        if total > count and width > 1:
+            width = max(int(width * (count / total)), 1)
+            continue
+
+        records.extend(page)
+        start += width
+
+    return records
+
+
+def _run_searches(searches, search):
+    """Execute a plan of searches, such as _window_searches(), and return its result.
+
+    Arguments:
+    searches (generator): The plan.
+    search (function): Executes a GSearchRequest, and returns the (records, total, count) of its result.
+    """
+    try:
+        request = next(searches)
+        while True:
+            request = searches.send(search(request))
+    except StopIteration as e:
+        return e.value
+
+
+class QueryTerm(namedtuple("QueryTerm", ["text"])):
+    """An immutable fulltext term in a query tree."""
+    __slots__ = ()
+
+    def compile(self):
+        return self.text
+
+    def canonical(self):
+        return self.text.strip()
+
+
+class QueryField(namedtuple("QueryField", ["field", "value"])):
+    """An immutable field:value term in a query tree."""
+    __slots__ = ()
+
+    def compile(self):
+        return self.field + ":" + self.value
+
+    def canonical(self):
+        return self.compile()
+
+
+class QueryString(namedtuple("QueryString", ["text"])):
+    """An immutable, pre-built query string in a query tree."""
+    __slots__ = ()
+
+    def compile(self):
+        return _clean_query_string(self.text)
+
+    def canonical(self):
+        return self.compile()
+
+
+class QueryGroup(namedtuple("QueryGroup", ["items", "ops"])):
+    """An immutable sequence of query nodes joined by operators.
+    ops[i] ("AND" or "OR") joins items[i] and items[i+1]. Nested groups are parenthesized when compiled.
+    The root of a query tree is a QueryGroup of QueryGroups.
+    """
+    __slots__ = ()
+
+    def compile(self):
+        """Compile the tree into a Globus Search query string."""
+        parts = []
+        for i, item in enumerate(self.items):
+            if i:
+                parts.append(" " + self.ops[i-1] + " ")
+            parts.append("(" + item.compile() + ")" if isinstance(item, QueryGroup) else item.compile())
+        return "".join(parts)
+
+
+    def canonical(self):
+        """Return a canonical form of the query, for caching and deduplication.
+        Equivalent queries that differ only in the order or repetition of terms joined by a single
+        operator have the same canonical form.
+        """
+        keys = []
+        # Raw terms and strings are compiled without parentheses, so one holding its own operators
+        # binds with its neighbors, and the group cannot be reordered
+        reorderable = True
+        for item in self.items:
+            key = item.canonical()
+            if isinstance(item, QueryGroup):
+                if len(item.items) > 1 and len(self.items) > 1:
+                    key = "(" + key + ")"
+            elif len(key.split()) > 1:
+                reorderable = False
+            keys.append(key)
+        if reorderable and len(set(self.ops)) <= 1:
+            # A group joined only by AND (or only by OR) can be ordered freely
+            op = " " + (self.ops[0] if self.ops else "AND") + " "
+            return op.join(sorted(set(keys)))
+        parts = [keys[0]]
+        for op, key in zip(self.ops, keys[1:]):
+            parts.append(" " + op + " " + key)
+        return "".join(parts)
+
+
+    def split_field(self, field):
+        """Split the query into one query per comma-separated value of a field, such as the sources
+        added by Forge.match_sources(). Each query can then be executed in parallel.
+        The field must be required by the whole query: alone in its group, and joined to the rest with AND.
+
+        Arguments:
+        field (str): The field to split on.
 
+        Returns:
+        list of QueryGroup: One query per value, or only this query if it cannot be split.
+        """
+        if "OR" in self.ops:
+            return [self]
+        for i, item in enumerate(self.items):
+            node = item.items[0] if isinstance(item, QueryGroup) and len(item.items) == 1 else item
+            if isinstance(node, QueryField) and node.field == field and "," in node.value:
+                return [self._replace(items=self.items[:i] + (QueryGroup((QueryField(field, value),), ()),)
+                                      + self.items[i+1:])
+                        for value in node.value.split(",")]
+        return [self]
 
 
 class Query:
@@ -529,11 +1232,14 @@ class Query:
     as Forge manages all the functions a user might need, but advanced users may do so at their own risk. Using Query
     directly is an unsupported behavior and may have unexpected results or unlisted changes in the future.
 
-    Queries may end up wrapped in parentheses, which has no direct effect on the search. Adding terms must be chained
-    with .and() or .or(). Terms will not have spaces in between otherwise, and it is desirable to be explicit about
-    which terms are required.
+    Queries may end up wrapped in parentheses, which has no direct effect on the search. Adding terms should be chained
+    with .and() or .or(), as it is desirable to be explicit about which terms are required. Terms added without
+    a join are required (AND).
+
+    Terms are kept in an immutable query tree (see tree()), which is compiled to a query string once per search.
+    The `query` attribute shows the query in progress as a string.
     """
-    def __init__(self, search_client, q="(", limit=None, advanced=False):
+    def __init__(self, search_client, q="(", limit=None, advanced=False, cache=None, scroll_plans=None):
         """Initialize the Query instance.
 
         Arguments:
@@ -543,35 +1249,109 @@ class Query:
         advanced: If True, will submit query in "advanced" mode, which enables searches other than basic fulltext.
                   If False, only basic fulltext term matches will be supported.
                   Default False.
+        cache (SearchCache): The cache to keep search and aggregate results in, or None to disable caching.
+                             Default None.
+        scroll_plans (str): The JSON file to remember scroll windows in (see ScrollPlanner), or None to not remember them.
+                            Default None.
         """
         self.__search_client = search_client
         self.query = q
         self.limit = limit
         self.advanced = advanced
+        self.cache = cache
+        self.scroll_plans = scroll_plans
 
 
-    def __clean_query_string(self, q):
-        """Clean up a query string.
-        This method does not access self, so that a search will not change state.
-        """
-        q = q.strip().replace("()", "")
-        if q.endswith("("):
-            q = q[:-1]
-        # Remove misplaced AND/OR at end
-        if q[-3:] == "AND":
-            q = q[:-3]
-        elif q[-2:] == "OR":
-            q = q[:-2]
-
-        # Balance parentheses
-        while q.count("(") > q.count(")"):
-            q += ")"
-        while q.count(")") > q.count("("):
-            q = "(" + q
-        
+    @property
+    def query(self):
+        """The query in progress, as a string. Open groups and trailing joins are left unclosed."""
+        groups = []
+        for items, ops in self.__groups:
+            parts = []
+            for i, item in enumerate(items):
+                if i:
+                    parts.append(" " + ops[i-1] + " ")
+                parts.append(item.text if isinstance(item, QueryString) else item.compile())
+            groups.append("".join(parts))
+        # Pre-built query strings already open their own group
+        first = self.__groups[0][0][:1]
+        q = groups[0] if first and isinstance(first[0], QueryString) and groups[0].startswith("(") else "(" + groups[0]
+        for op, group in zip(self.__group_ops, groups[1:]):
+            q += ") " + op + " (" + group
+        if self.__pending:
+            op, close_group = self.__pending
+            q += ") " + op + " (" if close_group else " " + op + " "
         return q
 
 
+    @query.setter
+    def query(self, q):
+        """Replace the query with a pre-built query string."""
+        # Each group is a pair of (items, operators joining the items)
+        self.__groups = [([], [])]
+        self.__group_ops = []
+        # The join waiting for the next term, as (operator, close_group)
+        self.__pending = None
+        self.__tree = None
+        if q.strip("() "):
+            self.__groups[0][0].append(QueryString(q))
+
+
+    @property
+    def empty(self):
+        """True if no terms have been added to the query."""
+        return not self.__groups[0][0]
+
+
+    def tree(self):
+        """Return the query as an immutable query tree.
+
+        Returns:
+        QueryGroup: The root of the tree, containing one QueryGroup per parenthetical group.
+        """
+        if self.__tree is None:
+            self.__tree = QueryGroup(tuple(QueryGroup(tuple(items), tuple(ops)) for items, ops in self.__groups if items),
+                                     tuple(self.__group_ops))
+        return self.__tree
+
+
+    def split_sources(self):
+        """Split the query into one query per source given to Forge.match_sources(), for parallel execution.
+
+        Returns:
+        list of str: The query strings. If the query cannot be split, this is the whole query.
+        """
+        return [tree.compile() for tree in self.tree().split_field("mdf.source_name")]
+
+
+    def __add(self, node):
+        """Add a node to the query, using the pending join if there is one."""
+        op, close_group = self.__pending or ("AND", False)
+        if close_group:
+            self.__group_ops.append(op)
+            self.__groups.append(([node], []))
+        else:
+            items, ops = self.__groups[-1]
+            if items:
+                ops.append(op)
+            items.append(node)
+        self.__pending = None
+        self.__tree = None
+
+
+    def __join(self, op, close_group, method):
+        """Set the join for the next term, if the query is ready for one."""
+        # Check that the query has terms
+        if self.empty:
+            print("Error: You must add a term before using ." + method + "(). The current query has not been changed.")
+        # Check to make sure there is a term before the AND or OR
+        elif self.__pending:
+            print("Error: You must add a term between each AND or OR. The current query has not been changed.")
+        else:
+            self.__pending = (op, close_group)
+        return self
+
+
     def term(self, term):
         """Add a term to the query.
 
@@ -581,7 +1361,7 @@ class Query:
         Returns:
         self (Query): For chaining.
         """
-        self.query += term
+        self.__add(QueryTerm(term))
         return self
 
 
@@ -597,7 +1377,7 @@ class Query:
         Returns:
         self (Query): For chaining.
         """
-        self.query += field + ":" + value
+        self.__add(QueryField(field, value))
         # Field matches are advanced queries
         self.advanced = True
         return self
@@ -617,16 +1397,7 @@ class Query:
         Returns:
         self (Query): For chaining.
         """
-        last = self.query.strip(" ()")[-3:]
-        # Check that the query has terms
-        if not last:
-            print("Error: You must add a term before using .and(). The current query has not been changed.")
-        # Check to make sure there is a term before the AND
-        elif last == "AND" or last[1:] == "OR":
-            print("Error: You must add a term between each AND or OR. The current query has not been changed.")
-        else:
-            self.query += ") AND (" if close_group else " AND "
-        return self
+        return self.__join("AND", close_group, "and")
 
 
     def or_join(self, close_group=False):
@@ -637,25 +1408,110 @@ class Query:
         close_group (bool): If True, will end the current group and start a new one.
                       If False, will continue current group.
                       Example: If the current query is "(term1"
-                          .or(close_group=True) => "(term1) OR("
+                          .or(close_group=True) => "(term1) OR ("
                           .or(close_group=False) => "(term1 OR "
 
         Returns:
         self (Query): For chaining.
         """
-        last = self.query.strip(" ()")[-3:]
-        # Check that the query has terms
-        if not last:
-            print("Error: You must add a term before using .or(). The current query has not been changed.")
-        # Check to make sure there is a term before the OR
-        elif last == "AND" or last[1:] == "OR":
-            print("Error: You must add a term between each AND or OR. The current query has not been changed.")
+        return self.__join("OR", close_group, "or")
+
+
+    def match_term(self, term, required=True, new_group=False):
+        """Add a term to the query, joined to the rest with AND or OR.
+        See Forge.match_term() for details.
+
+        Returns:
+        self (Query): For chaining.
+        """
+        # If not the start of the query string, add an AND or OR
+        if not self.empty:
+            if required:
+                self.and_join(new_group)
+            else:
+                self.or_join(new_group)
+        return self.term(term)
+
+
+    def match_field(self, field, value, required=True, new_group=False):
+        """Add a field:value term to the query, joined to the rest with AND or OR.
+        See Forge.match_field() for details.
+
+        Returns:
+        self (Query): For chaining.
+        """
+        # If not the start of the query string, add an AND or OR
+        if not self.empty:
+            if required:
+                self.and_join(new_group)
+            else:
+                self.or_join(new_group)
+        # Add default namespacing if not present
+        if "." not in field:
+            field = "mdf." + field
+        return self.field(field, value)
+
+
+    def match_sources(self, sources):
+        """Add sources to match to the query.
+        See Forge.match_sources() for details.
+
+        Returns:
+        self (Query): For chaining.
+        """
+        if not sources:
+            print("Error: No sources specified.")
+            return self
+        if not isinstance(sources, list):
+            sources = [sources]
+        return self.match_field(field="mdf.source_name", value=",".join(sources), required=True, new_group=True)
+
+
+    def match_elements(self, elements, match_all=True):
+        """Add elemental abbreviations to the query.
+        See Forge.match_elements() for details.
+
+        Returns:
+        self (Query): For chaining.
+        """
+        if not elements:
+            print("Error: No elements specified.")
+            return self
+        if not isinstance(elements, list):
+            elements = [elements]
+
+        if match_all:
+            # First source should be in separate group (and required)
+            self.match_field(field="mdf.elements", value=elements[0], required=True, new_group=True)
+            # Other sources should stay in that group
+            for element in elements[1:]:
+                self.match_field(field="mdf.elements", value=element, required=match_all, new_group=False)
         else:
-            self.query += ") OR (" if close_group else " OR "
+            self.match_field(field="mdf.elements", value=",".join(elements), required=True, new_group=True)
         return self
 
 
-    def search(self, q=None, advanced=None, limit=10, info=False):
+    def resolve(self, q=None):
+        """Prepare a query for execution.
+
+        Arguments:
+        q (str): The query string to prepare. Defaults to the current query.
+
+        Returns:
+        tuple: The query string to execute and its canonical key, or (None, None) if there is no query.
+        """
+        if q is None:
+            if self.empty:
+                return None, None
+            tree = self.tree()
+            return tree.compile(), tree.canonical()
+        if not q.strip("()"):
+            return None, None
+        q = _clean_query_string(q)
+        return q, q
+
+
+    def search(self, q=None, advanced=None, limit=10, info=False, use_cache=True, refresh_cache=False, fields=None):
         """Execute a search and return the results.
 
         Arguments:
@@ -668,14 +1524,16 @@ class Query:
         info (bool): If False, search will return a list of the results.
                      If True, search will return a tuple containing the results list, and other information about the query.
                      Default False.
+        use_cache (bool): If True, will use the Query's cache, if it has one. If False, will bypass the cache. Default True.
+        refresh_cache (bool): If True, will ignore any cached results and replace them with fresh ones. Default False.
+        fields (list of str): The fields to return from each record, as dot-separated paths. Default None, to return whole records.
 
         Returns:
         list (if info=False): The results.
         tuple (if info=True): The results, and a dictionary of query information.
         """
-        if q is None:
-            q = self.query
-        if not q.strip("()"):
+        q, key = self.resolve(q)
+        if not q:
             print("Error: No query specified")
             return ([], {"error": "No query specified"}) if info else []
         if advanced is None or self.advanced:
@@ -685,80 +1543,306 @@ class Query:
         if limit > SEARCH_LIMIT:
             limit = SEARCH_LIMIT
 
-        q = self.__clean_query_string(q)
-
         # Simple query (max 10k results)
         qu = {
             "q": q,
             "advanced": advanced,
             "limit": limit
             }
-        res = toolbox.gmeta_pop(self.__search_client.structured_search(qu), info=info)
+        fields = _field_list(fields)
+        def fetch():
+            records, total, count = self.__search_page(qu, fields)
+            return records, {"total_query_matches": total}
+
+        res = tuple(self.__cached(("search", key, advanced, limit, fields), use_cache, refresh_cache, fetch))
         # Add additional info
         if info:
             res[1]["query"] = qu
+            return res
+        return res[0]
+
+
+    def count(self, q=None, advanced=None, use_cache=True, refresh_cache=False):
+        """Count the results of a search, without fetching any of them.
+
+        Arguments:
+        q (str): The query to count. Defaults to the current query, if any. There must be some query to count.
+        advanced (bool): If True, will submit query in "advanced" mode. See search() for details.
+        use_cache (bool): If True, will use the Query's cache, if it has one. If False, will bypass the cache. Default True.
+        refresh_cache (bool): If True, will ignore any cached results and replace them with fresh ones. Default False.
+
+        Returns:
+        int: The number of matching results, or -1 if there is no query.
+        """
+        q, key = self.resolve(q)
+        if not q:
+            print("Error: No query specified")
+            return -1
+        if advanced is None or self.advanced:
+            advanced = self.advanced
+        qu = {
+            "q": q,
+            "advanced": advanced,
+            "limit": 0
+            }
+        return self.__cached(("count", key, advanced), use_cache, refresh_cache,
+                             lambda: self.__search_client.structured_search(qu).data["total"])
+
+
+    def facets(self, fields, q=None, advanced=None, size=FACET_SIZE, use_cache=True, refresh_cache=False):
+        """Count the results of a search by the values of some fields, without fetching any of them.
+
+        Arguments:
+        fields (str or list of str): The fields to count values of, such as "mdf.source_name" or "mdf.elements".
+        q (str): The query to count. Defaults to the current query, if any. There must be some query to count.
+        advanced (bool): If True, will submit query in "advanced" mode. See search() for details.
+        size (int): The maximum number of values to count for each field, starting with the most common. Default FACET_SIZE.
+        use_cache (bool): If True, will use the Query's cache, if it has one. If False, will bypass the cache. Default True.
+        refresh_cache (bool): If True, will ignore any cached results and replace them with fresh ones. Default False.
+
+        Returns:
+        dict: The counts of each value, indexed by field and then value.
+              For example, {"mdf.source_name": {"oqmd": 100, "cip": 10}}
+        """
+        if not isinstance(fields, list):
+            fields = [fields]
+        q, key = self.resolve(q)
+        if not q:
+            print("Error: No query specified")
+            return {}
+        if advanced is None or self.advanced:
+            advanced = self.advanced
+        qu = {
+            "q": q,
+            "advanced": advanced,
+            "limit": 0,
+            "facets": [{
+                "name": field,
+                "field_name": field,
+                "type": "terms",
+                "size": size
+                } for field in fields]
+            }
+
+        def fetch():
+            res = self.__search_client.structured_search(qu).data
+            counts = {field: {} for field in fields}
+            for facet in res.get("facet_results", []):
+                counts[facet["name"]] = {bucket["value"]: bucket["count"] for bucket in facet.get("buckets", [])}
+            return counts
+
+        return self.__cached(("facets", key, advanced, sorted(fields), size), use_cache, refresh_cache, fetch)
+
+
+    def __search_page(self, qu, fields=None):
+        """Execute a structured search and return its records, total matches, and number of records returned.
+        When the search client supports it, records are parsed as the response streams in,
+        instead of decoding the whole response at once.
+        """
+        if hasattr(self.__search_client, "structured_search_iter"):
+            stream = self.__search_client.structured_search_iter(qu, fields=fields)
+            records = list(stream)
+            return records, stream.info["total"], stream.info.get("count", len(records))
+        res = self.__search_client.structured_search(qu).data
+        return toolbox.gmeta_pop(res, fields=fields), res["total"], res["count"]
+
+
+    def __cached(self, key, use_cache, refresh_cache, fetch):
+        """Return the result of fetch(), through the cache if there is one.
+
+        Arguments:
+        key (tuple): What the result depends on, besides the index.
+        use_cache (bool): If False, will bypass the cache.
+        refresh_cache (bool): If True, will ignore any cached result.
+        fetch (function): Returns the (JSON-serializable) result.
+        """
+        if self.cache is None or not use_cache:
+            return fetch()
+        cache_key = self.cache.make_key(key[0], self.__index_name(), *key[1:])
+        cached = None if refresh_cache else self.cache.get(cache_key)
+        if cached is not None:
+            res = next(cached)
+            cached.close()
+            return res
+        res = fetch()
+        self.cache.put(cache_key, [res])
         return res
 
 
-    def aggregate(self, q=None, scroll_size=SEARCH_LIMIT):
+    def aggregate(self, q=None, scroll_size=SEARCH_LIMIT, workers=1, use_cache=True, refresh_cache=False, fields=None):
         """Gather all record results that match a specific query
 
         Note that all aggregate queries run in advanced mode.
 
         Arguments:
         q (str): The query to execute. Defaults to the current query, if any. There must be some query to execute.
-        advanced (bool): If True, will submit query in "advanced" mode, which enables searches other than basic fulltext.
-                         If False, only basic fulltext term matches will be supported.
-                         Default False.
-                         This value can change to True automatically if the query is built using advanced features, such as match_field.
-        scroll_size (int): Maximum number of records requested per request
+        scroll_size (int): The target number of records requested per request.
+                           Windows are sized to fit it, using what earlier aggregations of the query learned.
+        workers (int): The number of scroll windows to fetch concurrently.
+                       Results are always returned in scroll order, regardless of which window finishes first.
+                       Default 1.
+        use_cache (bool): If True, will use the Query's cache, if it has one. If False, will bypass the cache. Default True.
+        refresh_cache (bool): If True, will ignore any cached results and replace them with fresh ones. Default False.
+        fields (list of str): The fields to return from each record, as dot-separated paths. Default None, to return whole records.
 
         Returns:
         list of dict: All matching records
         """
-        if q is None:
-            q = self.query
-        if not q.strip("()"):
+        q, key = self.resolve_aggregate(q)
+        if not q:
+            return []
+
+        output = []
+        for records in self.__aggregate_pages(q, key, scroll_size, workers, use_cache, refresh_cache,
+                                              _field_list(fields), progress=True):
+            output.extend(records)
+
+        return output
+
+
+    def aggregate_iter(self, q=None, scroll_size=SEARCH_LIMIT, workers=1, pages=False,
+                       use_cache=True, refresh_cache=False, fields=None):
+        """Yield all record results that match a specific query, as each scroll window arrives.
+        Only the windows in flight are held in memory, so this is suitable for very large result sets.
+        If the Query has a cache, the windows are written to it as they arrive, and the entry
+        is saved once the generator is exhausted.
+
+        Note that all aggregate queries run in advanced mode.
+
+        Arguments:
+        q (str): The query to execute. Defaults to the current query, if any. There must be some query to execute.
+        scroll_size (int): The target number of records requested per request
+        workers (int): The number of scroll windows to fetch concurrently. Default 1.
+        pages (bool): If True, will yield the list of records in each scroll window.
+                      If False, will yield records one at a time.
+                      Default False.
+        use_cache (bool): If True, will use the Query's cache, if it has one. If False, will bypass the cache. Default True.
+        refresh_cache (bool): If True, will ignore any cached results and replace them with fresh ones. Default False.
+        fields (list of str): The fields to return from each record, as dot-separated paths. Default None, to return whole records.
+
+        Returns:
+        generator: The matching records (or pages of records), in scroll order.
+        """
+        # Resolve the query now, so that later changes to this Query do not affect the results
+        q, key = self.resolve_aggregate(q)
+        if not q:
+            return iter([])
+        return self.__aggregate_gen(q, key, scroll_size, workers, pages, use_cache, refresh_cache,
+                                    _field_list(fields))
+
+
+    def __index_name(self):
+        """Return the name of the index searched, for keying saved knowledge about queries."""
+        return getattr(self.__search_client, "default_index", None)
+
+
+    def resolve_aggregate(self, q=None):
+        """Prepare a query for aggregation: like resolve(), limited to records.
+        Prints an error if there is no query.
+
+        Returns:
+        tuple: The query string to execute and its canonical key, or (None, None) if there is no query.
+        """
+        q, key = self.resolve(q)
+        if not q:
             print("Error: No query specified")
-            return ([], {"error": "No query specified"}) if info else []
+            return None, None
+
+        return q + " AND mdf.resource_type:record", key + " AND mdf.resource_type:record"
 
-        q = self.__clean_query_string(q)
 
-        q += " AND mdf.resource_type:record"
+    def __aggregate_gen(self, q, key, scroll_size, workers, pages, use_cache, refresh_cache, fields):
+        """Generator backing aggregate_iter()."""
+        for records in self.__aggregate_pages(q, key, scroll_size, workers, use_cache, refresh_cache, fields):
+            if pages:
+                yield records
+            else:
+                yield from records
+
+
+    def __aggregate_pages(self, q, key, scroll_size, workers, use_cache, refresh_cache, fields, progress=False):
+        """Yield the pages of records matching an aggregation query, from the cache when possible."""
+        cache_key = None
+        if self.cache is not None and use_cache:
+            cache_key = self.cache.make_key("aggregate", self.__index_name(), key, fields)
+            cached = None if refresh_cache else self.cache.get(cache_key)
+            if cached is not None:
+                yield from cached
+                return
 
         # Get the total number of records
-        result = self.__search_client.search(q, limit=0, advanced=True)
-        total = result['total']
+        total = self.__search_client.search(q, limit=0, advanced=True)['total']
 
         # Scroll until all results are found
-        output = []
-        scroll_pos = 1
-        with tqdm(total=total) as pbar:
-            while len(output) < total:
-
-                # Scroll until the width is small enough to get all records
-                #   `scroll_id`s are unique to each dataset. If multiple datasets
-                #   match a certain query, the total number of matching records
-                #   may exceed the maximum that search will return - even if the
-                #   scroll width is much smaller than that maximum
-                scroll_width = scroll_size
-                while True:
-                    result_records = self.__search_client.search("(" + q +
-                                                                 ') AND mdf.scroll_id:>=%d AND mdf.scroll_id:<%d' % (
-                                                                     scroll_pos, scroll_pos + scroll_width),
-                                                                 advanced=True, limit=SEARCH_LIMIT)
+        pages = self.__scroll(q, key, total, scroll_size, workers, fields)
+        if cache_key:
+            pages = self.cache.store(cache_key, pages)
+        with tqdm(total=total, disable=not progress) as pbar:
+            for records in pages:
+                pbar.update(len(records))
+                yield records
 
-                    # Check to make sure that all the matching records were returned
-                    if result_records['total'] <= result_records['count']:
-                        break
 
-                    # If not, reduce the scroll width
-                    scroll_width = int(scroll_width * (result_records['count'] / result_records['total']))
+    def __scroll(self, q, key, total, scroll_size, workers, fields=None):
+        """Yield the records matching a query one scroll window at a time, in scroll_id order.
+        Windows are planned ahead of the consumer, and up to `workers` of them are in flight at once.
+        A ScrollPlanner sizes the windows, and remembers what it learns for the next aggregation of the same query.
 
-                # Append the results to the output
-                output.extend(toolbox.gmeta_pop(result_records))
-                pbar.update(result_records['count'])
-                scroll_pos += scroll_width
+        Arguments:
+        q (str): The cleaned query to execute.
+        key (str): The canonical form of the query, for remembering its windows.
+        total (int): The number of records that match the query.
+        scroll_size (int): The target number of records in each scroll window.
+        workers (int): The maximum number of windows to fetch concurrently.
+        fields (list of str): The fields to keep in each record. Default None, to keep whole records.
 
-        return output
+        Yields:
+        list of dict: The records in each window.
+        """
+        planner = _scroll_planner(self.__index_name(), key, scroll_size, self.scroll_plans)
+        found = 0
+        scroll_pos = 1
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            try:
+                while found < total:
+                    # Keep the pool full with the next windows in line
+                    while len(pending) < max(workers, 1):
+                        width, known = planner.plan(scroll_pos)
+                        pending.append(executor.submit(self.__fetch_window, q, scroll_pos, width,
+                                                       planner, known, fields))
+                        scroll_pos += width
+                    # Windows are consumed in submission order to keep the results ordered
+                    records = pending.popleft().result()
+                    found += len(records)
+                    yield records
+            finally:
+                # Windows planned past the last record, or abandoned by the consumer, are not needed
+                for future in pending:
+                    future.cancel()
+                planner.save()
+
+
+    def __fetch_window(self, q, start, width, planner, known, fields=None):
+        """Fetch all records in the scroll window [start, start + width).
+
+        `scroll_id`s are unique to each dataset. If multiple datasets match a certain query,
+        the number of matching records in a window may exceed the maximum that Search will return,
+        even if the window is much smaller than that maximum. In that case the window is
+        fetched in smaller pieces.
+
+        Arguments:
+        q (str): The cleaned query to execute.
+        start (int): The first scroll_id in the window.
+        width (int): The width of the window.
+        planner (ScrollPlanner): The planner to report window sizes to.
+        known (bool): If True, the planner already knows the window fits.
+                      If False, the window is sized with a count-only probe before fetching any records.
+        fields (list of str): The fields to keep in each record. Default None, to keep whole records.
+
+        Returns:
+        list of dict: The records in the window.
+        """
+        return _run_searches(_window_searches(q, start, width, planner, known),
+                             lambda request: self.__search_page(request, fields))
 
@@ -0,0 +1,203 @@
+import json
+import threading
+
+import globus_sdk
+import requests
+from globus_sdk.base import BaseClient, merge_params, slash_join
+
+from mdf_forge.toolbox import GMetaStream
+
+
+class SearchClient(BaseClient):
+    """Access (search and ingest) Globus Search."""
+
+    def __init__(self, base_url="https://search.api.globus.org/", default_index=None, **kwargs):
+        app_name = kwargs.pop('app_name', 'Search Client v0.2')
+        BaseClient.__init__(self, "search", app_name=app_name, **kwargs)
+        # base URL lookup will fail, producing None, set it by hand
+        self.base_url = base_url
+        self._headers['Content-Type'] = 'application/json'
+        self.default_index = default_index
+        self._pool_lock = threading.Lock()
+
+    def set_pool_size(self, size):
+        """Keep at least `size` connections to Search open for reuse, for concurrent requests through this client.
+        The pool only grows: the client may be shared, so a pool that is already large enough is left in use.
+
+        Arguments:
+        size (int): The number of pooled connections.
+        """
+        with self._pool_lock:
+            old_adapter = self._session.get_adapter(self.base_url)
+            if getattr(old_adapter, "_pool_maxsize", 0) >= size:
+                return
+            adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+            self._session.mount("https://", adapter)
+            self._session.mount("http://", adapter)
+            # Requests already sent on the old pool finish, but its idle connections are not kept
+            old_adapter.close()
+
+    def _base_index_uri(self, index):
+        index = index or self.default_index
+        if not index:
+            raise ValueError(
+                ('You must either pass an explicit index '
+                 'or set a default one at the time that you create '
+                 'a SearchClient'))
+        return '/v1/index/{}'.format(index)
+
+    def search(self, q, limit=None, offset=None, query_template=None,
+               index=None, advanced=None, **params):
+        """
+        Perform a simple ``GET`` based search.
+
+        Does not support all of the behaviors and parameters of advanced
+        searches.
+
+        **Parameters**
+
+          ``q`` (*string*)
+            The user-query string. Required for simple searches (and most
+            advanced searches).
+
+          ``index`` (*string*)
+            Optional unless ``default_index`` was not set.
+            The index to query.
+
+          ``limit`` (*int*)
+            Optional. The number of results to return.
+
+          ``offset`` (*int*)
+            Optional. An offset into the total result set for paging.
+
+          ``query_template`` (*string*)
+            Optional. A query_template name as defined within the Search
+            service.
+
+          ``advanced`` (*bool*)
+            Use simple query parsing vs. advanced query syntax when
+            interpreting ``q``. Defaults to False.
+
+          ``params``
+            Any additional query params to pass. For internal use only.
+        """
+        uri = slash_join(self._base_index_uri(index), 'search')
+        merge_params(params, q=q, limit=limit, offset=offset,
+                     query_template=query_template, advanced=advanced)
+        return self.get(uri, params=params)
+
+    def structured_search(self, data, index=None, **params):
+        """
+        Perform a structured, ``POST``-based, search.
+
+        **Parameters**
+
+          ``data`` (*dict*)
+            A valid GSearchRequest document to execute.
+
+          ``index`` (*string*)
+            Optional unless ``default_index`` was not set.
+            The index to query.
+
+          ``advanced`` (*bool*)
+            Use simple query parsing vs. advanced query syntax when
+            interpreting the query string. Defaults to False.
+
+          ``params``
+            Any additional query params to pass. For internal use only.
+        """
+        uri = slash_join(self._base_index_uri(index), 'search')
+        return self.post(uri, json_body=data, params=params)
+
+    def structured_search_iter(self, data, index=None, fields=None, **params):
+        """
+        Perform a structured, ``POST``-based search, and parse the results
+        as the response is read.
+
+        **Parameters**
+
+          ``data`` (*dict*)
+            A valid GSearchRequest document to execute.
+
+          ``index`` (*string*)
+            Optional unless ``default_index`` was not set.
+            The index to query.
+
+          ``fields`` (*list of string*)
+            Optional. The fields to keep in each record. See ``gmeta_pop``.
+
+          ``params``
+            Any additional query params to pass. For internal use only.
+
+        **Returns**
+
+          A ``GMetaStream`` of the records. Its ``info`` holds the ``total``
+          and ``count`` of the result once the records are consumed.
+        """
+        uri = slash_join(self._base_index_uri(index), 'search')
+        url = slash_join(self.base_url, uri)
+        body = json.dumps(data)
+        for attempt in range(2):
+            headers = dict(self._headers)
+            if self.authorizer is not None:
+                self.authorizer.set_authorization_header(headers)
+            try:
+                r = self._session.post(url, data=body, headers=headers, params=params, stream=True,
+                                       verify=self._verify, timeout=self._http_timeout)
+            except requests.RequestException as e:
+                raise globus_sdk.exc.convert_request_exception(e)
+            if (r.status_code != 401 or attempt or self.authorizer is None
+                    or not self.authorizer.handle_missing_authorization()):
+                break
+            r.close()
+        if not 200 <= r.status_code < 400:
+            raise self.error_class(r)
+        return GMetaStream(r, fields=fields)
+
+    def ingest(self, data, index=None, **params):
+        """
+        Perform a simple ``POST`` based ingest op.
+
+        **Parameters**
+
+          ``data`` (*dict*, ``GIngestStream``, or *file*)
+            A valid GIngest document to index. A ``GIngestStream`` is sent
+            as a chunked request body as it is serialized, and a file (opened
+            for reading bytes) is sent as it is read, so neither has to fit
+            in memory.
+
+          ``index`` (*string*)
+            Optional unless ``default_index`` was not set.
+            The search index to send data into.
+
+          ``params``
+            Any additional query params to pass. For internal use only.
+        """
+        uri = slash_join(self._base_index_uri(index), 'ingest')
+        if isinstance(data, dict):
+            return self.post(uri, json_body=data, params=params)
+        url = slash_join(self.base_url, uri)
+        # A stream can only be sent once, so it is not retried with fresh authorization
+        retry = hasattr(data, "seek")
+        start = data.tell() if retry else None
+        for attempt in range(2):
+            headers = dict(self._headers)
+            if self.authorizer is not None:
+                self.authorizer.set_authorization_header(headers)
+            try:
+                r = self._session.post(url, data=data if retry else iter(data), headers=headers, params=params,
+                                       verify=self._verify, timeout=self._http_timeout)
+            except requests.RequestException as e:
+                raise globus_sdk.exc.convert_request_exception(e)
+            if (r.status_code != 401 or attempt or not retry or self.authorizer is None
+                    or not self.authorizer.handle_missing_authorization()):
+                break
+            data.seek(start)
+        if not 200 <= r.status_code < 400:
+            raise self.error_class(r)
+        return self.default_response_class(r, client=self)
+
+    def remove(self, subject, index=None, **params):
+        uri = slash_join(self._base_index_uri(index), "subject")
+        params["subject"] = subject
+        return self.delete(uri, params=params)
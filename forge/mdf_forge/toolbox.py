@@ -1,14 +1,37 @@
-import gzip
+from bisect import bisect_left, bisect_right
+import codecs
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import hashlib
 import json
+import math
+import mmap
 import os
 import re
-import tarfile
-import zipfile
+import sys
+import threading
+import time
+from urllib.parse import urlparse
 
-import globus_sdk
-from globus_sdk.base import BaseClient, merge_params, slash_join
-from globus_sdk.response import GlobusHTTPResponse
-from tqdm import tqdm
+from mdf_forge._lazy import LazyModule, lazy_function
+
+# fcntl is only available on Unix; elsewhere, files are not locked
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# These are imported when first used, so that importing the toolbox stays fast
+bz2 = LazyModule("bz2")
+gzip = LazyModule("gzip")
+lzma = LazyModule("lzma")
+sqlite3 = LazyModule("sqlite3")
+tarfile = LazyModule("tarfile")
+zipfile = LazyModule("zipfile")
+globus_sdk = LazyModule("globus_sdk")
+requests = LazyModule("requests")
+tqdm = lazy_function("tqdm", "tqdm")
 
 
 
@@ -16,6 +39,23 @@ from tqdm import tqdm
 ##  Authentication utilities
 ###################################################
 
+NATIVE_CLIENT_ID = "98bfc684-977f-4670-8669-71f8337688e4"
+CRED_PATH = os.path.expanduser("~/mdf/credentials")
+SCOPES = {
+    "transfer": "urn:globus:auth:scope:transfer.api.globus.org:all",
+    "search": "urn:globus:auth:scope:search.api.globus.org:search",
+    "search_ingest": "urn:globus:auth:scope:search.api.globus.org:all",
+    "mdf": "urn:globus:auth:scope:data.materialsdatafacility.org:all" # urn:globus:auth:scope:api.materialsdatafacility.org:all"
+    }
+# The resource server that issues the tokens for each service
+RESOURCE_SERVERS = {
+    "transfer": "transfer.api.globus.org",
+    "search": "search.api.globus.org",
+    "search_ingest": "search.api.globus.org",
+    "mdf": "data.materialsdatafacility.org"
+    }
+
+
 def login(credentials=None, clear_old_tokens=False, **kwargs):
     """Login to Globus services
 
@@ -34,41 +74,8 @@ def login(credentials=None, clear_old_tokens=False, **kwargs):
     dict: The clients and authorizers requested, indexed by service name.
           For example, if login() is told to auth with 'search' then the search client will be in the 'search' field.
     """
-    NATIVE_CLIENT_ID = "98bfc684-977f-4670-8669-71f8337688e4"
     DEFAULT_CRED_FILENAME = "globus_login.json"
-    DEFAULT_CRED_PATH = os.path.expanduser("~/mdf/credentials")
-    SCOPES = {
-        "transfer": "urn:globus:auth:scope:transfer.api.globus.org:all",
-        "search": "urn:globus:auth:scope:search.api.globus.org:search",
-        "search_ingest": "urn:globus:auth:scope:search.api.globus.org:all",
-        "mdf": "urn:globus:auth:scope:data.materialsdatafacility.org:all" # urn:globus:auth:scope:api.materialsdatafacility.org:all"
-        }
-
-    def _get_tokens(client, scopes, app_name, force_refresh=False):
-        token_path = os.path.join(DEFAULT_CRED_PATH, app_name + "_tokens.json")
-        if force_refresh:
-            if os.path.exists(token_path):
-                os.remove(token_path)
-        if os.path.exists(token_path):
-            with open(token_path, "r") as tf:
-                tokens = json.load(tf)
-        else:
-            os.makedirs(DEFAULT_CRED_PATH, exist_ok=True)
-            client.oauth2_start_flow(requested_scopes=scopes, refresh_tokens=True)
-            authorize_url = client.oauth2_get_authorize_url()
-
-            print("It looks like this is the first time you're accessing this client.\nPlease log in to Globus at this link:\n", authorize_url)
-            auth_code = input("Copy and paste the authorization code here: ").strip()
-            print("Thanks!")
-
-            token_response = client.oauth2_exchange_code_for_tokens(auth_code)
-            tokens = token_response.by_resource_server
-
-            os.umask(0o077)
-            with open(token_path, "w") as tf:
-                json.dump(tokens, tf)
-
-        return tokens
+    DEFAULT_CRED_PATH = CRED_PATH
 
     if type(credentials) is str:
         try:
@@ -92,6 +99,7 @@ def login(credentials=None, clear_old_tokens=False, **kwargs):
             except IOError:
                 raise ValueError("Credentials/configuration must be passed as a filename string, JSON string, or dictionary, or provided in '" + DEFAULT_CRED_FILENAME + "' or '" + DEFAULT_CRED_PATH + "'.")
 
+    from mdf_forge.search_client import SearchClient
     native_client = globus_sdk.NativeAppAuthClient(NATIVE_CLIENT_ID, app_name=creds["app_name"])
 
     servs = []
@@ -104,24 +112,64 @@ def login(credentials=None, clear_old_tokens=False, **kwargs):
     scopes = " ".join([SCOPES[sc] for sc in servs])
 
     all_tokens = _get_tokens(native_client, scopes, creds["app_name"], force_refresh=clear_old_tokens)
+    if clear_old_tokens:
+        # The shared clients hold the old tokens in memory
+        CLIENTS.clear()
 
     clients = {}
     if "transfer" in servs:
-        transfer_authorizer = globus_sdk.RefreshTokenAuthorizer(all_tokens["transfer.api.globus.org"]["refresh_token"], native_client)
+        transfer_authorizer = _refresh_token_authorizer(all_tokens["transfer.api.globus.org"], native_client)
         clients["transfer"] = globus_sdk.TransferClient(authorizer=transfer_authorizer)
     if "search_ingest" in servs:
-        ingest_authorizer = globus_sdk.RefreshTokenAuthorizer(all_tokens["search.api.globus.org"]["refresh_token"], native_client)
+        ingest_authorizer = _refresh_token_authorizer(all_tokens["search.api.globus.org"], native_client)
         clients["search_ingest"] = SearchClient(default_index=(creds.get("index", None) or kwargs.get("index", None)), authorizer=ingest_authorizer)
     elif "search" in servs:
-        search_authorizer = globus_sdk.RefreshTokenAuthorizer(all_tokens["search.api.globus.org"]["refresh_token"], native_client)
+        search_authorizer = _refresh_token_authorizer(all_tokens["search.api.globus.org"], native_client)
         clients["search"] = SearchClient(default_index=(creds.get("index", None) or kwargs.get("index", None)), authorizer=search_authorizer)
     if "mdf" in servs:
-        mdf_authorizer = globus_sdk.RefreshTokenAuthorizer(all_tokens["data.materialsdatafacility.org"]["refresh_token"], native_client)
+        mdf_authorizer = _refresh_token_authorizer(all_tokens["data.materialsdatafacility.org"], native_client)
         clients["mdf"] = mdf_authorizer
 
     return clients
 
 
+def _get_tokens(client, scopes, app_name, force_refresh=False):
+    """Load the tokens of an app from its token file, logging in to Globus to create the file if needed."""
+    token_path = os.path.join(CRED_PATH, app_name + "_tokens.json")
+    if force_refresh:
+        if os.path.exists(token_path):
+            os.remove(token_path)
+    if os.path.exists(token_path):
+        with open(token_path, "r") as tf:
+            tokens = json.load(tf)
+    else:
+        os.makedirs(CRED_PATH, exist_ok=True)
+        client.oauth2_start_flow(requested_scopes=scopes, refresh_tokens=True)
+        authorize_url = client.oauth2_get_authorize_url()
+
+        print("It looks like this is the first time you're accessing this client.\nPlease log in to Globus at this link:\n", authorize_url)
+        auth_code = input("Copy and paste the authorization code here: ").strip()
+        print("Thanks!")
+
+        token_response = client.oauth2_exchange_code_for_tokens(auth_code)
+        tokens = token_response.by_resource_server
+
+        os.umask(0o077)
+        with open(token_path, "w") as tf:
+            json.dump(tokens, tf)
+
+    return tokens
+
+
+def _refresh_token_authorizer(tokens, auth_client, on_refresh=None):
+    """Create an authorizer from the tokens for one resource server.
+    The saved access token is used until it expires, so no request to Globus Auth is needed yet.
+    """
+    return globus_sdk.RefreshTokenAuthorizer(tokens["refresh_token"], auth_client,
+                                             access_token=tokens.get("access_token"),
+                                             expires_at=tokens.get("expires_at_seconds"), on_refresh=on_refresh)
+
+
 def confidential_login(credentials=None):
     """Login to Globus services as a confidential client (a client with its own login information).
 
@@ -169,6 +217,7 @@ def confidential_login(credentials=None):
             except IOError:
                 raise ValueError("Credentials/configuration must be passed as a filename string, JSON string, or dictionary, or provided in '" + DEFAULT_CRED_FILENAME + "' or '" + DEFAULT_CRED_PATH + "'.")
 
+    from mdf_forge.search_client import SearchClient
     conf_client = globus_sdk.ConfidentialAppAuthClient(creds["client_id"], creds["client_secret"])
     servs = []
     for serv in creds["services"]:
@@ -194,13 +243,147 @@ def confidential_login(credentials=None):
     return clients
 
 
+class ClientRegistry:
+    """Globus clients and authorizers shared by the whole process (every Forge and AsyncForge), each built when first needed.
+    The token file of an app is read once, and its access tokens are reused, and refreshed, in memory,
+    so new clients do not contact Globus Auth until the tokens expire.
+    After a fork, the clients in the child process open their own connections, so they do not share the parent's.
+    """
+
+    def __init__(self):
+        self.__lock = threading.RLock()
+        # app_name -> tokens by resource server
+        self.__tokens = {}
+        # app_name -> NativeAppAuthClient
+        self.__auth_clients = {}
+        # (app_name, resource server) -> RefreshTokenAuthorizer
+        self.__authorizers = {}
+        # (app_name, service, index) -> client or authorizer
+        self.__clients = {}
+
+
+    def get(self, service, app_name, services, index=None):
+        """Return the client for a service, creating it if needed.
+
+        Arguments:
+        service (str): The service: transfer, search, search_ingest, or mdf.
+        app_name (str): The name of the app, which names its token file.
+        services (list of str): Every service the app uses. If the app has not logged in before,
+                                the user is asked to log in for all of them at once.
+        index (str): The default Search index, for search and search_ingest. Default None.
+
+        Returns:
+        TransferClient, SearchClient, or RefreshTokenAuthorizer (for mdf): The client.
+        """
+        service = service.lower()
+        if service not in services:
+            raise ValueError("Service '" + service + "' is not one of the services of '" + app_name + "'")
+        key = (app_name, service, index if service in ("search", "search_ingest") else None)
+        with self.__lock:
+            if key not in self.__clients:
+                authorizer = self.__authorizer(app_name, services, RESOURCE_SERVERS[service])
+                if service == "transfer":
+                    client = globus_sdk.TransferClient(authorizer=authorizer)
+                elif service in ("search", "search_ingest"):
+                    from mdf_forge.search_client import SearchClient
+                    client = SearchClient(default_index=index, authorizer=authorizer)
+                else:
+                    client = authorizer
+                self.__clients[key] = client
+            return self.__clients[key]
+
+
+    def clear(self):
+        """Forget every client and token, so that they are loaded again when next needed (for example, after logging in again)."""
+        with self.__lock:
+            self.__tokens.clear()
+            self.__auth_clients.clear()
+            self.__authorizers.clear()
+            self.__clients.clear()
+
+
+    def after_fork(self):
+        """Prepare the registry for use in a child process.
+        The clients are kept, since objects created before the fork (such as a Forge) still use them,
+        but each gets a new session, so its connections are not shared with the parent.
+        This is called automatically in children of os.fork(), where supported.
+        """
+        # The lock may have been held by another thread of the parent
+        self.__lock = threading.RLock()
+        for client in list(self.__clients.values()) + list(self.__auth_clients.values()):
+            if hasattr(client, "_session"):
+                client._session = requests.Session()
+
+
+    def __authorizer(self, app_name, services, resource_server):
+        """Return the authorizer for a resource server, creating it from the app's tokens if needed."""
+        key = (app_name, resource_server)
+        if key not in self.__authorizers:
+            if app_name not in self.__tokens:
+                scopes = " ".join([SCOPES[service.lower()] for service in services])
+                self.__tokens[app_name] = _get_tokens(self.__auth_client(app_name), scopes, app_name)
+            tokens = self.__tokens[app_name]
+
+            def save(token_response):
+                # Keep refreshed tokens for authorizers created later, including in child processes
+                with self.__lock:
+                    tokens.update(token_response.by_resource_server)
+
+            self.__authorizers[key] = _refresh_token_authorizer(tokens[resource_server], self.__auth_client(app_name),
+                                                                on_refresh=save)
+        return self.__authorizers[key]
+
+
+    def __auth_client(self, app_name):
+        """Return the Globus Auth client of an app."""
+        if app_name not in self.__auth_clients:
+            self.__auth_clients[app_name] = globus_sdk.NativeAppAuthClient(NATIVE_CLIENT_ID, app_name=app_name)
+        return self.__auth_clients[app_name]
+
+
+# The registry every Forge shares
+CLIENTS = ClientRegistry()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=CLIENTS.after_fork)
+
+
 
 ###################################################
 ##  File utilities
 ###################################################
 
-def find_files(root, file_pattern=None, verbose=False):
+class FoundFile(namedtuple("FoundFile", ["path", "filename", "no_root_path"])):
+    """A file found by find_files().
+    The fields can also be read by name, like a dictionary (for example, found_file["filename"]).
+
+    Fields:
+    path (str): The path to the directory containing the file.
+    filename (str): The name of the file.
+    no_root_path (str): The path to the directory containing the file, with the path to the root directory removed.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self._fields else default
+
+
+    def keys(self):
+        return self._fields
+
+
+def find_files(root, file_pattern=None, verbose=False, workers=1, manifest=None):
     """Find files recursively in a given directory.
+    Each directory is listed once with os.scandir(). With more than one worker, subdirectories are listed
+    in parallel ahead of the results, which helps on network filesystems where each listing is slow;
+    the results are in the same order either way.
 
     Arguments:
     root (str): The path to the starting (root) directory.
@@ -208,9 +391,13 @@ def find_files(root, file_pattern=None, verbose=False):
     verbose: If True, will print status messages.
              If False, will remain silent unless there is an error.
              Default False.
+    workers (int): The number of directories to list at once. Default 1.
+    manifest (str): A JSON file to save the directory listings in, or None to not save them. Default None.
+                    On the next scan, directories that have not changed since (by modification time)
+                    are not listed again, so scanning an unchanged tree only takes one stat() per directory.
 
     Yields:
-    dict: The matching file's path information.
+    FoundFile: The matching file's path information.
         Contains:
         path (str): The path to the directory containing the file.
         no_root_path (str): The path to the directory containing the file, with the path to the root directory removed.
@@ -218,47 +405,436 @@ def find_files(root, file_pattern=None, verbose=False):
     """
     # Add separator to end of root if not already supplied
     root += os.sep if root[-1:] != os.sep else ""
-    for path, dirs, files in tqdm(os.walk(root), desc="Finding files", disable= not verbose):
-        for one_file in files:
-            if not file_pattern or re.search(file_pattern, one_file):  # Only care about dirs with desired data
-                yield {
-                    "path": path,
-                    "filename": one_file,
-                    "no_root_path": path.replace(root, "")
-                    }
+    pattern = re.compile(file_pattern) if file_pattern else None
+    listings = _ScanListings(manifest, root) if manifest else None
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def list_dir(no_root_path):
+        path = root + no_root_path
+        if executor is None:
+            return path, no_root_path, _list_directory(path, no_root_path, listings)
+        return path, no_root_path, executor.submit(_list_directory, path, no_root_path, listings)
+
+    # Depth-first, in the same order as os.walk(); with workers, each subdirectory's listing is started when it is found
+    stack = [list_dir("")]
+    complete = False
+    try:
+        with tqdm(desc="Finding files", disable= not verbose) as progress:
+            while stack:
+                path, no_root_path, listing = stack.pop()
+                files, dirs = listing if executor is None else listing.result()
+                progress.update()
+                for one_file in files:
+                    if not pattern or pattern.search(one_file):  # Only care about dirs with desired data
+                        yield FoundFile(path, one_file, no_root_path)
+                stack.extend(list_dir(os.path.join(no_root_path, name)) for name in reversed(dirs))
+        complete = True
+    finally:
+        if executor is not None:
+            for path, no_root_path, listing in stack:
+                listing.cancel()
+            executor.shutdown(wait=True)
+        # Only a complete scan is saved, since directories that were not reached are dropped from the manifest
+        if listings is not None and complete:
+            listings.save()
+
+
+def _list_directory(path, no_root_path, listings=None):
+    """List the files and subdirectories of a directory, as os.walk() would (without following links to directories).
 
-
-def uncompress_tree(root, verbose=False):
-    """Uncompress all tar, zip, and gzip archives under a given directory.
-    Note that this process tends to be very slow.
+    Returns:
+    tuple: The list of file names and the list of subdirectory names.
+    """
+    if listings is not None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return [], []
+        listing = listings.get(no_root_path, stat)
+        if listing is not None:
+            return listing
+    files = []
+    dirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry.name)
+                elif not entry.is_symlink():
+                    dirs.append(entry.name)
+    # Unreadable directories are skipped, like os.walk() does
+    except OSError:
+        return [], []
+    if listings is not None:
+        listings.put(no_root_path, stat, files, dirs)
+    return files, dirs
+
+
+class _ScanListings:
+    """The directory listings saved by find_files(manifest=...)."""
+
+    # Listings of directories modified this recently are not saved,
+    # because another change within the filesystem's timestamp resolution would go unnoticed
+    RACY_SECONDS = 2
+
+    def __init__(self, path, root):
+        self.path = path
+        self.__root = os.path.abspath(root)
+        self.__lock = threading.Lock()
+        self.__dirs = {}
+        # Listings of the directories reached in this scan
+        self.__seen = {}
+        self.__changed = False
+        try:
+            with open(path) as manifest_file:
+                saved = json.load(manifest_file)
+            if saved.get("root") == self.__root:
+                self.__dirs = saved["dirs"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+
+    def get(self, no_root_path, stat):
+        with self.__lock:
+            entry = self.__dirs.get(no_root_path)
+            if not entry or entry[0] != stat.st_mtime_ns:
+                return None
+            self.__seen[no_root_path] = entry
+        return entry[1], entry[2]
+
+
+    def put(self, no_root_path, stat, files, dirs):
+        with self.__lock:
+            if time.time() - stat.st_mtime > self.RACY_SECONDS:
+                self.__seen[no_root_path] = [stat.st_mtime_ns, files, dirs]
+            self.__changed = True
+
+
+    def save(self):
+        """Save the listings. Failure to save is not an error; the next scan will list every directory."""
+        with self.__lock:
+            if not self.__changed and len(self.__seen) == len(self.__dirs):
+                return
+            saved = {"root": self.__root, "dirs": dict(self.__seen)}
+        try:
+            tmp_path = self.path + ".tmp" + str(os.getpid())
+            with open(tmp_path, "w") as manifest_file:
+                json.dump(saved, manifest_file)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+
+def uncompress_tree(root, verbose=False, workers=None, manifest=None):
+    """Uncompress all tar, zip, gzip, bzip2, and xz files under a given directory.
+    Each file's type is found from its first bytes. Archives (including compressed tar files) are extracted
+    into the directory they are in, and other compressed files are decompressed next to themselves,
+    without the last extension. Files are processed in parallel by a pool of processes, and decompressed
+    in chunks, so large files do not need to fit in memory.
+    Files whose outputs all exist already are skipped. Compressed files that would be decompressed
+    to the same path (such as "data.bz2" and "data.xz") are reported as errors, and left alone.
 
     Arguments:
     root (str): The path to the starting (root) directory.
     verbose: If True, will print status messages.
              If False, will remain silent unless there is an error.
              Default False.
+    workers (int): The number of processes to use, or None to use one per CPU. Default None.
+    manifest (str): A JSON file to record the files processed in, or None to not record them. Default None.
+                    On the next run, files that have not changed since (by size and modification time),
+                    and whose outputs still exist, are skipped without being opened.
     """
-    for path, dirs, files in tqdm(os.walk(root), desc="Uncompressing files", disable= not verbose):
-        for single_file in files:
-            abs_path = os.path.join(path, single_file)
-            if tarfile.is_tarfile(abs_path):
-                tar = tarfile.open(abs_path)
-                tar.extractall(path)
-                tar.close()
-            elif zipfile.is_zipfile(abs_path):
-                z = zipfile.ZipFile(abs_path)
-                z.extractall(path)
-                z.close()
+    # Imported here, since it loads multiprocessing, which most uses of the toolbox do not need
+    from concurrent.futures import ProcessPoolExecutor
+
+    root += os.sep if root[-1:] != os.sep else ""
+    extractions = _ExtractionManifest(manifest, root) if manifest else None
+    paths = []
+    for found_file in find_files(root):
+        abs_path = os.path.join(found_file.path, found_file.filename)
+        if extractions is None or not (extractions.unchanged(abs_path) or extractions.is_manifest(abs_path)):
+            paths.append(abs_path)
+
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 and len(paths) > 1 else None
+
+    def pool_map(function, *iterables):
+        if executor is None:
+            return map(function, *iterables)
+        count = len(iterables[0])
+        return executor.map(function, *iterables, chunksize=max(1, min(64, count // (workers * 4))))
+
+    def report(abs_path, outputs, error):
+        if error:
+            print("Error: Unable to uncompress '", abs_path, "': ", error, sep="")
+        elif extractions is not None:
+            extractions.record(abs_path, outputs)
+
+    try:
+        # First find what each file is, then uncompress the ones that are compressed
+        jobs = []
+        for abs_path, kind, error in tqdm(pool_map(_sniff_job, paths), desc="Checking files", total=len(paths),
+                                          disable= not verbose):
+            if error or kind is None:
+                report(abs_path, [], error)
             else:
+                jobs.append((abs_path, kind))
+        # Files decompressed to the same path would overwrite each other
+        claims = {}
+        for abs_path, kind in jobs:
+            if kind not in ("tar", "zip"):
+                claims.setdefault(_uncompressed_path(abs_path), []).append(abs_path)
+        colliding = set()
+        for out_path, claimants in claims.items():
+            if len(claimants) > 1:
+                colliding.update(claimants)
+                for abs_path in claimants:
+                    report(abs_path, [], "'" + out_path + "' would also be written by '"
+                           + "', '".join(other for other in claimants if other != abs_path) + "'")
+        jobs = [(abs_path, kind) for abs_path, kind in jobs if abs_path not in colliding]
+
+        results = pool_map(_uncompress_file, [abs_path for abs_path, kind in jobs], [kind for abs_path, kind in jobs])
+        for result in tqdm(results, desc="Uncompressing files", total=len(jobs), disable= not verbose):
+            report(*result)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+        if extractions is not None:
+            extractions.save()
+
+
+# The first bytes of each compression format
+_COMPRESSION_MAGIC = {
+    "gzip": b"\x1f\x8b",
+    "bz2": b"BZh",
+    "xz": b"\xfd7zXZ\x00"
+    }
+
+
+def _sniff_file(path):
+    """Find the type of a file from its first bytes.
+
+    Returns:
+    str: "tar", "zip", "gzip", "bz2", or "xz" (for compressed files that are not tar files), or None.
+    """
+    with open(path, "rb") as in_file:
+        header = in_file.read(tarfile.BLOCKSIZE)
+    if header[:4] in (b"PK\x03\x04", b"PK\x05\x06"):
+        return "zip"
+    for kind, magic in _COMPRESSION_MAGIC.items():
+        if header.startswith(magic):
+            # Look at the start of the uncompressed data for a tar header
+            with _open_compressed(kind, path) as in_file:
+                header = in_file.read(tarfile.BLOCKSIZE)
+            return "tar" if _is_tar_header(header) else kind
+    return "tar" if _is_tar_header(header) else None
+
+
+def _sniff_job(abs_path):
+    """Find the type of a file for uncompress_tree().
+
+    Returns:
+    tuple: The path to the file, its type (see _sniff_file()), and the error message, if any.
+    """
+    try:
+        return abs_path, _sniff_file(abs_path), None
+    except Exception as e:
+        return abs_path, None, repr(e)
+
+
+def _uncompressed_path(abs_path):
+    """Return the path a compressed file (that is not an archive) is decompressed to:
+    the file without its extension (should be .gz or similar)."""
+    stem, ext = os.path.splitext(abs_path)
+    return stem if ext else abs_path + ".out"
+
+
+def _is_tar_header(block):
+    """Return True if a block of bytes is a valid tar header."""
+    try:
+        tarfile.TarInfo.frombuf(block, "utf-8", "surrogateescape")
+    except tarfile.HeaderError:
+        return False
+    return True
+
+
+def _open_compressed(kind, path):
+    """Open a gzip, bz2, or xz file for reading its uncompressed data."""
+    if kind == "gzip":
+        return gzip.open(path, "rb")
+    elif kind == "bz2":
+        return bz2.open(path, "rb")
+    return lzma.open(path, "rb")
+
+
+def _uncompress_file(abs_path, kind):
+    """Uncompress one file for uncompress_tree(), unless all its outputs exist.
+
+    Arguments:
+    abs_path (str): The path to the file.
+    kind (str): The type of the file, from _sniff_file().
+
+    Returns:
+    tuple: The path to the file, the paths to its outputs relative to its directory,
+           and the error message, if any.
+    """
+    directory = os.path.dirname(abs_path)
+    try:
+        if kind == "tar":
+            with tarfile.open(abs_path) as archive:
+                outputs = [os.path.normpath(member.name) for member in archive.getmembers()]
+                if not _all_exist(directory, outputs):
+                    archive.extractall(directory)
+        elif kind == "zip":
+            with zipfile.ZipFile(abs_path) as archive:
+                outputs = [os.path.normpath(name) for name in archive.namelist()]
+                if not _all_exist(directory, outputs):
+                    archive.extractall(directory)
+        else:
+            out_path = _uncompressed_path(abs_path)
+            outputs = [os.path.basename(out_path)]
+            if not os.path.exists(out_path):
+                # Decompress to a temporary file first, so that an interrupted run leaves no partial output
+                tmp_path = out_path + ".part" + str(os.getpid())
                 try:
-                    with gzip.open(abs_path) as gz:
-                        file_data = gz.read()
-                        # Opens the absolute path, including filename, for writing, but does not include the extension (should be .gz or similar)
-                        with open(abs_path.rsplit('.', 1)[0], 'w') as newfile:
-                            newfile.write(str(file_data))
-                # An IOErrorwill occur at gz.read() if the file is not a gzip
-                except IOError:
-                    pass
+                    with _open_compressed(kind, abs_path) as in_file, open(tmp_path, "wb") as out_file:
+                        for chunk in iter(lambda: in_file.read(HTTPPool.CHUNK_SIZE), b""):
+                            out_file.write(chunk)
+                    os.replace(tmp_path, out_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+    except Exception as e:
+        return abs_path, [], repr(e)
+    return abs_path, outputs, None
+
+
+def _all_exist(directory, outputs):
+    """Return True if every output path (relative to the directory) exists."""
+    return all(os.path.lexists(os.path.join(directory, output)) for output in outputs)
+
+
+class _ExtractionManifest:
+    """The files processed by uncompress_tree(manifest=...)."""
+
+    def __init__(self, path, root):
+        self.path = path
+        self.__root = os.path.abspath(root)
+        try:
+            with open(path) as manifest_file:
+                self.__files = json.load(manifest_file)
+        except (OSError, ValueError):
+            self.__files = {}
+        if not isinstance(self.__files, dict):
+            self.__files = {}
+
+
+    def is_manifest(self, abs_path):
+        """Return True if a path is the manifest itself (or one of its temporary files)."""
+        return os.path.abspath(abs_path).startswith(os.path.abspath(self.path))
+
+
+    def unchanged(self, abs_path):
+        """Return True if a file was processed before, has not changed since, and its outputs all exist."""
+        entry = self.__files.get(self.__key(abs_path))
+        if not entry:
+            return False
+        try:
+            stat = os.stat(abs_path)
+        except OSError:
+            return False
+        return (stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]
+                and _all_exist(os.path.dirname(abs_path), entry["outputs"]))
+
+
+    def record(self, abs_path, outputs):
+        try:
+            stat = os.stat(abs_path)
+        except OSError:
+            return
+        self.__files[self.__key(abs_path)] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "outputs": outputs
+            }
+
+
+    def save(self):
+        """Save the manifest. Failure to save is not an error; the next run will check every file again."""
+        try:
+            tmp_path = self.path + ".tmp" + str(os.getpid())
+            with open(tmp_path, "w") as manifest_file:
+                json.dump(self.__files, manifest_file)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+
+    def __key(self, abs_path):
+        """Return the manifest key of a file."""
+        return os.path.relpath(os.path.abspath(abs_path), self.__root)
+
+
+
+class DestinationIndex:
+    """Choose unique destination paths for many files, without checking the filesystem for each one.
+    Each destination directory is listed once, the first time it is used; after that, names are checked
+    against the listing and the paths already chosen. Colliding names get a number before the extension
+    (for example, "myfile(1).ext"), counted per name, so each collision is resolved in constant time.
+    """
+
+    def __init__(self, existing=True):
+        """Initialize the DestinationIndex.
+
+        Arguments:
+        existing (bool): If True, files already in a directory count as collisions.
+                         If False, only paths claimed from this index do, so that files already there
+                         are claimed again under the same names (to be replaced or synchronized).
+                         Default True.
+        """
+        self.__existing = existing
+        # Directory -> names present or already chosen
+        self.__names = {}
+        # (directory, stem, extension) -> next collision number to try
+        self.__counters = {}
+
+
+    def claim(self, path, rename=True):
+        """Reserve a destination path.
+
+        Arguments:
+        path (str): The desired path.
+        rename (bool): If True, a path that is taken will be renamed with a collision number.
+                       If False, the path is returned as-is, even if it is taken.
+                       Default True.
+
+        Returns:
+        str: The path reserved.
+        """
+        directory, name = os.path.split(path)
+        names = self.__names.get(directory)
+        if names is None:
+            try:
+                names = set(os.listdir(directory or ".")) if self.__existing else set()
+            except (FileNotFoundError, NotADirectoryError):
+                names = set()
+            self.__names[directory] = names
+        if rename and name in names:
+            # The extension starts at the last period
+            index = name.rfind(".")
+            stem, ext = (name, "") if index < 0 else (name[:index], name[index:])
+            counter = (directory, stem, ext)
+            collisions = self.__counters.get(counter, 1)
+            while stem + "(" + str(collisions) + ")" + ext in names:
+                collisions += 1
+            self.__counters[counter] = collisions + 1
+            name = stem + "(" + str(collisions) + ")" + ext
+        names.add(name)
+        return os.path.join(directory, name)
 
 
 
@@ -314,7 +890,7 @@ def format_gmeta(data):
         raise TypeError("Cannot format '" + str(type(data)) + "' into GMeta.")
 
 
-def gmeta_pop(gmeta, info=False):
+def gmeta_pop(gmeta, info=False, fields=None):
     """Remove GMeta wrapping from a Globus Search result.
     This function can be called on the raw GlobusHTTPResponse that Search returns, or a string or dictionary representation of it.
 
@@ -323,30 +899,1568 @@ def gmeta_pop(gmeta, info=False):
     info (bool): If False, gmeta_pop will return a list of the results and discard the metadata.
                  If True, gmeta_pop will return a tuple containing the results list, and other information about the query.
                  Default False.
+    fields (list of str): The fields to keep in each result, as dot-separated paths (for example, "mdf.links").
+                          Everything else is dropped, so only the projected records stay in memory.
+                          Default None, to keep all fields.
 
     Returns:
     list (if info=False): The unwrapped results.
     tuple (if info=True): The unwrapped results, and a dictionary of query information.
     """
-    if type(gmeta) is GlobusHTTPResponse:
-        gmeta = json.loads(gmeta.text)
-    elif type(gmeta) is str:
-        gmeta = json.loads(gmeta)
-    elif type(gmeta) is not dict:
+    if _is_globus_response(gmeta) or type(gmeta) is str:
+        # Parse the records straight out of the response, without building the whole tree
+        stream = GMetaStream(gmeta, fields=fields)
+        results = list(stream)
+        total = stream.info["total"]
+    elif type(gmeta) is dict:
+        projection = compile_projection(fields) if fields else None
+        results = []
+        for res in gmeta["gmeta"]:
+            for con in res["content"]:
+                results.append(project(con, projection) if projection else con)
+        total = gmeta["total"]
+    else:
         raise TypeError("gmeta must be dict, GlobusHTTPResponse, or JSON string")
-    results = []
-    for res in gmeta["gmeta"]:
-        for con in res["content"]:
-            results.append(con)
     if info:
         fyi = {
-            "total_query_matches": gmeta["total"]
+            "total_query_matches": total
             }
         return results, fyi
     else:
         return results
 
 
+def _is_globus_response(obj):
+    """Return whether obj is a GlobusHTTPResponse, without importing globus_sdk if nothing has yet."""
+    response = sys.modules.get("globus_sdk.response")
+    return response is not None and type(obj) is response.GlobusHTTPResponse
+
+
+def compile_projection(fields):
+    """Compile a list of dot-separated field paths into a projection tree for project().
+    A path that is a prefix of another keeps the whole subtree (for example, "mdf" overrides "mdf.links").
+
+    Arguments:
+    fields (str or list of str): The fields to keep.
+
+    Returns:
+    dict: The projection tree. Each key maps to True (keep the value) or to the projection of the value.
+    """
+    if isinstance(fields, str):
+        fields = [fields]
+    tree = {}
+    for field in fields:
+        node = tree
+        parts = field.split(".")
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+            if node is True:
+                break
+        else:
+            node[parts[-1]] = True
+    return tree
+
+
+def project(record, projection):
+    """Keep only the projected fields of a record.
+    Lists of dictionaries are projected element by element.
+
+    Arguments:
+    record (dict): The record to project.
+    projection (dict): The projection, from compile_projection().
+
+    Returns:
+    dict: A new record with only the projected fields. Missing fields are omitted.
+    """
+    output = {}
+    for name, sub in projection.items():
+        if name not in record:
+            continue
+        value = record[name]
+        if sub is True:
+            output[name] = value
+        elif isinstance(value, dict):
+            output[name] = project(value, sub)
+        elif isinstance(value, list):
+            output[name] = [project(v, sub) for v in value if isinstance(v, dict)]
+    return output
+
+
+
+class GMetaStream:
+    """Parse the records out of a Globus Search result incrementally, as the response is read.
+    Each record in gmeta[*].content[*] is decoded (and projected) on its own, so only the unread part
+    of the current chunk and the records kept by the caller are held in memory,
+    rather than the whole response text and its parsed tree.
+
+    The other top-level values of the result (such as "total" and "count") are collected in `info`
+    as they are reached. Search may send them after the records, so `info` is only complete
+    once iteration has finished. A GMetaStream can only be iterated once.
+    """
+    CHUNK_SIZE = 2**16
+    __whitespace = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, source, fields=None, chunk_size=CHUNK_SIZE):
+        """Prepare to parse a Search result.
+
+        Arguments:
+        source: The result. May be a GlobusHTTPResponse, a requests.Response (ideally made with stream=True),
+                a JSON string or bytes, or an iterable of string or bytes chunks.
+        fields (list of str): The fields to keep in each record. See gmeta_pop() for details.
+                              Default None, to keep whole records.
+        chunk_size (int): The number of bytes to read from a response at a time. Default CHUNK_SIZE.
+        """
+        self.info = {}
+        self.__chunks = self.__read(source, chunk_size)
+        self.__projection = compile_projection(fields) if fields else None
+        self.__decoder = json.JSONDecoder()
+        self.__buf = ""
+        self.__pos = 0
+        self.__eof = False
+
+
+    def __iter__(self):
+        for key in self.__members():
+            if key != "gmeta":
+                self.info[key] = self.__value()
+                continue
+            for _ in self.__elements():
+                for result_key in self.__members():
+                    if result_key != "content":
+                        self.__value()
+                        continue
+                    for _ in self.__elements():
+                        record = self.__value()
+                        yield project(record, self.__projection) if self.__projection else record
+
+
+    @staticmethod
+    def __read(source, chunk_size):
+        """Yield the text of the source in chunks."""
+        if _is_globus_response(source):
+            source = source._data
+        if isinstance(source, (str, bytes)):
+            chunks = [source]
+        elif hasattr(source, "iter_content"):
+            chunks = source.iter_content(chunk_size)
+        elif hasattr(source, "text"):
+            chunks = [source.text]
+        else:
+            chunks = source
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for chunk in chunks:
+            yield decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        yield decoder.decode(b"", final=True)
+
+
+    def __fill(self):
+        """Read the next chunk into the buffer, dropping what has been parsed. Returns False at the end of the source."""
+        chunk = next(self.__chunks, None)
+        if chunk is None:
+            self.__eof = True
+            return False
+        self.__buf = self.__buf[self.__pos:] + chunk
+        self.__pos = 0
+        return True
+
+
+    def __peek(self):
+        """Skip whitespace and return the next character, or "" at the end of the source."""
+        while True:
+            self.__pos = self.__whitespace.match(self.__buf, self.__pos).end()
+            if self.__pos < len(self.__buf):
+                return self.__buf[self.__pos]
+            if not self.__fill():
+                return ""
+
+
+    def __expect(self, chars):
+        """Consume the next character, which must be one of `chars`."""
+        char = self.__peek()
+        if not char or char not in chars:
+            raise ValueError("Malformed Search result: expected one of '" + chars + "' at '"
+                             + self.__buf[self.__pos:self.__pos + 20] + "'")
+        self.__pos += 1
+        return char
+
+
+    def __value(self):
+        """Decode the next complete JSON value."""
+        self.__peek()
+        while True:
+            try:
+                value, end = self.__decoder.raw_decode(self.__buf, self.__pos)
+                # A value ending with the buffer may be a truncated number
+                if end < len(self.__buf) or self.__eof:
+                    self.__pos = end
+                    return value
+            except ValueError:
+                if self.__eof:
+                    raise
+            # Read until the unparsed text doubles, so large values are not re-decoded for every chunk
+            target = 2 * (len(self.__buf) - self.__pos)
+            while len(self.__buf) - self.__pos < target and self.__fill():
+                pass
+
+
+    def __members(self):
+        """Yield the keys of the next object. The caller must consume each value before resuming."""
+        self.__expect("{")
+        if self.__peek() == "}":
+            self.__pos += 1
+            return
+        while True:
+            key = self.__value()
+            self.__expect(":")
+            yield key
+            if self.__expect(",}") == "}":
+                return
+
+
+    def __elements(self):
+        """Yield once for each element of the next array. The caller must consume each element before resuming."""
+        self.__expect("[")
+        if self.__peek() == "]":
+            self.__pos += 1
+            return
+        while True:
+            yield
+            if self.__expect(",]") == "]":
+                return
+
+
+class GIngestStream:
+    """Serialize records into a GIngest document incrementally, as it is sent or written.
+    This is the reverse of GMetaStream: each record is formatted (with format_gmeta()) and encoded on its own,
+    as the document is read, so a batch of any size can be built in constant memory.
+    The bytes produced are the same as json.dumps(format_gmeta(entries)), encoded in UTF-8.
+
+    A GIngestStream can be iterated (for bytes chunks, as a chunked HTTP request body), or written to a file.
+    `count` holds the number of entries serialized so far. A GIngestStream can only be read once.
+    """
+    CHUNK_SIZE = 2**16
+
+    def __init__(self, records, chunk_size=CHUNK_SIZE):
+        """Prepare to serialize records.
+
+        Arguments:
+        records (iterable of dict): The records to ingest. Each may be a GMetaEntry,
+                                    or an MDF record to be formatted into one.
+        chunk_size (int): The approximate number of bytes in each chunk. Default CHUNK_SIZE.
+        """
+        self.count = 0
+        self.__records = iter(records)
+        self.__chunk_size = chunk_size
+        self.__encoder = json.JSONEncoder()
+
+
+    def __iter__(self):
+        # The envelope is split around its (empty) list of entries
+        envelope = self.__encoder.encode(format_gmeta([]))
+        split = envelope.rindex("[]") + 1
+        chunk = [envelope[:split]]
+        size = split
+        for record in self.__records:
+            if record.get("@datatype") != "GMetaEntry":
+                record = format_gmeta(record)
+            entry = self.__encoder.encode(record)
+            if self.count:
+                chunk.append(", ")
+            chunk.append(entry)
+            size += len(entry) + 2
+            self.count += 1
+            if size >= self.__chunk_size:
+                yield "".join(chunk).encode("utf-8")
+                chunk = []
+                size = 0
+        chunk.append(envelope[split:])
+        yield "".join(chunk).encode("utf-8")
+
+
+    def write(self, destination):
+        """Write the GIngest document to a file.
+
+        Arguments:
+        destination (str or file): The path to write to, or a file opened for writing bytes.
+
+        Returns:
+        int: The number of entries written.
+        """
+        if isinstance(destination, str):
+            with open(destination, "wb") as out_file:
+                return self.write(out_file)
+        for chunk in self:
+            destination.write(chunk)
+        return self.count
+
+
+
+###################################################
+##  Search utilities
+###################################################
+
+class SearchCache:
+    """A persistent, size-bounded cache of Globus Search results, stored in SQLite.
+
+    Each entry is a sequence of JSON pages, so large aggregations can be written and read
+    back incrementally. Entries expire after `ttl` seconds, and the least recently used
+    entries are evicted when the cache grows past `max_bytes`.
+    Entries only become visible once all of their pages are written.
+    """
+    DEFAULT_PATH = os.path.expanduser("~/mdf/cache/search_cache.sqlite")
+
+    def __init__(self, path=None, ttl=86400, max_bytes=2**30):
+        """Initialize the SearchCache.
+
+        Arguments:
+        path (str): The SQLite database file. Default ~/mdf/cache/search_cache.sqlite.
+        ttl (int): The number of seconds an entry is valid for, or None for no expiration. Default one day.
+        max_bytes (int): The maximum size of all cached results, in bytes. Default 1 GiB.
+        """
+        self.path = path or self.DEFAULT_PATH
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.__connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS entries "
+                       "(key TEXT PRIMARY KEY, created REAL, accessed REAL, size INTEGER)")
+            db.execute("CREATE TABLE IF NOT EXISTS pages "
+                       "(key TEXT, seq INTEGER, data BLOB, PRIMARY KEY (key, seq))")
+            db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+
+
+    @staticmethod
+    def make_key(*parts):
+        """Create a cache key from JSON-serializable parts, such as the query, flags, limit, and index."""
+        return json.dumps(parts, sort_keys=True, separators=(",", ":"))
+
+
+    def get(self, key):
+        """Look up a cache entry.
+
+        Arguments:
+        key (str): The key to look up.
+
+        Returns:
+        generator: The entry's pages, in order, if the entry is cached and not expired.
+                   Each page is read when it is reached, without holding the database open in between.
+                   If the entry is replaced or evicted before all of its pages are read, the generator raises LookupError.
+        None: If the entry is not cached.
+        """
+        now = time.time()
+        with self.__connect() as db:
+            row = db.execute("SELECT created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and now - row[0] > self.ttl:
+                self.__delete(db, key)
+                return None
+            db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            rowids = [rowid for (rowid,) in db.execute("SELECT rowid FROM pages WHERE key = ? ORDER BY seq", (key,))]
+        return self.__read_pages(key, rowids)
+
+
+    def store(self, key, pages):
+        """Write pages to a cache entry while passing them through.
+        The entry replaces any existing entry for the key once the pages are exhausted.
+        If the pages are not exhausted, nothing is cached.
+
+        Arguments:
+        key (str): The key to store the entry under.
+        pages (iterable): The JSON-serializable pages of the entry.
+
+        Yields:
+        The pages, as they are written.
+        """
+        # Each store writes under its own pending key, so concurrent stores of one key do not mix their pages
+        pending_key = key + "\0pending\0" + str(os.getpid()) + "\0" + os.urandom(8).hex()
+        size = 0
+        complete = False
+        try:
+            for seq, page in enumerate(pages):
+                data = json.dumps(page, separators=(",", ":")).encode("utf-8")
+                size += len(data)
+                # Commit each page on its own so long aggregations do not hold the database lock
+                with self.__connect() as db:
+                    db.execute("INSERT INTO pages VALUES (?, ?, ?)", (pending_key, seq, data))
+                yield page
+            now = time.time()
+            with self.__connect() as db:
+                self.__delete(db, key)
+                db.execute("UPDATE pages SET key = ? WHERE key = ?", (key, pending_key))
+                db.execute("INSERT INTO entries VALUES (?, ?, ?, ?)", (key, now, now, size))
+                self.__evict(db)
+            complete = True
+        finally:
+            # Abandoned (or failed) stores leave no pages behind
+            if not complete:
+                with self.__connect() as db:
+                    db.execute("DELETE FROM pages WHERE key = ?", (pending_key,))
+
+
+    def put(self, key, pages):
+        """Store a complete list of pages under a key.
+
+        Arguments:
+        key (str): The key to store the entry under.
+        pages (list): The JSON-serializable pages of the entry.
+        """
+        for page in self.store(key, pages):
+            pass
+
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        with self.__connect() as db:
+            db.execute("DELETE FROM entries")
+            db.execute("DELETE FROM pages")
+
+
+    @contextmanager
+    def __connect(self):
+        """Open a connection to the cache, committing and closing it afterwards."""
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+
+    def __read_pages(self, key, rowids):
+        """Yield the pages of an entry, reading each one on its own, so an abandoned reader holds no lock."""
+        for rowid in rowids:
+            with self.__connect() as db:
+                row = db.execute("SELECT data FROM pages WHERE rowid = ? AND key = ?", (rowid, key)).fetchone()
+            if row is None:
+                raise LookupError("Cache entry was removed while it was being read")
+            yield json.loads(row[0].decode("utf-8"))
+
+
+    def __delete(self, db, key):
+        """Remove an entry and its pages."""
+        db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        db.execute("DELETE FROM pages WHERE key = ?", (key,))
+
+
+    def __evict(self, db):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in db.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.__delete(db, key)
+            total -= size
+
+
+@contextmanager
+def _file_lock(path):
+    """Hold an exclusive lock on a file (through path + ".lock"), so that processes update it one at a time."""
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class ScrollPlanner:
+    """Choose `mdf.scroll_id` windows for aggregate queries.
+
+    The planner keeps a histogram of how many records matched each observed scroll window,
+    and uses it to choose windows that hold close to `target` records without going over.
+    Windows that are already known can be fetched directly; unknown windows should be sized
+    with a count-only probe first.
+    Observations are saved per query key, so repeated aggregations make close to the
+    minimum number of requests.
+    """
+    # Unknown windows may grow at most this many times per step when records are sparse
+    MAX_GROWTH = 8
+    # The most query keys kept in a file; the least recently saved are dropped past this
+    MAX_PLANS = 1000
+
+    def __init__(self, key, target, path=None):
+        """Initialize the ScrollPlanner.
+
+        Arguments:
+        key (str): The key identifying the query (and index) being aggregated.
+        target (int): The desired maximum number of records per window.
+        path (str): The JSON file to load and save observations in, or None to keep them in memory only.
+                    Default None.
+        """
+        self.key = key
+        self.target = max(int(target), 1)
+        self.path = path
+        self.__lock = threading.Lock()
+        # Sorted starts of non-overlapping observed windows, and their (end, total)
+        self.__starts = []
+        self.__windows = {}
+        self.__last_width = self.target
+        if path:
+            self.__load()
+
+
+    def plan(self, start):
+        """Choose the next window to fetch.
+
+        Arguments:
+        start (int): The first scroll_id of the window.
+
+        Returns:
+        tuple: The width of the window, and whether its record count is already known.
+               Windows that are not known should be probed before fetching.
+        """
+        with self.__lock:
+            # Pack consecutive known windows while they fit in the target
+            pos = start
+            count = 0
+            while pos in self.__windows:
+                end, total = self.__windows[pos]
+                if count + total > self.target:
+                    break
+                count += total
+                pos = end
+            if pos > start:
+                self.__last_width = pos - start
+                return pos - start, True
+
+            # Otherwise estimate from the density of the nearest observation
+            width = self.__last_width * self.MAX_GROWTH
+            density = self.__density_near(start)
+            if density:
+                width = min(width, max(int(self.target / density), 1))
+            elif density is None:
+                # Nothing is known yet; assume one record per scroll_id
+                width = self.target
+            self.__last_width = width
+            return width, False
+
+
+    def observe(self, start, end, total):
+        """Record the number of records matching in the window [start, end).
+        Older observations overlapping the window are replaced.
+
+        Arguments:
+        start (int): The first scroll_id of the window.
+        end (int): The scroll_id just past the end of the window.
+        total (int): The number of matching records in the window.
+        """
+        with self.__lock:
+            lo = bisect_right(self.__starts, start) - 1
+            if lo < 0 or self.__windows[self.__starts[lo]][0] <= start:
+                lo += 1
+            hi = bisect_left(self.__starts, end)
+            for old_start in self.__starts[lo:hi]:
+                del self.__windows[old_start]
+            self.__starts[lo:hi] = [start]
+            self.__windows[start] = (end, total)
+
+
+    def save(self):
+        """Save the observations to the planner's path, if it has one.
+        The file is locked while it is updated, and observations saved by other processes since it was loaded are kept,
+        unless this planner's own observations replace them.
+        Failure to save is not an error; the next aggregation will simply probe again.
+        """
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with _file_lock(self.path):
+                plans = self.__read_plans()
+                # Merge with the latest saved observations of this key
+                merged = ScrollPlanner(self.key, self.target)
+                for start, end, total in self.__saved_windows(plans.pop(self.key, None)):
+                    merged.observe(start, end, total)
+                with self.__lock:
+                    for start in self.__starts:
+                        merged.observe(start, *self.__windows[start])
+                plans[self.key] = {"saved": time.time(), "windows": merged.__window_list()}
+                # Drop the least recently saved keys
+                if len(plans) > self.MAX_PLANS:
+                    def saved(key):
+                        return plans[key].get("saved", 0) if isinstance(plans[key], dict) else 0
+                    for key in sorted(plans, key=saved)[:len(plans) - self.MAX_PLANS]:
+                        del plans[key]
+                tmp_path = self.path + ".tmp" + str(os.getpid())
+                with open(tmp_path, "w") as plan_file:
+                    json.dump(plans, plan_file)
+                os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+
+    def __window_list(self):
+        """Return the observations as a list of [start, end, total]."""
+        with self.__lock:
+            return [[start] + list(self.__windows[start]) for start in self.__starts]
+
+
+    @staticmethod
+    def __saved_windows(entry):
+        """Return the windows of a saved entry (older files saved the list of windows alone)."""
+        if isinstance(entry, dict):
+            return entry.get("windows", [])
+        return entry or []
+
+
+    def __load(self):
+        """Load the saved observations for this planner's key."""
+        for start, end, total in self.__saved_windows(self.__read_plans().get(self.key)):
+            self.observe(start, end, total)
+
+
+    def __read_plans(self):
+        """Read all saved observations from the planner's path."""
+        try:
+            with open(self.path) as plan_file:
+                plans = json.load(plan_file)
+        except (OSError, ValueError):
+            return {}
+        return plans if isinstance(plans, dict) else {}
+
+
+    def __density_near(self, start):
+        """Return the records per scroll_id of the observation nearest to start, or None if there are none."""
+        if not self.__starts:
+            return None
+        i = max(bisect_right(self.__starts, start) - 1, 0)
+        obs_start = self.__starts[i]
+        end, total = self.__windows[obs_start]
+        return total / (end - obs_start)
+
+
+
+###################################################
+##  HTTP utilities
+###################################################
+
+class HTTPPool:
+    """Make authorized HTTP requests from many threads through one pooled, keep-alive requests.Session,
+    and schedule batches of requests across hosts.
+    """
+    CHUNK_SIZE = 2**20
+    RETRIES = 3
+    # Default minimum size of a file, in bytes, for download() to fetch it in segments
+    SEGMENT_THRESHOLD = 2**28
+    # Seconds between saves of the progress of a segmented download
+    PROGRESS_INTERVAL = 1
+
+    def __init__(self, authorizer=None, pool_size=16):
+        """Create the session.
+
+        Arguments:
+        authorizer (GlobusAuthorizer): The authorizer for every request. Default None, for no authorization.
+        pool_size (int): The number of connections to keep open to each host. Default 16.
+        """
+        self.authorizer = authorizer
+        self.__pool_size = pool_size
+        self.__new_session()
+
+
+    def __new_session(self):
+        """Create the session, for the current process."""
+        self.__pid = os.getpid()
+        self.__session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.__pool_size, pool_maxsize=self.__pool_size)
+        self.__session.mount("https://", adapter)
+        self.__session.mount("http://", adapter)
+
+
+    def get(self, url, headers=None, stream=False):
+        """GET a URL, retrying once with fresh authorization if the server responds 401 Unauthorized.
+
+        Arguments:
+        url (str): The URL to get.
+        headers (dict): Extra headers for the request. Default None.
+        stream (bool): If True, the body will be read when the caller reads it. Default False.
+
+        Returns:
+        requests.Response: The response.
+        """
+        return self.__request("GET", url, headers, stream)
+
+
+    def head(self, url, headers=None):
+        """Make a HEAD request for a URL, retrying once with fresh authorization if the server responds 401 Unauthorized.
+
+        Arguments:
+        url (str): The URL.
+        headers (dict): Extra headers for the request. Default None.
+
+        Returns:
+        requests.Response: The response.
+        """
+        return self.__request("HEAD", url, headers, False)
+
+
+    def __request(self, method, url, headers, stream):
+        """Make an authorized request, as described in get()."""
+        # A pool used in a child process gets its own connections, rather than the parent's
+        if self.__pid != os.getpid():
+            self.__new_session()
+        for attempt in range(2):
+            request_headers = dict(headers or {})
+            if self.authorizer is not None:
+                self.authorizer.set_authorization_header(request_headers)
+            response = self.__session.request(method, url, headers=request_headers, stream=stream, allow_redirects=True)
+            if response.status_code != 401 or attempt or self.authorizer is None:
+                break
+            response.close()
+            self.authorizer.handle_missing_authorization()
+        return response
+
+
+    def download(self, url, local_path, checksum=None, headers=None, info=False, segments=1, segment_threshold=None):
+        """Save the file at a URL to disk, one chunk at a time.
+        The file is written to local_path + ".part" and renamed into place once complete, so local_path never holds a partial file.
+        If the transfer is interrupted, it is resumed from where it stopped with an HTTP Range request,
+        both within this call (up to RETRIES times) and by later calls for the same local_path.
+        The file's ETag (or Last-Modified date) is saved in local_path + ".part.validator" and sent with If-Range,
+        so a file that changed on the server is downloaded again in full instead of appended to the old part.
+        Large files can be fetched as several byte ranges at once, written in place into the preallocated .part file.
+        The ranges still to be fetched are saved in local_path + ".part.segments", so that a later call resumes them.
+        If the server does not support that, or a segment fails for good, the rest of the file is fetched in one stream.
+
+        Arguments:
+        url (str): The URL of the file.
+        local_path (str): Where to save the file.
+        checksum (tuple of str): The name of a hashlib algorithm and the expected hex digest of the file.
+                                 Default None, to only check the size of the file against what the server reported.
+        headers (dict): Extra headers for the request, such as conditional request headers. Default None.
+        info (bool): If False, download will return the result of the download.
+                     If True, download will return a tuple containing the result, and information about the download:
+                     the validators of the file ("etag" and "last_modified", from the server's ETag and Last-Modified headers),
+                     the "bytes" received, the number of "retries", the "latency" until the first response in seconds
+                     (None if there was no response), and the total "seconds" taken.
+                     Default False.
+        segments (int): The number of byte ranges to fetch a large file in at once. Default 1, to fetch every file in one stream.
+        segment_threshold (int): The minimum size of a file, in bytes, to fetch it in segments. Default SEGMENT_THRESHOLD.
+
+        Returns:
+        int or Exception (if info=False): The HTTP status code (200 once the file is saved), or the error if the download failed.
+        tuple (if info=True): The result, and a dictionary of information about the download.
+        """
+        stats = {"start": time.time(), "bytes": 0, "retries": 0, "latency": None}
+        result, response_headers = self.__download(url, local_path, checksum, headers, stats, segments,
+                                                   segment_threshold or self.SEGMENT_THRESHOLD)
+        if info:
+            return result, {
+                "etag": response_headers.get("ETag"),
+                "last_modified": response_headers.get("Last-Modified"),
+                "bytes": stats["bytes"],
+                "retries": stats["retries"],
+                "latency": stats["latency"],
+                "seconds": time.time() - stats["start"]
+                }
+        return result
+
+
+    def __download(self, url, local_path, checksum, headers, stats, segments=1, segment_threshold=None):
+        """Download a file, as described in download(), counting what happens in stats.
+
+        Returns:
+        tuple: The result, and the headers of the last response (empty if there was none).
+        """
+        part_path = local_path + ".part"
+        error = None
+        response_headers = {}
+        segmented = None
+        # Positional writes are needed to fill in segments
+        if segments > 1 and hasattr(os, "pwrite"):
+            try:
+                segmented = self.__download_segments(url, part_path, headers, stats, segments, segment_threshold)
+            except (requests.RequestException, OSError):
+                segmented = None
+        if segmented is not None:
+            status, size, response_headers = segmented
+            if status not in (200, 206):
+                return status, response_headers
+        else:
+            for attempt in range(self.RETRIES + 1):
+                stats["retries"] += attempt > 0
+                try:
+                    status, size, response_headers = self.__download_part(url, part_path, headers, stats)
+                    if status not in (200, 206):
+                        return status, response_headers
+                    break
+                except requests.RequestException as e:
+                    # Keep what was received, and ask for the rest
+                    error = e
+                except OSError as e:
+                    # The file cannot be written, which retrying will not fix
+                    return e, response_headers
+            else:
+                return error, response_headers
+
+        try:
+            received = os.path.getsize(part_path)
+            if size is not None and received != size:
+                if received > size:
+                    self.__discard_part(part_path)
+                return IOError("Expected " + str(size) + " bytes but received " + str(received)), response_headers
+            if checksum:
+                digest = hashlib.new(checksum[0])
+                with open(part_path, "rb") as part:
+                    for chunk in iter(lambda: part.read(self.CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                if digest.hexdigest() != checksum[1].lower():
+                    self.__discard_part(part_path)
+                    return ValueError(checksum[0] + " checksum of '" + url + "' does not match"), response_headers
+            os.replace(part_path, local_path)
+            self.__discard_part(part_path)
+        except OSError as e:
+            return e, response_headers
+        return 200, response_headers
+
+
+    def __download_segments(self, url, part_path, headers, stats, segments, segment_threshold):
+        """Fetch the rest of a large file as several byte ranges at once, writing each in place into the partial download.
+
+        Returns:
+        tuple: The HTTP status code, the full size of the file, and the headers of the HEAD response,
+               or None if the file should be fetched in one stream instead.
+               Whatever was completed from the start of the file is kept in the partial download for that stream to resume.
+        """
+        head = self.head(url, headers=headers)
+        stats["latency"] = time.time() - stats["start"]
+        if head.status_code == 304:
+            return 304, None, head.headers
+        length = head.headers.get("Content-Length", "")
+        if (head.status_code != 200 or not length.isdigit() or head.headers.get("Content-Encoding")
+                or head.headers.get("Accept-Ranges", "bytes") != "bytes"):
+            return None
+        size = int(length)
+        validator = self.__validator(head.headers)
+        if size < segment_threshold or not validator:
+            return None
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        # A partial download of another version of the file cannot be resumed
+        if offset and self.__read_validator(part_path) != validator:
+            self.__discard_part(part_path)
+            offset = 0
+        progress = self.__read_segments(part_path) if offset else None
+        if progress is not None and progress["size"] == size:
+            # An interrupted segmented download resumes the ranges it had left
+            bounds = [(start, end) for start, end in progress["ranges"] if start < end]
+        else:
+            if progress is not None:
+                self.__discard_part(part_path)
+                offset = 0
+            if offset >= size:
+                return None
+            width = -(-(size - offset) // segments)
+            bounds = [(start, min(start + width, size)) for start in range(offset, size, width)]
+        self.__write_validator(part_path, validator)
+
+        # Only the ranges are requested; conditions were already checked by the HEAD request
+        range_headers = {key: value for key, value in (headers or {}).items()
+                         if key not in ("If-None-Match", "If-Modified-Since")}
+        # If the file changes on the server partway through, the server sends all of it instead of a range
+        range_headers["If-Range"] = validator
+        # How far each segment has been written, and how many times it was retried
+        positions = [start for start, end in bounds]
+        retries = [0] * len(bounds)
+        progress_lock = threading.Lock()
+        progress_saved = [0]
+
+        def save_progress(force=False):
+            """Save the ranges still to be fetched, at most every PROGRESS_INTERVAL seconds unless forced."""
+            with progress_lock:
+                if force or time.time() - progress_saved[0] >= self.PROGRESS_INTERVAL:
+                    self.__write_segments(part_path, size, [(position, end) for (start, end), position
+                                                            in zip(bounds, positions) if position < end])
+                    progress_saved[0] = time.time()
+
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            # Reserve the space for the whole file at once
+            if hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except OSError:
+                    os.ftruncate(fd, size)
+            else:
+                os.ftruncate(fd, size)
+            # From here on, the .part file has holes until the ranges are filled in
+            save_progress(force=True)
+
+            def fetch(i):
+                end = bounds[i][1]
+                for attempt in range(self.RETRIES + 1):
+                    retries[i] += attempt > 0
+                    try:
+                        segment_headers = dict(range_headers, Range="bytes=%d-%d" % (positions[i], end - 1))
+                        with self.get(url, headers=segment_headers, stream=True) as response:
+                            if (response.status_code != 206 or not
+                                    response.headers.get("Content-Range", "").startswith("bytes %d-" % positions[i])):
+                                return False
+                            for chunk in response.iter_content(self.CHUNK_SIZE):
+                                chunk = memoryview(chunk)[:end - positions[i]]
+                                while chunk:
+                                    written = os.pwrite(fd, chunk, positions[i])
+                                    positions[i] += written
+                                    chunk = chunk[written:]
+                                save_progress()
+                        if positions[i] >= end:
+                            return True
+                    except requests.RequestException:
+                        pass
+                    except OSError:
+                        # The file cannot be written, which retrying will not fix
+                        return False
+                return False
+
+            complete = True
+            if bounds:
+                with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+                    complete = all(list(executor.map(fetch, range(len(bounds)))))
+            stats["bytes"] += sum(position - start for (start, end), position in zip(bounds, positions))
+            stats["retries"] += sum(retries)
+            if not complete:
+                # Keep the part of the file that is complete from the start, for the single stream to resume
+                os.ftruncate(fd, self.__complete_prefix(size, [(position, end) for (start, end), position
+                                                                in zip(bounds, positions)]))
+                os.remove(part_path + ".segments")
+                return None
+            os.remove(part_path + ".segments")
+        finally:
+            os.close(fd)
+        return 206, size, head.headers
+
+
+    def __download_part(self, url, part_path, headers=None, stats=None):
+        """Append the rest of a file to its partial download, restarting if the server cannot resume it.
+
+        Returns:
+        tuple: The HTTP status code, the full size of the file according to the server (None if unknown),
+               and the response headers.
+        """
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        progress = self.__read_segments(part_path) if offset else None
+        if progress is not None:
+            # A segmented download left holes in the file; only what is complete from the start can be appended to
+            offset = min(offset, self.__complete_prefix(progress["size"], progress["ranges"]))
+            with open(part_path, "r+b") as part:
+                part.truncate(offset)
+            os.remove(part_path + ".segments")
+        request_headers = dict(headers or {})
+        if offset:
+            validator = self.__read_validator(part_path)
+            if validator:
+                # If the file changed since the partial download was started, the server sends all of it
+                request_headers["Range"] = "bytes=" + str(offset) + "-"
+                request_headers["If-Range"] = validator
+            else:
+                # Without a validator there is no telling which version of the file the partial download is from
+                self.__discard_part(part_path)
+                offset = 0
+        with self.get(url, headers=request_headers, stream=True) as response:
+            if stats is not None and stats["latency"] is None:
+                stats["latency"] = time.time() - stats["start"]
+            content_range = response.headers.get("Content-Range", "")
+            if offset and (response.status_code == 416
+                           or (response.status_code == 206 and not content_range.startswith("bytes " + str(offset) + "-"))):
+                # The partial file cannot be resumed, so start over
+                response.close()
+                self.__discard_part(part_path)
+                return self.__download_part(url, part_path, headers, stats)
+            if response.status_code not in (200, 206):
+                return response.status_code, None, response.headers
+            if response.status_code == 206:
+                total = content_range.rpartition("/")[2]
+                size = int(total) if total.isdigit() else None
+            else:
+                # A full response replaces whatever was there
+                offset = 0
+                length = response.headers.get("Content-Length")
+                # Content-Length is the encoded size when the body is compressed in transit
+                size = int(length) if length and length.isdigit() and not response.headers.get("Content-Encoding") else None
+                self.__write_validator(part_path, self.__validator(response.headers))
+            with open(part_path, "ab" if offset else "wb") as output:
+                for chunk in response.iter_content(self.CHUNK_SIZE):
+                    output.write(chunk)
+                    if stats is not None:
+                        stats["bytes"] += len(chunk)
+        return response.status_code, size, response.headers
+
+
+    @staticmethod
+    def __validator(response_headers):
+        """Return the validator to resume a file with (its strong ETag, or else its Last-Modified date), or None."""
+        etag = response_headers.get("ETag")
+        # Weak ETags cannot be used in If-Range
+        if etag and not etag.startswith("W/"):
+            return etag
+        return response_headers.get("Last-Modified")
+
+
+    @staticmethod
+    def __read_validator(part_path):
+        """Return the validator saved with a partial download, or None."""
+        try:
+            with open(part_path + ".validator") as validator_file:
+                return validator_file.read() or None
+        except OSError:
+            return None
+
+
+    @staticmethod
+    def __write_validator(part_path, validator):
+        """Save the validator of the file a partial download is from, next to it."""
+        if validator:
+            with open(part_path + ".validator", "w") as validator_file:
+                validator_file.write(validator)
+        elif os.path.exists(part_path + ".validator"):
+            os.remove(part_path + ".validator")
+
+
+    @staticmethod
+    def __read_segments(part_path):
+        """Return the progress saved with a segmented partial download (its "size", and the "ranges" still
+        to be fetched), or None if it was not segmented.
+        """
+        try:
+            with open(part_path + ".segments") as segments_file:
+                progress = json.load(segments_file)
+            return {"size": int(progress["size"]), "ranges": [(int(start), int(end)) for start, end in progress["ranges"]]}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+
+    @staticmethod
+    def __write_segments(part_path, size, ranges):
+        """Save the progress of a segmented partial download next to it, replacing the last save at once."""
+        tmp_path = part_path + ".segments.tmp"
+        with open(tmp_path, "w") as segments_file:
+            json.dump({"size": size, "ranges": ranges}, segments_file)
+        os.replace(tmp_path, part_path + ".segments")
+
+
+    @staticmethod
+    def __complete_prefix(size, ranges):
+        """Return how much of a segmented download is complete from the start, given the ranges still to be fetched."""
+        return min([start for start, end in ranges if start < end] or [size])
+
+
+    @staticmethod
+    def __discard_part(part_path):
+        """Remove a partial download (if it is still there) and its validator and progress."""
+        for path in (part_path, part_path + ".validator", part_path + ".segments"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+    def map(self, function, jobs, workers=8, per_host=4):
+        """Call function(url, *args) for each (url, *args) job on a pool of threads.
+        No more than `per_host` jobs run against one host at a time. Whenever a job finishes,
+        the next job goes out round-robin among the hosts with a free slot, so faster hosts take on more of the work
+        and one slow server cannot hold up the rest.
+
+        Arguments:
+        function (function): The function to call. Errors should be returned rather than raised.
+        jobs (list of tuple): The arguments for each call. The first must be the URL requested.
+        workers (int): The maximum number of jobs to run at once. Default 8.
+        per_host (int): The maximum number of jobs to run against each host at once. Default 4.
+
+        Yields:
+        tuple: Each job and the value returned for it, in order of completion.
+        """
+        workers = max(workers, 1)
+        per_host = max(per_host, 1)
+        queues = OrderedDict()
+        for job in jobs:
+            queues.setdefault(urlparse(job[0]).netloc, deque()).append(job)
+        active = dict.fromkeys(queues, 0)
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while queues or running:
+                submitted = True
+                while submitted and len(running) < workers:
+                    submitted = False
+                    for host in list(queues):
+                        if len(running) >= workers:
+                            break
+                        if active[host] >= per_host:
+                            continue
+                        job = queues[host].popleft()
+                        if queues[host]:
+                            queues.move_to_end(host)
+                        else:
+                            del queues[host]
+                        running[executor.submit(function, *job)] = (host, job)
+                        active[host] += 1
+                        submitted = True
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    host, job = running.pop(future)
+                    active[host] -= 1
+                    yield job, future.result()
+
+
+
+class DataCache:
+    """A persistent, size-bounded cache of data files fetched over HTTP, keyed by URL (host and path).
+
+    Each file is stored under `path`, named by the SHA-256 of its URL, with an SQLite index of its validators
+    (ETag and Last-Modified). A cached file is used without contacting the server for `max_age` seconds after
+    it was last validated. After that, it is revalidated with a conditional request, and only downloaded again
+    if it has changed. The least recently used files are evicted when the cache grows past `max_bytes`,
+    except files in use by this DataCache, such as those inside a pinned() block.
+    """
+    DEFAULT_PATH = os.path.expanduser("~/mdf/cache/data")
+
+    def __init__(self, path=None, max_bytes=2**32, max_age=3600):
+        """Initialize the DataCache.
+
+        Arguments:
+        path (str): The directory to keep cached files in. Default ~/mdf/cache/data.
+        max_bytes (int): The maximum size of all cached files, in bytes. Default 4 GiB.
+        max_age (int): The number of seconds to use a file before checking whether it changed,
+                       or None to never check. Default one hour.
+        """
+        self.path = path or self.DEFAULT_PATH
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.__index = os.path.join(self.path, "index.sqlite")
+        self.__lock = threading.Lock()
+        # The lock and number of users of each URL in use, so that files in use are not evicted
+        self.__in_use = {}
+        os.makedirs(self.path, exist_ok=True)
+        with self.__connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS files "
+                       "(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, size INTEGER, validated REAL, accessed REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS files_accessed ON files (accessed)")
+
+
+    def file_path(self, url):
+        """Return where the file for a URL is (or would be) cached."""
+        return os.path.join(self.path, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+
+    def fetch(self, pool, url, **kwargs):
+        """Make sure the file at a URL is cached and current, downloading it if necessary.
+
+        Arguments:
+        pool (HTTPPool): The pool to make requests through.
+        url (str): The URL of the file.
+
+        Keyword Arguments:
+        Passed on to pool.download(), such as segments and segment_threshold.
+
+        Returns:
+        int or Exception: 200 if the file is cached at file_path(url), otherwise the HTTP status code or error.
+        """
+        local_path = self.file_path(url)
+        # Requests for the same URL wait for each other, rather than downloading it twice
+        with self.__using(url) as url_lock, url_lock:
+            with self.__connect() as db:
+                row = db.execute("SELECT etag, last_modified, validated FROM files WHERE url = ?", (url,)).fetchone()
+            headers = {}
+            if row is not None and os.path.exists(local_path):
+                etag, last_modified, validated = row
+                if self.max_age is None or time.time() - validated <= self.max_age:
+                    self.__touch(url, validated=False)
+                    return 200
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+
+            status, validators = pool.download(url, local_path, headers=headers, info=True, **kwargs)
+            if status == 304 and headers:
+                self.__touch(url, validated=True)
+                return 200
+            if status != 200:
+                return status
+            now = time.time()
+            with self.__connect() as db:
+                db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                           (url, validators["etag"], validators["last_modified"], os.path.getsize(local_path), now, now))
+                self.__evict(db, keep=url)
+            return 200
+
+
+    @contextmanager
+    def pinned(self, pool, url, **kwargs):
+        """Fetch a file, and keep it from being evicted until the block ends.
+        Use this to read the file after fetching it, while other threads may be filling the cache.
+
+        Arguments:
+        pool (HTTPPool): The pool to make requests through.
+        url (str): The URL of the file.
+
+        Keyword Arguments:
+        Passed on to fetch().
+
+        Yields:
+        int or Exception: The result of fetch().
+        """
+        with self.__using(url):
+            yield self.fetch(pool, url, **kwargs)
+
+
+    def open(self, url):
+        """Map a cached file into memory, read-only.
+
+        Arguments:
+        url (str): The URL of the file, which must have been fetched.
+
+        Returns:
+        mmap or memoryview: The contents of the file. Use it as a context manager, or close it when done.
+        """
+        with open(self.file_path(url), "rb") as f:
+            # Empty files cannot be mapped
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"")
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def clear(self):
+        """Remove every file from the cache."""
+        with self.__connect() as db:
+            for (url,) in db.execute("SELECT url FROM files").fetchall():
+                self.__delete(db, url)
+
+
+    @contextmanager
+    def __connect(self):
+        """Open a connection to the index, committing and closing it afterwards."""
+        db = sqlite3.connect(self.__index, timeout=60)
+        try:
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+
+    @contextmanager
+    def __using(self, url):
+        """Mark a URL as in use for the duration of the block, yielding its lock.
+        The lock is forgotten once nothing uses the URL.
+        """
+        with self.__lock:
+            entry = self.__in_use.setdefault(url, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self.__lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.__in_use[url]
+
+
+    def __touch(self, url, validated):
+        """Mark a file as used now (and, if validated, as known to be current)."""
+        now = time.time()
+        with self.__connect() as db:
+            if validated:
+                db.execute("UPDATE files SET accessed = ?, validated = ? WHERE url = ?", (now, now, url))
+            else:
+                db.execute("UPDATE files SET accessed = ? WHERE url = ?", (now, url))
+
+
+    def __delete(self, db, url):
+        """Remove a file and its index entry."""
+        db.execute("DELETE FROM files WHERE url = ?", (url,))
+        try:
+            os.remove(self.file_path(url))
+        except FileNotFoundError:
+            pass
+
+
+    def __evict(self, db, keep=None):
+        """Remove the least recently used files (other than `keep` and those in use) until the cache fits in max_bytes."""
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        with self.__lock:
+            in_use = set(self.__in_use)
+        for url, size in db.execute("SELECT url, size FROM files ORDER BY accessed").fetchall():
+            if total <= self.max_bytes:
+                break
+            if url != keep and url not in in_use:
+                self.__delete(db, url)
+                total -= size
+
+
+
+class SyncManifest:
+    """A record of the files downloaded into a directory over HTTP, so that refreshing them only downloads what changed.
+    For each file, the manifest keeps its URL, the server's validators (ETag and Last-Modified),
+    and the size and modification time the file had when it was saved. A file that is still as it was saved
+    is revalidated with a conditional request, and only downloaded again if it changed on the server.
+    Files that are missing or were changed locally are always downloaded again.
+    """
+
+    def __init__(self, path):
+        """Initialize the SyncManifest.
+
+        Arguments:
+        path (str): The JSON file to load and save the manifest in. Paths in the manifest are relative to its directory.
+        """
+        self.path = path
+        self.__root = os.path.dirname(os.path.abspath(path))
+        self.__lock = threading.Lock()
+        try:
+            with open(path) as manifest_file:
+                self.__files = json.load(manifest_file)
+        except (OSError, ValueError):
+            self.__files = {}
+
+
+    def conditions(self, url, local_path):
+        """Return the headers to revalidate a file with, or None if the file must be downloaded in full.
+
+        Arguments:
+        url (str): The URL the file is downloaded from.
+        local_path (str): Where the file is saved.
+
+        Returns:
+        dict: The conditional request headers, or None.
+        """
+        with self.__lock:
+            entry = self.__files.get(self.__key(local_path))
+        if not entry or entry["url"] != url:
+            return None
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            return None
+        if stat.st_size != entry["size"] or stat.st_mtime_ns != entry["mtime_ns"]:
+            return None
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers or None
+
+
+    def record(self, url, local_path, validators):
+        """Record a file that was just downloaded.
+
+        Arguments:
+        url (str): The URL the file was downloaded from.
+        local_path (str): Where the file was saved.
+        validators (dict): The "etag" and "last_modified" of the file, as returned by HTTPPool.download(info=True).
+        """
+        stat = os.stat(local_path)
+        with self.__lock:
+            self.__files[self.__key(local_path)] = {
+                "url": url,
+                "etag": validators.get("etag"),
+                "last_modified": validators.get("last_modified"),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns
+                }
+
+
+    def save(self):
+        """Save the manifest to its path.
+        Failure to save is not an error; the next refresh will simply download the files again.
+        """
+        with self.__lock:
+            files = dict(self.__files)
+        try:
+            os.makedirs(self.__root, exist_ok=True)
+            tmp_path = self.path + ".tmp" + str(os.getpid())
+            with open(tmp_path, "w") as manifest_file:
+                json.dump(files, manifest_file)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+
+    def __key(self, local_path):
+        """Return the manifest key of a local path."""
+        return os.path.relpath(os.path.abspath(local_path), self.__root)
+
+
+
+class DownloadSummary(namedtuple("DownloadSummary", ["files_completed", "files_unchanged", "files_failed", "bytes",
+                                                     "seconds", "bytes_per_second", "retries", "hosts", "tasks"])):
+    """What happened during a download, made by TransferMetrics.summary().
+
+    Fields:
+    files_completed (int): The number of files saved.
+    files_unchanged (int): The number of files skipped because they were already up to date.
+    files_failed (int): The number of files that could not be saved.
+    bytes (int): The number of bytes received.
+    seconds (float): The time the download took.
+    bytes_per_second (float): The overall throughput.
+    retries (int): The number of requests retried after an interruption.
+    hosts (dict): For each host (or Globus source endpoint), its "files", "unchanged", "failed", "bytes", "retries",
+                  "bytes_per_second", and the 50th, 90th and 99th percentile "latency" until the first response,
+                  in seconds (None when unknown).
+    tasks (dict): The latest "status", "source", "files", "files_transferred", "files_skipped", "bytes_transferred",
+                  and "bytes_per_second" of each Globus Transfer task, by task ID.
+    """
+    __slots__ = ()
+
+
+class TransferMetrics:
+    """Collect throughput, latency, retry, and completion metrics for a download, and report each event to a callback.
+
+    The callback receives one dictionary per event, as it happens:
+    file events ("event": "file") have the "url", "host", "path", "status", "bytes", "seconds", "latency" and "retries" of a file;
+    task events ("event": "task") have the "task_id", "source", "status", "files", "files_transferred", "files_skipped",
+    "bytes_transferred" and "bytes_per_second" of a Globus Transfer task, each time it is checked.
+    """
+
+    def __init__(self, callback=None):
+        """Initialize the TransferMetrics.
+
+        Arguments:
+        callback (function): The function to call with each event. Default None, for no callback.
+        """
+        self.callback = callback
+        self.__start = time.time()
+        self.__lock = threading.Lock()
+        self.__hosts = OrderedDict()
+        self.__latencies = {}
+        self.__tasks = OrderedDict()
+
+
+    def record_file(self, url, local_path, status, info=None):
+        """Record a file download.
+
+        Arguments:
+        url (str): The URL of the file.
+        local_path (str): Where the file was saved.
+        status (int or Exception): The result of the download: 200 if saved, 304 if already up to date, or the error.
+        info (dict): The "bytes", "seconds", "latency" and "retries" of the download, as returned by
+                     HTTPPool.download(info=True). Default None, if unknown.
+        """
+        info = info or {}
+        now = time.time()
+        event = {
+            "event": "file",
+            "url": url,
+            "host": urlparse(url).netloc,
+            "path": local_path,
+            "status": status,
+            "bytes": info.get("bytes", 0),
+            "seconds": info.get("seconds", 0),
+            "latency": info.get("latency"),
+            "retries": info.get("retries", 0)
+            }
+        with self.__lock:
+            host = self.__host(event["host"])
+            if status == 200:
+                host["files"] += 1
+            elif status == 304:
+                host["unchanged"] += 1
+            else:
+                host["failed"] += 1
+            host["bytes"] += event["bytes"]
+            host["retries"] += event["retries"]
+            host["first"] = min(host["first"], now - event["seconds"])
+            host["last"] = max(host["last"], now)
+            if event["latency"] is not None:
+                self.__latencies.setdefault(event["host"], []).append(event["latency"])
+        self.__report(event)
+
+
+    def record_task(self, task):
+        """Record the state of a Globus Transfer task.
+
+        Arguments:
+        task (dict): The task document from Globus Transfer, or at least its "task_id" and "status".
+        """
+        event = {
+            "event": "task",
+            "task_id": task["task_id"],
+            "source": task.get("source_endpoint_id"),
+            "status": task["status"],
+            "files": task.get("files", 0),
+            "files_transferred": task.get("files_transferred", 0),
+            "files_skipped": task.get("files_skipped", 0),
+            "bytes_transferred": task.get("bytes_transferred", 0),
+            "bytes_per_second": task.get("effective_bytes_per_second", 0)
+            }
+        with self.__lock:
+            old = self.__tasks.get(event["task_id"], {})
+            # Keep the source from the submission, which later task documents also have
+            event["source"] = event["source"] or old.get("source")
+            self.__tasks[event["task_id"]] = {key: value for key, value in event.items() if key not in ("event", "task_id")}
+        self.__report(event)
+
+
+    def summary(self):
+        """Summarize the download so far.
+
+        Returns:
+        DownloadSummary: The summary.
+        """
+        seconds = time.time() - self.__start
+        with self.__lock:
+            hosts = OrderedDict()
+            for name, host in self.__hosts.items():
+                latencies = sorted(self.__latencies.get(name, []))
+                elapsed = host["last"] - host["first"]
+                hosts[name] = {
+                    "files": host["files"],
+                    "unchanged": host["unchanged"],
+                    "failed": host["failed"],
+                    "bytes": host["bytes"],
+                    "retries": host["retries"],
+                    "bytes_per_second": host["bytes"] / elapsed if elapsed > 0 else 0.0,
+                    "latency": {"p" + str(p): _percentile(latencies, p) for p in (50, 90, 99)}
+                    }
+            files_completed = sum(host["files"] for host in self.__hosts.values())
+            files_unchanged = sum(host["unchanged"] for host in self.__hosts.values())
+            files_failed = sum(host["failed"] for host in self.__hosts.values())
+            total_bytes = sum(host["bytes"] for host in self.__hosts.values())
+            retries = sum(host["retries"] for host in self.__hosts.values())
+            tasks = OrderedDict((task_id, dict(task)) for task_id, task in self.__tasks.items())
+        for task in tasks.values():
+            files_completed += task["files_transferred"]
+            files_unchanged += task["files_skipped"]
+            if task["status"] not in ("ACTIVE", "SUCCEEDED"):
+                files_failed += task["files"] - task["files_transferred"] - task["files_skipped"]
+            total_bytes += task["bytes_transferred"]
+            host = hosts.setdefault(task["source"], {"files": 0, "unchanged": 0, "failed": 0, "bytes": 0, "retries": 0,
+                                                     "bytes_per_second": 0.0,
+                                                     "latency": {"p50": None, "p90": None, "p99": None}})
+            host["files"] += task["files_transferred"]
+            host["unchanged"] += task["files_skipped"]
+            host["bytes"] += task["bytes_transferred"]
+            host["bytes_per_second"] += task["bytes_per_second"]
+        return DownloadSummary(files_completed, files_unchanged, files_failed, total_bytes, seconds,
+                               total_bytes / seconds if seconds > 0 else 0.0, retries, hosts, tasks)
+
+
+    def __host(self, name):
+        """Return the running totals for a host, creating them if needed."""
+        if name not in self.__hosts:
+            self.__hosts[name] = {"files": 0, "unchanged": 0, "failed": 0, "bytes": 0, "retries": 0,
+                                  "first": float("inf"), "last": float("-inf")}
+        return self.__hosts[name]
+
+
+    def __report(self, event):
+        """Pass an event to the callback. Errors in the callback are printed, rather than stopping the download."""
+        if self.callback is None:
+            return
+        try:
+            self.callback(event)
+        except Exception as e:
+            print("Error in download callback:", repr(e))
+
+
+def _percentile(values, percent):
+    """Return the nearest-rank percentile of sorted values, or None if there are none."""
+    if not values:
+        return None
+    return values[max(int(math.ceil(percent / 100 * len(values))) - 1, 0)]
+
 
 ###################################################
 ##  Globus utilities
@@ -415,110 +2529,14 @@ def get_local_ep(transfer_client):
 ##  Clients
 ###################################################
 
-class SearchClient(BaseClient):
-    """Access (search and ingest) Globus Search."""
-
-    def __init__(self, base_url="https://search.api.globus.org/", default_index=None, **kwargs):
-        app_name = kwargs.pop('app_name', 'Search Client v0.2')
-        BaseClient.__init__(self, "search", app_name=app_name, **kwargs)
-        # base URL lookup will fail, producing None, set it by hand
-        self.base_url = base_url
-        self._headers['Content-Type'] = 'application/json'
-        self.default_index = default_index
-
-    def _base_index_uri(self, index):
-        index = index or self.default_index
-        if not index:
-            raise ValueError(
-                ('You must either pass an explicit index '
-                 'or set a default one at the time that you create '
-                 'a SearchClient'))
-        return '/v1/index/{}'.format(index)
-
-    def search(self, q, limit=None, offset=None, query_template=None,
-               index=None, advanced=None, **params):
-        """
-        Perform a simple ``GET`` based search.
-
-        Does not support all of the behaviors and parameters of advanced
-        searches.
-
-        **Parameters**
-
-          ``q`` (*string*)
-            The user-query string. Required for simple searches (and most
-            advanced searches).
-
-          ``index`` (*string*)
-            Optional unless ``default_index`` was not set.
-            The index to query.
-
-          ``limit`` (*int*)
-            Optional. The number of results to return.
-
-          ``offset`` (*int*)
-            Optional. An offset into the total result set for paging.
-
-          ``query_template`` (*string*)
-            Optional. A query_template name as defined within the Search
-            service.
-
-          ``advanced`` (*bool*)
-            Use simple query parsing vs. advanced query syntax when
-            interpreting ``q``. Defaults to False.
-
-          ``params``
-            Any additional query params to pass. For internal use only.
-        """
-        uri = slash_join(self._base_index_uri(index), 'search')
-        merge_params(params, q=q, limit=limit, offset=offset,
-                     query_template=query_template, advanced=advanced)
-        return self.get(uri, params=params)
-
-    def structured_search(self, data, index=None, **params):
-        """
-        Perform a structured, ``POST``-based, search.
-
-        **Parameters**
-
-          ``data`` (*dict*)
-            A valid GSearchRequest document to execute.
-
-          ``index`` (*string*)
-            Optional unless ``default_index`` was not set.
-            The index to query.
-
-          ``advanced`` (*bool*)
-            Use simple query parsing vs. advanced query syntax when
-            interpreting the query string. Defaults to False.
-
-          ``params``
-            Any additional query params to pass. For internal use only.
-        """
-        uri = slash_join(self._base_index_uri(index), 'search')
-        return self.post(uri, json_body=data, params=params)
-
-    def ingest(self, data, index=None, **params):
-        """
-        Perform a simple ``POST`` based ingest op.
-
-        **Parameters**
-
-          ``data`` (*dict*)
-            A valid GIngest document to index.
-
-          ``index`` (*string*)
-            Optional unless ``default_index`` was not set.
-            The search index to send data into.
-
-          ``params``
-            Any additional query params to pass. For internal use only.
-        """
-        uri = slash_join(self._base_index_uri(index), 'ingest')
-        return self.post(uri, json_body=data, params=params)
+def __getattr__(name):
+    """Import the clients when they are first used, since they need globus_sdk."""
+    if name == "SearchClient":
+        from mdf_forge.search_client import SearchClient
+        return SearchClient
+    raise AttributeError("module '" + __name__ + "' has no attribute '" + name + "'")
 
-    def remove(self, subject, index=None, **params):
-        uri = slash_join(self._base_index_uri(index), "subject")
-        params["subject"] = subject
-        return self.delete(uri, params=params)
 
+# Module __getattr__ is only supported from Python 3.7
+if sys.version_info < (3, 7):
+    from mdf_forge.search_client import SearchClient
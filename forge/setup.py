@@ -12,6 +12,9 @@ setup(
         "requests>=2.18.1",
         "tqdm>=4.14.0"
     ],
+    extras_require={
+        "async": ["aiohttp>=3.0"]
+    },
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Intended Audience :: Science/Research",
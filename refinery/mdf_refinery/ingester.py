@@ -2,12 +2,15 @@ import sys
 import json
 import os
 import multiprocessing
+from itertools import islice
 from queue import Empty
+import shutil
+import tempfile
 
 from tqdm import tqdm
 from globus_sdk import GlobusAPIError
 
-from mdf_forge.toolbox import format_gmeta, confidential_login
+from mdf_forge.toolbox import GIngestStream, confidential_login
 from mdf_refinery.config import PATH_FEEDSTOCK, PATH_CREDENTIALS
 
 
@@ -36,13 +39,16 @@ def ingest(mdf_source_names, globus_index, batch_size=100, verbose=False):
         ingest_client = confidential_login(credentials=creds)["search_ingest"]
 
 
+    # Batches are spooled to files, which the submitters stream to Search
+    spool_dir = tempfile.mkdtemp(prefix="mdf_ingest_")
+
     # Set up multiprocessing
     ingest_queue = multiprocessing.JoinableQueue()
     counter = multiprocessing.Value('i', 0)
     killswitch = multiprocessing.Value('i', 0)
 
     # One reader (can reduce performance on large datasets if multiple are submitted at once)
-    reader = multiprocessing.Process(target=queue_ingests, args=(ingest_queue, mdf_source_names, batch_size))
+    reader = multiprocessing.Process(target=queue_ingests, args=(ingest_queue, mdf_source_names, batch_size, spool_dir))
     # As many submitters as is feasible
     submitters = [multiprocessing.Process(target=process_ingests, args=(ingest_queue, ingest_client, counter, killswitch)) for i in range(NUM_SUBMITTERS)]
     prog_bar = multiprocessing.Process(target=track_progress, args=(counter, killswitch))
@@ -57,39 +63,37 @@ def ingest(mdf_source_names, globus_index, batch_size=100, verbose=False):
     [s.join() for s in submitters]
     if prog_bar.is_alive():
         prog_bar.join()
+    shutil.rmtree(spool_dir, ignore_errors=True)
 
     if verbose:
         print("Ingesting complete")
 
 
-def queue_ingests(ingest_queue, sources, batch_size):
+def queue_ingests(ingest_queue, sources, batch_size, spool_dir):
+    batch_num = 0
     for source_name in sources:
-        list_ingestables = []
         with open(os.path.join(PATH_FEEDSTOCK, source_name+"_all.json"), 'r') as feedstock:
-            for json_record in feedstock:
-                record = format_gmeta(json.loads(json_record))
-                list_ingestables.append(record)
-
-                if batch_size > 0 and len(list_ingestables) >= batch_size:
-                    full_ingest = format_gmeta(list_ingestables)
-                    ingest_queue.put(json.dumps(full_ingest))
-                    list_ingestables.clear()
-
-        # Check for partial batch to ingest
-        if list_ingestables:
-            full_ingest = format_gmeta(list_ingestables)
-            ingest_queue.put(json.dumps(full_ingest))
-            list_ingestables.clear()
+            records = (json.loads(json_record) for json_record in feedstock)
+            while True:
+                # Each batch is written as it is read, so only one record is in memory at a time
+                batch = GIngestStream(islice(records, batch_size) if batch_size > 0 else records)
+                batch_path = os.path.join(spool_dir, str(batch_num) + ".json")
+                if not batch.write(batch_path):
+                    os.remove(batch_path)
+                    break
+                ingest_queue.put(batch_path)
+                batch_num += 1
 
 
 def process_ingests(ingest_queue, ingest_client, counter, killswitch):
     while killswitch.value == 0:
         try:
-            ingestable = json.loads(ingest_queue.get(timeout=10))
+            batch_path = ingest_queue.get(timeout=10)
         except Empty:
             continue
         try:
-            res = ingest_client.ingest(ingestable)
+            with open(batch_path, 'rb') as ingestable:
+                res = ingest_client.ingest(ingestable)
             if not res["success"]:
                 raise ValueError("Ingest failed: " + str(res))
             elif res["num_documents_ingested"] <= 0:
@@ -97,6 +101,8 @@ def process_ingests(ingest_queue, ingest_client, counter, killswitch):
         except GlobusAPIError as e:
             print("\nA Globus API Error has occurred. Details:\n", e.raw_json, "\n")
             continue
+        finally:
+            os.remove(batch_path)
         with counter.get_lock():
             counter.value += 1
         ingest_queue.task_done()
@@ -0,0 +1,119 @@
+import asyncio
+import re
+import pytest
+import globus_sdk
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web
+from mdf_forge.async_forge import AsyncForge
+
+
+# Stand-in for Globus Search and the MDF data server
+# Records come from two sources, each with its own scroll_ids
+records = ([{"mdf": {"source_name": "src_a", "scroll_id": i, "links": {}}} for i in range(1, 251)]
+           + [{"mdf": {"source_name": "src_b", "scroll_id": i, "links": {}}} for i in range(1, 121)])
+files = {
+    "/test/file1.txt": b"first file\n",
+    "/test/file2.txt": b"second file\n",
+    "/test/latin1.txt": b"caf\xe9\n"
+    }
+
+
+async def search_handler(request):
+    body = await request.json()
+    matches = records
+    window = re.search(r"mdf.scroll_id:>=(\d+) AND mdf.scroll_id:<(\d+)", body["q"])
+    if window:
+        lo, hi = int(window.group(1)), int(window.group(2))
+        matches = [r for r in matches if lo <= r["mdf"]["scroll_id"] < hi]
+    # The stand-in returns at most 100 results per request
+    returned = matches[:min(body.get("limit", 10), 100)]
+    return web.json_response({
+        "@datatype": "GSearchResult",
+        "count": len(returned),
+        "total": len(matches),
+        "gmeta": [{"@datatype": "GMetaResult", "content": [r]} for r in returned]
+        })
+
+
+async def file_handler(request):
+    if request.path not in files:
+        return web.Response(status=404)
+    return web.Response(body=files[request.path])
+
+
+def run_with_server(test):
+    """Run a coroutine test function against the stand-in server."""
+    async def main():
+        app = web.Application()
+        app.router.add_post("/v1/index/mdf/search", search_handler)
+        app.router.add_get("/test/{name}", file_handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        url = "http://127.0.0.1:" + str(port)
+        try:
+            async with AsyncForge(search_url=url, search_authorizer=globus_sdk.NullAuthorizer(),
+                                  mdf_authorizer=globus_sdk.NullAuthorizer(), concurrency=4) as af:
+                await test(af, url)
+        finally:
+            await runner.cleanup()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+def test_async_search(capsys):
+    async def test(af, url):
+        # Error on no query
+        assert await af.search() == []
+        out, err = capsys.readouterr()
+        assert "Error: No query specified" in out
+        # Return info if requested
+        res, info = await af.match_sources("src_a").search(limit=5, info=True)
+        assert len(res) == 5
+        assert info["total_query_matches"] == len(records)
+        assert info["query"]["q"] == "(mdf.source_name:src_a)"
+        # Query was reset
+        assert await af.search() == []
+    run_with_server(test)
+
+
+def test_async_aggregate():
+    async def test(af, url):
+        res1 = await af.aggregate("mdf.source_name:src_a", scroll_size=100, workers=3)
+        assert len(res1) == len(records)
+        # Windows come back in scroll order, regardless of the number of workers
+        assert await af.aggregate("mdf.source_name:src_a", scroll_size=100, workers=1) == res1
+        # Streaming gives the same records
+        res2 = [r async for r in af.aggregate_iter("mdf.source_name:src_a", scroll_size=100)]
+        assert res2 == res1
+    run_with_server(test)
+
+
+def test_async_http_stream():
+    async def test(af, url):
+        results = [{"mdf": {"links": {"txt": {"http_host": url, "path": path}}}} for path in sorted(files)]
+        texts = [text async for text in af.http_stream(results)]
+        # Data that is not UTF-8 is decoded with replacement characters, as Forge.http_stream() does
+        assert texts == ["first file\n", "second file\n", "caf\ufffd\n"]
+    run_with_server(test)
+
+
+def test_async_authorizers(monkeypatch):
+    from mdf_forge import toolbox
+    calls = []
+
+    def get(name, *args):
+        calls.append(name)
+        return globus_sdk.NullAuthorizer() if name == "mdf" else type("Client", (), {"authorizer": name})()
+    monkeypatch.setattr(toolbox.CLIENTS, "get", get)
+    # A missing authorizer comes from the shared clients, even if the other is given
+    AsyncForge(search_authorizer=globus_sdk.NullAuthorizer())
+    assert calls == ["mdf"]
+    AsyncForge(mdf_authorizer=globus_sdk.NullAuthorizer())
+    assert calls == ["mdf", "search"]
@@ -1,4 +1,7 @@
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
 import os
+import threading
 import time
 import types
 import pytest
@@ -38,6 +41,35 @@ def test_query_field():
     assert q.advanced
 
 
+def test_query_tree():
+    q1 = forge.Query(query_search_client)
+    q1.field("mdf.source_name", "cip,oqmd").and_join(close_group=True).field("mdf.elements", "Al")
+    q1.and_join().field("mdf.elements", "Fe")
+    tree = q1.tree()
+    assert isinstance(tree, forge.QueryGroup)
+    assert tree.compile() == "(mdf.source_name:cip,oqmd) AND (mdf.elements:Al AND mdf.elements:Fe)"
+    # Equivalent queries share a canonical form
+    q2 = forge.Query(query_search_client)
+    q2.field("mdf.elements", "Fe").and_join().field("mdf.elements", "Al").and_join()
+    q2.field("mdf.elements", "Fe").and_join(close_group=True).field("mdf.source_name", "cip,oqmd")
+    assert q2.tree().canonical() == tree.canonical()
+    # Mixed operators keep their order
+    q3 = forge.Query(query_search_client).term("a").or_join().term("b").and_join().term("c")
+    assert q3.tree().canonical() == "a OR b AND c"
+    # Terms holding their own operators are not mixed with their neighbors
+    q4 = forge.Query(query_search_client).term("c").and_join().term("a OR b")
+    q5 = forge.Query(query_search_client).term("a OR b").and_join().term("c")
+    assert q4.tree().canonical() == "c AND a OR b"
+    assert q5.tree().canonical() != q4.tree().canonical()
+    # Sources can be split into separate queries
+    assert q1.split_sources() == ["(mdf.source_name:cip) AND (mdf.elements:Al AND mdf.elements:Fe)",
+                                  "(mdf.source_name:oqmd) AND (mdf.elements:Al AND mdf.elements:Fe)"]
+    assert q3.split_sources() == [q3.tree().compile()]
+    # The tree is immutable
+    with pytest.raises(AttributeError):
+        tree.items = ()
+
+
 def test_query_search(capsys):
     # Error on no query
     q1 = forge.Query(query_search_client)
@@ -69,6 +101,11 @@ def test_query_aggregate():
                         '(oqmd.configuration:static OR oqmd.configuration:standard) '
                         'AND oqmd.converged:True AND oqmd.band_gap.value:>2')
     assert isinstance(r[0], dict)
+    # Concurrent windows return the same records, in the same order
+    r2 = forge.Query(query_search_client).aggregate('mdf.source_name:oqmd AND '
+                        '(oqmd.configuration:static OR oqmd.configuration:standard) '
+                        'AND oqmd.converged:True AND oqmd.band_gap.value:>2', workers=4)
+    assert [rec["mdf"]["mdf_id"] for rec in r2] == [rec["mdf"]["mdf_id"] for rec in r]
 
 
 def test_query_chaining():
@@ -166,6 +203,65 @@ def test_forge_search(capsys):
     assert len(res4) == 3
 
 
+def test_forge_search_cache(tmp_path):
+    f = forge.Forge(cache=toolbox.SearchCache(path=str(tmp_path / "cache.sqlite")))
+    res1 = f.search("oqmd", limit=3)
+    # Repeat searches are served from the cache
+    assert f.search("oqmd", limit=3) == res1
+    assert f.search("oqmd", limit=3, refresh_cache=True) == res1
+    assert f.search("oqmd", limit=3, use_cache=False) == res1
+    # Aggregations are cached too
+    res2 = f.aggregate_source("hopv")
+    assert f.aggregate_source("hopv") == res2
+
+
+def test_forge_search_many():
+    f = forge.Forge()
+    queries = ["oqmd", {"q": "Al", "limit": 3}, "oqmd",
+               forge.Query(query_search_client).field("mdf.source_name", "cip")]
+    res = f.search_many(queries, limit=5, workers=4)
+    assert len(res) == 4
+    assert all(type(r) is list for r in res)
+    assert len(res[1]) == 3
+    # Identical queries share one result
+    assert res[0] is res[2]
+    assert res[1] == f.search("Al", limit=3)
+    res_info = f.search_many(["oqmd"], limit=1, info=True)
+    assert type(res_info[0]) is tuple
+
+
+def test_forge_count(capsys):
+    f = forge.Forge()
+    # Error on no query
+    assert f.count() == -1
+    out, err = capsys.readouterr()
+    assert "Error: No query specified" in out
+    res, info = f.match_sources("amcs").search(limit=1, info=True)
+    assert f.match_sources("amcs").count() == info["total_query_matches"]
+    # Query was reset
+    assert f.count() == -1
+
+
+def test_forge_facets():
+    f = forge.Forge()
+    res = f.facets(["mdf.source_name", "mdf.resource_type"], q="mdf.source_name:amcs", advanced=True, size=5)
+    assert list(res.keys()) == ["mdf.source_name", "mdf.resource_type"]
+    assert list(res["mdf.source_name"].keys()) == ["amcs"]
+    assert res["mdf.source_name"]["amcs"] == f.count("mdf.source_name:amcs", advanced=True)
+    assert len(res["mdf.resource_type"]) <= 5
+    # Single field
+    assert f.facets("mdf.source_name", q="mdf.source_name:amcs", advanced=True) == {"mdf.source_name": res["mdf.source_name"]}
+
+
+def test_forge_search_fields():
+    f = forge.Forge()
+    full = f.search("mdf.source_name:amcs", advanced=True, limit=5)
+    res = f.search("mdf.source_name:amcs", advanced=True, limit=5, fields=["mdf.mdf_id", "mdf.links"])
+    assert res == [{"mdf": {k: v for k, v in r["mdf"].items() if k in ["mdf_id", "links"]}} for r in full]
+    agg = f.aggregate_source("amcs", fields="mdf.scroll_id")
+    assert all(list(r.keys()) == ["mdf"] and list(r["mdf"].keys()) == ["scroll_id"] for r in agg)
+
+
 def test_forge_search_by_elements():
     f1 = forge.Forge()
     f2 = forge.Forge()
@@ -193,6 +289,21 @@ def test_forge_aggregate():
     assert isinstance(r[0], dict)
 
 
+def test_forge_aggregate_iter():
+    f = forge.Forge()
+    q = ('mdf.source_name:oqmd AND '
+         '(oqmd.configuration:static OR oqmd.configuration:standard) '
+         'AND oqmd.converged:True AND oqmd.band_gap.value:>2')
+    res1 = f.aggregate_iter(q)
+    assert isinstance(res1, types.GeneratorType)
+    assert isinstance(next(res1), dict)
+    # Pages and records cover the same results
+    records = list(f.aggregate_iter(q, workers=2))
+    pages = list(f.aggregate_iter(q, pages=True))
+    assert all(isinstance(page, list) for page in pages)
+    assert sum(len(page) for page in pages) == len(records)
+
+
 def test_forge_reset_query():
     f = forge.Forge()
     # Term will return results
@@ -220,6 +331,82 @@ def test_forge_http_download():
     assert os.path.exists(os.path.join(dest_path, "test_multifetch.txt"))
     os.remove(os.path.join(dest_path, "test_fetch.txt"))
     os.remove(os.path.join(dest_path, "test_multifetch.txt"))
+    # Records sharing a file only download it once
+    res1 = f.http_download(example_result1 * 12, dest=dest_path, workers=4, per_host=2)
+    assert res1 == [{"txt": os.path.join(dest_path, "test_fetch.txt")}] * 12
+    assert os.path.exists(os.path.join(dest_path, "test_fetch.txt"))
+    assert not os.path.exists(os.path.join(dest_path, "test_fetch(1).txt"))
+    os.remove(os.path.join(dest_path, "test_fetch.txt"))
+    # From a plan
+    plan = f.plan_download(example_result2, dest=dest_path)
+    assert f.http_download(plan) == plan.record_paths
+    for local_path in plan.files.values():
+        assert os.path.exists(local_path)
+        os.remove(local_path)
+    # Error on a plan for another service
+    assert f.http_download(f.plan_download(example_result1, service="globus")) == []
+    # Metrics, through a callback and a summary
+    events = []
+    paths, summary = f.http_download(example_result2, dest=dest_path, callback=events.append, info=True)
+    assert [e["event"] for e in events] == ["file", "file"]
+    assert summary.files_completed == 2 and summary.files_failed == 0
+    assert summary.bytes == sum(os.path.getsize(p["txt"]) for p in paths)
+    assert list(summary.hosts) == ["data.materialsdatafacility.org"]
+    for p in paths:
+        os.remove(p["txt"])
+    # Sync only downloads files again if they changed
+    f.http_download(example_result2, dest=dest_path, sync=True)
+    assert os.path.exists(os.path.join(dest_path, forge.SYNC_MANIFEST_NAME))
+    with open(os.path.join(dest_path, "test_fetch.txt"), "w") as edited:
+        edited.write("edited")
+    mtime = os.path.getmtime(os.path.join(dest_path, "test_multifetch.txt"))
+    time.sleep(1)
+    f.http_download(example_result2, dest=dest_path, sync=True)
+    assert os.path.getmtime(os.path.join(dest_path, "test_multifetch.txt")) == mtime
+    with open(os.path.join(dest_path, "test_fetch.txt")) as refreshed:
+        assert refreshed.read() == "This is a test document for Forge testing. Please do not remove.\n"
+    assert not os.path.exists(os.path.join(dest_path, "test_fetch(1).txt"))
+    os.remove(os.path.join(dest_path, "test_fetch.txt"))
+    os.remove(os.path.join(dest_path, "test_multifetch.txt"))
+    os.remove(os.path.join(dest_path, forge.SYNC_MANIFEST_NAME))
+
+
+
+def test_forge_http_download_checksum(monkeypatch, tmp_path, capsys):
+    class FileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = self.path[1:].encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(("127.0.0.1", 0), FileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = "http://127.0.0.1:" + str(server.server_port)
+    # No login is needed to download from a local server
+    monkeypatch.setattr(toolbox.CLIENTS, "get", lambda *args: None)
+    f = forge.Forge()
+    results = [{"mdf": {"links": {
+        "good": {"http_host": host, "path": "/good", "sha256": hashlib.sha256(b"good").hexdigest()},
+        "bad": {"http_host": host, "path": "/bad", "md5": hashlib.md5(b"other").hexdigest()},
+        "plain": {"http_host": host, "path": "/plain"}
+        }}}]
+    dest = str(tmp_path)
+    # Files that do not match the checksum in their link are reported, and not saved
+    paths, summary = f.http_download(results, dest=dest, verbose=False, info=True)
+    out, err = capsys.readouterr()
+    assert "md5 checksum of '" + host + "/bad' does not match" in out
+    assert summary.files_completed == 2 and summary.files_failed == 1
+    assert not os.path.exists(paths[0]["bad"])
+    with open(paths[0]["good"]) as good:
+        assert good.read() == "good"
+    # Unless verification is off
+    paths = f.http_download(results, dest=dest, verbose=False, verify=False)
+    with open(paths[0]["bad"]) as bad:
+        assert bad.read() == "bad"
+    server.shutdown()
 
 
 def test_forge_globus_download():
@@ -240,9 +427,93 @@ def test_forge_globus_download():
     assert os.path.exists(os.path.join(dest_path, "test_multifetch.txt"))
     os.remove(os.path.join(dest_path, "test_fetch.txt"))
     os.remove(os.path.join(dest_path, "test_multifetch.txt"))
+    # Metrics, through a callback and a summary
+    events = []
+    res2, summary = f.globus_download(example_result1, dest=dest_path, callback=events.append, info=True)
+    assert set(summary.tasks) == set(res2)
+    assert all(task["status"] == "SUCCEEDED" for task in summary.tasks.values())
+    assert events[-1]["event"] == "task" and summary.files_completed == 1
+    os.remove(os.path.join(dest_path, "test_fetch.txt"))
+    # Sync replaces files that changed, instead of renaming
+    f.globus_download(example_result1, dest=dest_path)
+    with open(os.path.join(dest_path, "test_fetch.txt"), "w") as edited:
+        edited.write("edited")
+    f.globus_download(example_result1, dest=dest_path, sync="checksum")
+    assert not os.path.exists(os.path.join(dest_path, "test_fetch(1).txt"))
+    with open(os.path.join(dest_path, "test_fetch.txt")) as refreshed:
+        assert refreshed.read() == "This is a test document for Forge testing. Please do not remove.\n"
+    os.remove(os.path.join(dest_path, "test_fetch.txt"))
 
 
-def test_forge_http_stream():
+def test_forge_wait_for_transfers(monkeypatch, capsys):
+    class TestTransferClient():
+        def task_list(self, num_results, filter):
+            # "missing" is never listed, as for a wrong ID or another identity's task
+            return [{"task_id": task_id, "status": "SUCCEEDED", "files": 1, "files_transferred": 1,
+                     "files_skipped": 0} for task_id in filter[len("task_id:"):].split(",") if task_id != "missing"]
+    f = forge.Forge()
+    monkeypatch.setattr(f, "_Forge__transfer_client", TestTransferClient())
+    monkeypatch.setattr(forge.time, "sleep", lambda seconds: pytest.fail("Waited for a task that does not exist"))
+    f._Forge__wait_for_transfers(["found", "missing"], verbose=False)
+    out, err = capsys.readouterr()
+    assert "Error: Transfer task missing was not found" in out
+    assert "Transfer task found" not in out
+
+
+def test_batch_transfer_items():
+    items = [("/source/" + str(i), "/dest/" + str(i)) for i in range(10)]
+    # Bounded by items
+    assert [len(b) for b in forge._batch_transfer_items(items, max_items=4)] == [4, 4, 2]
+    # Bounded by request size
+    assert [len(b) for b in forge._batch_transfer_items(items, max_bytes=400)] == [3, 3, 3, 1]
+    # All items are kept, in order
+    assert sum(forge._batch_transfer_items(items, max_items=3), []) == items
+    assert list(forge._batch_transfer_items(items)) == [items]
+
+
+def test_plan_downloads(tmp_path):
+    dest = str(tmp_path)
+    shared = {"globus_endpoint": "ep1", "http_host": "https://host1", "path": "/data/archive.tar"}
+    results = [
+        {"mdf": {"links": {"landing_page": "https://example.com", "data": shared,
+                           "meta": {"globus_endpoint": "ep1", "http_host": "https://host1", "path": "/a/meta.json"}}}},
+        {"mdf": {"links": {"data": shared,
+                           "meta": {"globus_endpoint": "ep1", "http_host": "https://host1", "path": "/b/meta.json"}}}},
+        {"mdf": {"links": {"data": dict(shared, globus_endpoint="ep2", http_host="https://host2")}}}
+        ]
+    # Each (host, path) is fetched once, and names only collide between different files
+    plan = forge._plan_downloads(results, dest, False, "http")
+    assert plan.service == "http"
+    assert list(plan.files.items()) == [
+        (("https://host1", "/data/archive.tar"), os.path.join(dest, "archive.tar")),
+        (("https://host1", "/a/meta.json"), os.path.join(dest, "meta.json")),
+        (("https://host1", "/b/meta.json"), os.path.join(dest, "meta(1).json")),
+        (("https://host2", "/data/archive.tar"), os.path.join(dest, "archive(1).tar"))
+        ]
+    # Every record maps to its files
+    assert plan.record_paths == [
+        {"data": os.path.join(dest, "archive.tar"), "meta": os.path.join(dest, "meta.json")},
+        {"data": os.path.join(dest, "archive.tar"), "meta": os.path.join(dest, "meta(1).json")},
+        {"data": os.path.join(dest, "archive(1).tar")}
+        ]
+    # Directories are kept, and Globus paths are absolute
+    plan = forge._plan_downloads(results, os.path.relpath(dest), True, "globus")
+    assert plan.files[("ep1", "/a/meta.json")] == os.path.join(dest, "a", "meta.json")
+    assert plan.files[("ep2", "/data/archive.tar")] == os.path.join(dest, "data", "archive.tar")
+    assert len(plan.files) == 4
+    # Checksums are taken from the links that carry them
+    results[0]["mdf"]["links"]["meta"]["md5"] = "abc"
+    assert forge._plan_downloads(results, dest, False, "http").checksums == {("https://host1", "/a/meta.json"): ("md5", "abc")}
+    # Planning does not touch the filesystem; directories are made when the plan is downloaded
+    assert not os.path.exists(os.path.join(dest, "b"))
+    forge._make_download_dirs(plan)
+    assert os.path.isdir(os.path.join(dest, "b"))
+    # Error on unknown service
+    with pytest.raises(ValueError):
+        forge._plan_downloads(results, dest, False, "ftp")
+
+
+def test_forge_http_stream(monkeypatch):
     f = forge.Forge()
     # Simple case
     res1 = f.http_stream(example_result1)
@@ -253,6 +524,26 @@ def test_forge_http_stream():
     assert isinstance(res2, types.GeneratorType)
     assert res2.__next__() == "This is a test document for Forge testing. Please do not remove.\n"
     assert res2.__next__() == "This is a second test document for Forge testing. Please do not remove.\n"
+    # Bytes and files, with and without prefetching
+    res3 = list(f.http_stream(example_result2, output="bytes", prefetch=0))
+    assert res3 == [b"This is a test document for Forge testing. Please do not remove.\n",
+                    b"This is a second test document for Forge testing. Please do not remove.\n"]
+    res4 = list(f.http_stream(example_result2, output="file", decompress=True))
+    assert [r.read() for r in res4] == res3
+    for r in res4:
+        r.close()
+    # Files fetched ahead are closed if the consumer stops early
+    spooled = []
+    temporary_file = forge.tempfile.TemporaryFile
+    monkeypatch.setattr(forge.tempfile, "TemporaryFile", lambda: spooled.append(temporary_file()) or spooled[-1])
+    res5 = f.http_stream(example_result2, output="file", use_cache=False)
+    next(res5).close()
+    res5.close()
+    assert len(spooled) == 2
+    assert all(t.closed for t in spooled)
+    # Error on bad output
+    with pytest.raises(ValueError):
+        next(f.http_stream(example_result1, output="json"))
 
 
 def test_forge_http_return():
@@ -267,6 +558,22 @@ def test_forge_http_return():
     assert res2 == ["This is a test document for Forge testing. Please do not remove.\n", "This is a second test document for Forge testing. Please do not remove.\n"]
 
 
+def test_forge_data_cache(tmp_path):
+    data_cache = toolbox.DataCache(path=str(tmp_path / "data"))
+    f = forge.Forge(data_cache=data_cache)
+    assert f.data_cache is data_cache
+    res1 = f.http_return(example_result2)
+    # Files are cached
+    url = example_result1[0]["mdf"]["links"]["txt"]["http_host"] + example_result1[0]["mdf"]["links"]["txt"]["path"]
+    assert os.path.exists(data_cache.file_path(url))
+    # Cached files are the same
+    assert f.http_return(example_result2) == res1
+    assert f.http_return(example_result2, use_cache=False) == res1
+    f.http_download(example_result1, dest=str(tmp_path))
+    with open(str(tmp_path / "test_fetch.txt")) as test_file:
+        assert test_file.read() == res1[0]
+
+
 def test_forge_chaining():
     f1 = forge.Forge()
     f1.match_field("source_name", "cip")
@@ -0,0 +1,54 @@
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+
+# The most modules a fresh import of each module may load, dependencies included
+# Raise these only when a new import is worth its startup cost
+MODULE_LIMITS = {
+    "mdf_forge": 5,
+    "mdf_forge.toolbox": 40,
+    "mdf_forge.forge": 45
+    }
+# Dependencies that must not be imported until they are used
+LAZY_MODULES = ["globus_sdk", "requests", "tqdm", "tarfile", "zipfile", "gzip", "sqlite3", "tempfile"]
+
+
+def measure_import(module):
+    """Import a module in a fresh interpreter.
+
+    Returns:
+    dict: The "seconds" the import took, and the "modules" it loaded.
+    """
+    code = ("import json, sys, time\n"
+            "before = set(sys.modules)\n"
+            "start = time.perf_counter()\n"
+            "import " + module + "\n"
+            "seconds = time.perf_counter() - start\n"
+            "print(json.dumps({'seconds': seconds, 'modules': sorted(set(sys.modules) - before)}))\n")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = subprocess.check_output([sys.executable, "-c", code], env=env)
+    return json.loads(output.decode("utf-8"))
+
+
+@pytest.mark.parametrize("module", sorted(MODULE_LIMITS))
+def test_import_time(module):
+    result = measure_import(module)
+    # Reported for tracking startup time (see with pytest -s)
+    print(module, "imported", len(result["modules"]), "modules in", round(result["seconds"] * 1000, 1), "ms")
+    assert len(result["modules"]) <= MODULE_LIMITS[module]
+    assert [name for name in LAZY_MODULES if name in result["modules"]] == []
+
+
+def test_lazy_attributes():
+    import mdf_forge
+    from mdf_forge import toolbox
+    assert mdf_forge.toolbox is toolbox
+    from mdf_forge.toolbox import SearchClient
+    assert toolbox.SearchClient is SearchClient
+    with pytest.raises(AttributeError):
+        toolbox.NotAClient
+    with pytest.raises(AttributeError):
+        mdf_forge.not_a_module
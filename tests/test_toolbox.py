@@ -1,5 +1,10 @@
 import os
+import hashlib
 import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 import pytest
 import globus_sdk
 from mdf_forge import toolbox
@@ -22,6 +27,46 @@ def test_confidential_login():
 same as login
 '''
 
+def test_client_registry(monkeypatch, tmp_path):
+    monkeypatch.setattr(toolbox, "CRED_PATH", str(tmp_path))
+    # Unexpired access tokens are used without contacting Globus Auth
+    expires = int(time.time()) + 3600
+    tokens = {server: {"access_token": "access-" + server, "refresh_token": "refresh-" + server,
+                       "expires_at_seconds": expires}
+              for server in set(toolbox.RESOURCE_SERVERS.values())}
+    with open(str(tmp_path / "Test_App_tokens.json"), "w") as token_file:
+        json.dump(tokens, token_file)
+    registry = toolbox.ClientRegistry()
+    services = ["search", "transfer", "mdf"]
+    search = registry.get("search", "Test_App", services, index="mdf")
+    assert isinstance(search, toolbox.SearchClient)
+    assert search.default_index == "mdf"
+    headers = {}
+    search.authorizer.set_authorization_header(headers)
+    assert headers["Authorization"] == "Bearer access-search.api.globus.org"
+    # Clients are shared, and created on demand from the tokens in memory
+    os.remove(str(tmp_path / "Test_App_tokens.json"))
+    assert registry.get("search", "Test_App", services, index="mdf") is search
+    assert registry.get("search", "Test_App", services, index="other") is not search
+    transfer = registry.get("transfer", "Test_App", services)
+    assert isinstance(transfer, globus_sdk.TransferClient)
+    assert registry.get("mdf", "Test_App", services).access_token == "access-data.materialsdatafacility.org"
+    # Error on services that were not requested
+    with pytest.raises(ValueError):
+        registry.get("search_ingest", "Test_App", services)
+    # Children of a fork keep the clients, with their own connections
+    session = transfer._session
+    registry.after_fork()
+    assert registry.get("transfer", "Test_App", services) is transfer
+    assert transfer._session is not session
+    assert registry.get("search", "Test_App", services, index="mdf").authorizer.access_token == "access-search.api.globus.org"
+    # Clearing the registry forgets the clients and tokens
+    registry.clear()
+    with open(str(tmp_path / "Test_App_tokens.json"), "w") as token_file:
+        json.dump(tokens, token_file)
+    assert registry.get("transfer", "Test_App", services) is not transfer
+
+
 def test_find_files():
     root = os.path.join(os.path.dirname(__file__), "testing_files")
     # Get everything
@@ -50,6 +95,44 @@ def test_find_files():
     assert fn3 == correct3
 
 
+def test_find_files_scan(monkeypatch, tmp_path):
+    root = str(tmp_path / "tree")
+    for sub in ["", "a", os.path.join("a", "b"), "c"]:
+        os.makedirs(os.path.join(root, sub), exist_ok=True)
+        for i in range(3):
+            open(os.path.join(root, sub, "file" + str(i) + ".txt"), "w").close()
+        open(os.path.join(root, sub, "other.dat"), "w").close()
+    res1 = list(toolbox.find_files(root, "txt$"))
+    assert len(res1) == 12
+    # Records are tuples, and can also be read by name
+    path, filename, no_root_path = res1[0]
+    assert res1[0]["filename"] == filename and res1[0].no_root_path == no_root_path
+    assert dict(res1[0]) == {"path": path, "filename": filename, "no_root_path": no_root_path}
+    with pytest.raises(KeyError):
+        res1[0]["count"]
+    # Workers give the same results, in the same order
+    assert list(toolbox.find_files(root, "txt$", workers=4)) == res1
+
+    # Directories not changed since the last scan are not listed again
+    manifest = str(tmp_path / "scan.json")
+    for sub in ["", "a", os.path.join("a", "b"), "c"]:
+        os.utime(os.path.join(root, sub), (time.time() - 60, time.time() - 60))
+    assert list(toolbox.find_files(root, "txt$", manifest=manifest)) == res1
+    listed = []
+    scandir = os.scandir
+    def counting_scandir(path):
+        listed.append(path)
+        return scandir(path)
+    monkeypatch.setattr(os, "scandir", counting_scandir)
+    assert list(toolbox.find_files(root, "txt$", manifest=manifest, workers=2)) == res1
+    assert listed == []
+    # Changed directories are
+    open(os.path.join(root, "a", "file3.txt"), "w").close()
+    res2 = list(toolbox.find_files(root, "txt$", manifest=manifest))
+    assert len(res2) == 13
+    assert listed == [os.path.join(root, "a")]
+
+
 def test_uncompress_tree():
     root = os.path.join(os.path.dirname(__file__), "testing_files")
     toolbox.uncompress_tree(root)
@@ -58,6 +141,101 @@ def test_uncompress_tree():
     os.remove(path)
 
 
+def test_uncompress_tree_formats(monkeypatch, tmp_path, capsys):
+    import bz2, gzip, io, lzma, tarfile, zipfile
+    root = str(tmp_path)
+    data = os.urandom(2**21)
+    os.makedirs(os.path.join(root, "sub"))
+    with gzip.open(os.path.join(root, "data.bin.gz"), "wb") as out:
+        out.write(data)
+    with bz2.open(os.path.join(root, "sub", "data.bz2"), "wb") as out:
+        out.write(data)
+    with lzma.open(os.path.join(root, "sub", "other.xz"), "wb") as out:
+        out.write(data)
+    # Both would be decompressed to sub/dup
+    with bz2.open(os.path.join(root, "sub", "dup.bz2"), "wb") as out:
+        out.write(b"bz2")
+    with lzma.open(os.path.join(root, "sub", "dup.xz"), "wb") as out:
+        out.write(b"xz")
+    with tarfile.open(os.path.join(root, "archive.tgz"), "w:gz") as tar:
+        info = tarfile.TarInfo("tarred/data.txt")
+        info.size = 5
+        tar.addfile(info, io.BytesIO(b"tarry"))
+    with zipfile.ZipFile(os.path.join(root, "sub", "archive.zip"), "w") as z:
+        z.writestr("zipped.txt", "zippy")
+    with open(os.path.join(root, "plain.txt"), "w") as out:
+        out.write("not compressed")
+    with open(os.path.join(root, "broken.gz"), "wb") as out:
+        out.write(b"\x1f\x8b" + b"\x00" * 100)
+
+    manifest = str(tmp_path / "extracted.json")
+    toolbox.uncompress_tree(root, workers=2, manifest=manifest)
+    for path in ["data.bin", os.path.join("sub", "data"), os.path.join("sub", "other")]:
+        with open(os.path.join(root, path), "rb") as in_file:
+            assert in_file.read() == data
+    with open(os.path.join(root, "tarred", "data.txt")) as in_file:
+        assert in_file.read() == "tarry"
+    with open(os.path.join(root, "sub", "zipped.txt")) as in_file:
+        assert in_file.read() == "zippy"
+    out, err = capsys.readouterr()
+    assert "Error: Unable to uncompress '" + os.path.join(root, "broken.gz") in out
+    assert "Error: Unable to uncompress '" + os.path.join(root, "sub", "dup.bz2") in out
+    assert "Error: Unable to uncompress '" + os.path.join(root, "sub", "dup.xz") in out
+    assert not os.path.exists(os.path.join(root, "sub", "dup"))
+    assert not [name for name in os.listdir(root) if ".part" in name]
+
+    # Unchanged files are skipped without being opened
+    processed = []
+    sniff_file = toolbox._sniff_file
+    def recording_sniff(abs_path):
+        processed.append(os.path.relpath(abs_path, root))
+        return sniff_file(abs_path)
+    monkeypatch.setattr(toolbox, "_sniff_file", recording_sniff)
+    toolbox.uncompress_tree(root, workers=1, manifest=manifest)
+    # Only the failed files, and the outputs of the first run (which are not compressed), are checked
+    failed = ["broken.gz", os.path.join("sub", "dup.bz2"), os.path.join("sub", "dup.xz")]
+    assert set(failed) <= set(processed)
+    assert not set(processed) & {"data.bin.gz", "plain.txt", "archive.tgz", os.path.join("sub", "archive.zip")}
+    processed.clear()
+    toolbox.uncompress_tree(root, workers=1, manifest=manifest)
+    assert sorted(processed) == failed
+    # Files whose outputs are missing are processed again
+    os.remove(os.path.join(root, "sub", "zipped.txt"))
+    processed.clear()
+    toolbox.uncompress_tree(root, workers=1, manifest=manifest)
+    assert sorted(processed) == sorted(failed + [os.path.join("sub", "archive.zip")])
+    assert os.path.isfile(os.path.join(root, "sub", "zipped.txt"))
+
+    # Without a manifest, existing outputs are not replaced
+    with open(os.path.join(root, "data.bin"), "w") as out:
+        out.write("changed")
+    toolbox.uncompress_tree(root, workers=1)
+    with open(os.path.join(root, "data.bin")) as in_file:
+        assert in_file.read() == "changed"
+
+
+def test_destination_index(tmp_path):
+    root = str(tmp_path)
+    for name in ["OUTCAR", "data.txt", "data(1).txt"]:
+        open(os.path.join(root, name), "w").close()
+    index = toolbox.DestinationIndex()
+    # Existing and already claimed names get a collision number before the extension
+    assert index.claim(os.path.join(root, "OUTCAR")) == os.path.join(root, "OUTCAR(1)")
+    assert index.claim(os.path.join(root, "OUTCAR")) == os.path.join(root, "OUTCAR(2)")
+    assert index.claim(os.path.join(root, "data.txt")) == os.path.join(root, "data(2).txt")
+    assert index.claim(os.path.join(root, "new.tar.gz")) == os.path.join(root, "new.tar.gz")
+    assert index.claim(os.path.join(root, "new.tar.gz")) == os.path.join(root, "new.tar(1).gz")
+    assert index.claim(os.path.join(root, "data.txt"), rename=False) == os.path.join(root, "data.txt")
+    # Directories that do not exist yet have no names taken, and are not created
+    assert index.claim(os.path.join(root, "a", "b", "OUTCAR")) == os.path.join(root, "a", "b", "OUTCAR")
+    assert index.claim(os.path.join(root, "a", "OUTCAR")) == os.path.join(root, "a", "OUTCAR")
+    assert not os.path.exists(os.path.join(root, "a"))
+    # Existing files can be claimed again, for replacing
+    index = toolbox.DestinationIndex(existing=False)
+    assert index.claim(os.path.join(root, "OUTCAR")) == os.path.join(root, "OUTCAR")
+    assert index.claim(os.path.join(root, "OUTCAR")) == os.path.join(root, "OUTCAR(1)")
+
+
 def test_format_gmeta():
     # Simple GMetaEntry
     md1 = {
@@ -239,6 +417,576 @@ def test_gmeta_pop():
     info_pop = toolbox.gmeta_pop(ghttp, info=True)
     print(info_pop)
     assert info_pop == (popped, {'total_query_matches': 22})
+    # Field projection
+    links_pop = toolbox.gmeta_pop(ghttp, fields=["mdf.links.txt.path", "mdf.mdf_id"])
+    assert links_pop == [{"mdf": {"links": {"txt": {"path": "/test/test_fetch.txt"}}}}] * 2
+    # Whole subtrees override their fields
+    assert toolbox.gmeta_pop(ghttp, fields=["mdf", "mdf.links.txt"]) == popped
+    assert toolbox.project({"a": [{"b": 1, "c": 2}, 3], "d": 4}, toolbox.compile_projection("a.b")) == {"a": [{"b": 1}]}
+
+
+def test_gmeta_stream():
+    result = {
+        "@datatype": "GSearchResult",
+        "count": 3,
+        "gmeta": [{
+            "@datatype": "GMetaResult",
+            "content": [{"mdf": {"mdf_id": "1", "title": "\u00e9" * 10}}, {"mdf": {"mdf_id": "2", "title": ""}}],
+            "subject": "1"
+            }, {
+            "@datatype": "GMetaResult",
+            "content": [{"mdf": {"mdf_id": "3", "title": None}}],
+            "subject": "3"
+            }],
+        "offset": 0,
+        "total": 12345
+        }
+    text = json.dumps(result, indent=2).encode("utf-8")
+    # Any chunking gives the same records, including chunks that split characters and numbers
+    for size in [1, 7, len(text)]:
+        stream = toolbox.GMetaStream([text[i:i+size] for i in range(0, len(text), size)])
+        assert list(stream) == toolbox.gmeta_pop(result)
+        assert stream.info == {"@datatype": "GSearchResult", "count": 3, "offset": 0, "total": 12345}
+    assert list(toolbox.GMetaStream(text, fields=["mdf.mdf_id"])) == [{"mdf": {"mdf_id": str(i)}} for i in range(1, 4)]
+    assert toolbox.gmeta_pop(text.decode("utf-8"), info=True) == (toolbox.gmeta_pop(result), {"total_query_matches": 12345})
+    # Error on truncated results
+    with pytest.raises(ValueError):
+        list(toolbox.GMetaStream(text[:-20]))
+
+
+def test_gingest_stream(tmp_path):
+    from mdf_forge.search_client import SearchClient
+    records = [{"mdf": {"links": {"landing_page": "https://example.com/" + str(i)}, "acl": ["public"],
+                        "title": "\u00e9" * (i % 50)}} for i in range(500)]
+    expected = json.dumps(toolbox.format_gmeta([toolbox.format_gmeta(json.loads(json.dumps(r))) for r in records]))
+    # Records are formatted as they are read, and come out as format_gmeta() would make them
+    stream = toolbox.GIngestStream(json.loads(json.dumps(r)) for r in records)
+    chunks = list(stream)
+    assert b"".join(chunks) == expected.encode("utf-8")
+    assert len(chunks) > 1
+    assert stream.count == 500
+    # GMetaEntries are kept as they are
+    entries = [toolbox.format_gmeta(json.loads(json.dumps(r))) for r in records[:3]]
+    assert b"".join(toolbox.GIngestStream(entries)) == json.dumps(toolbox.format_gmeta(entries)).encode("utf-8")
+    assert b"".join(toolbox.GIngestStream([])) == json.dumps(toolbox.format_gmeta([])).encode("utf-8")
+    path = str(tmp_path / "batch.json")
+    assert toolbox.GIngestStream(json.loads(json.dumps(r)) for r in records).write(path) == 500
+    with open(path) as in_file:
+        assert in_file.read() == expected
+
+    # Streams are sent chunked, and files as they are read
+    server = _FileServer()
+    client = SearchClient(base_url=server.url, default_index="test", authorizer=globus_sdk.NullAuthorizer())
+    res = client.ingest(toolbox.GIngestStream(json.loads(json.dumps(r)) for r in records))
+    assert res["num_documents_ingested"] == 500
+    with open(path, "rb") as in_file:
+        assert client.ingest(in_file)["num_documents_ingested"] == 500
+    assert client.ingest(json.loads(expected))["success"]
+    assert [(path, chunked) for path, chunked, body in server.posts] == [("/v1/index/test/ingest", True),
+                                                                        ("/v1/index/test/ingest", False),
+                                                                        ("/v1/index/test/ingest", False)]
+    assert all(json.loads(body.decode("utf-8")) == json.loads(expected) for path, chunked, body in server.posts)
+    server.shutdown()
+
+
+def test_search_client_pool_size():
+    from mdf_forge.search_client import SearchClient
+    client = SearchClient(default_index="test", authorizer=globus_sdk.NullAuthorizer())
+    # The pool only grows, and the adapter it replaces is closed
+    adapter = client._session.get_adapter(client.base_url)
+    client.set_pool_size(1)
+    assert client._session.get_adapter(client.base_url) is adapter
+    closed = []
+    adapter.close = lambda: closed.append(adapter)
+    client.set_pool_size(32)
+    bigger = client._session.get_adapter(client.base_url)
+    assert bigger is not adapter and closed == [adapter]
+    client.set_pool_size(8)
+    assert client._session.get_adapter(client.base_url) is bigger
+
+
+def test_search_cache(tmp_path):
+    cache = toolbox.SearchCache(path=str(tmp_path / "cache.sqlite"), max_bytes=100)
+    key1 = cache.make_key("search", "mdf", {"q": "Al", "advanced": False, "limit": 10})
+    # Keys are independent of dict ordering
+    assert key1 == cache.make_key("search", "mdf", {"limit": 10, "advanced": False, "q": "Al"})
+    assert cache.get(key1) is None
+    cache.put(key1, [[1, 2], [3]])
+    assert list(cache.get(key1)) == [[1, 2], [3]]
+
+    # Unfinished entries are not cached
+    gen = cache.store("partial", [[1], [2]])
+    next(gen)
+    gen.close()
+    assert cache.get("partial") is None
+    # Their pages are removed
+    import sqlite3
+    db = sqlite3.connect(cache.path)
+    assert db.execute("SELECT COUNT(*) FROM pages WHERE key LIKE 'partial%'").fetchone()[0] == 0
+    # Concurrent stores of one key do not mix their pages
+    gen1 = cache.store("shared", [["a1"], ["a2"]])
+    gen2 = cache.store("shared", [["b1"], ["b2"], ["b3"]])
+    assert next(gen1) == ["a1"] and next(gen2) == ["b1"]
+    list(gen1)
+    assert list(cache.get("shared")) == [["a1"], ["a2"]]
+    list(gen2)
+    assert list(cache.get("shared")) == [["b1"], ["b2"], ["b3"]]
+    db.close()
+    # A reader that stops partway holds no lock on the database
+    reader = cache.get("shared")
+    assert next(reader) == ["b1"]
+    db = sqlite3.connect(cache.path, timeout=0)
+    db.execute("BEGIN EXCLUSIVE")
+    db.rollback()
+    db.close()
+    # Entries replaced while they are read are not mixed with their replacement
+    cache.put("shared", [["c1"]])
+    with pytest.raises(LookupError):
+        next(reader)
+
+    # Least recently used entries are evicted past max_bytes
+    cache.put("big1", [["x" * 60]])
+    list(cache.get(key1))
+    cache.put("big2", [["y" * 60]])
+    assert cache.get("big1") is None
+    assert cache.get(key1) is not None
+
+    # Expired entries are not returned
+    cache.ttl = -1
+    assert cache.get(key1) is None
+
+
+def test_scroll_planner(monkeypatch, tmp_path):
+    plan_path = str(tmp_path / "plans.json")
+    planner = toolbox.ScrollPlanner("q", target=100, path=plan_path)
+    # Nothing known: assume one record per scroll_id
+    assert planner.plan(1) == (100, False)
+    # Dense window: narrow the next guess
+    planner.observe(1, 101, 400)
+    assert planner.plan(101) == (25, False)
+    # Known windows are packed together while they fit
+    planner.observe(1, 26, 100)
+    planner.observe(26, 51, 0)
+    planner.observe(51, 76, 0)
+    assert planner.plan(1) == (75, True)
+    assert planner.plan(26) == (50, True)
+    # Newer observations replace overlapping ones
+    planner.observe(26, 76, 120)
+    assert planner.plan(26)[1] is False
+
+    # Observations persist per key
+    planner.save()
+    assert toolbox.ScrollPlanner("q", target=100, path=plan_path).plan(1) == (25, True)
+    assert toolbox.ScrollPlanner("other", target=100, path=plan_path).plan(1) == (100, False)
+    # Planners saving the same file keep each other's observations
+    planner1 = toolbox.ScrollPlanner("q", target=100, path=plan_path)
+    planner2 = toolbox.ScrollPlanner("q", target=100, path=plan_path)
+    planner1.observe(1000, 1100, 50)
+    planner2.observe(2000, 2100, 50)
+    planner1.save()
+    planner2.save()
+    merged = toolbox.ScrollPlanner("q", target=100, path=plan_path)
+    assert merged.plan(1000) == (100, True) and merged.plan(2000) == (100, True)
+    # Only the most recently saved keys are kept
+    monkeypatch.setattr(toolbox.ScrollPlanner, "MAX_PLANS", 3)
+    for key in ["a", "b", "c", "d"]:
+        toolbox.ScrollPlanner(key, target=100, path=plan_path).save()
+    with open(plan_path) as plan_file:
+        assert sorted(json.load(plan_file)) == ["b", "c", "d"]
+
+
+class _FileServer(ThreadingMixIn, HTTPServer):
+    """Serves /<name> as the bytes of name, slowly, and counts concurrent requests.
+    /private requires the header "Authorization: Bearer fresh".
+    /big is a larger file, and `files` may override the contents of any path.
+    Range requests and ETags are supported, and the connection is dropped partway through the next `drops` responses.
+    POSTs are answered like Search ingests."""
+    daemon_threads = True
+    big = bytes(range(256)) * 1200
+
+    def __init__(self):
+        self.files = {}
+        self.drops = 0
+        self.ranges = []
+        self.posts = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), _FileHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:" + str(self.server_port)
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        # Stands in for Search ingest: keeps the body, and whether it was chunked, in `posts`
+        chunked = self.headers.get("Transfer-Encoding") == "chunked"
+        if chunked:
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                if not size:
+                    break
+        else:
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.posts.append((self.path, chunked, body))
+        response = json.dumps({"success": True, "num_documents_ingested": len(json.loads(body.decode("utf-8"))["ingest_data"]["gmeta"])}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        time.sleep(0.02)
+        if self.path == "/missing":
+            self.send_response(404)
+            body = b""
+        elif self.path == "/private" and self.headers.get("Authorization") != "Bearer fresh":
+            self.send_response(401)
+            body = b""
+        else:
+            body = server.files.get(self.path, server.big if self.path == "/big" else self.path[1:].encode())
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            start, end = self.headers.get("Range", "bytes=0-")[6:].split("-")
+            start, end = int(start), int(end or len(body) - 1)
+            if self.headers.get("If-Range", etag) != etag:
+                # The file changed, so all of it is sent
+                start, end = 0, len(body) - 1
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                body = b""
+            elif head:
+                self.send_response(200)
+            elif start or end < len(body) - 1:
+                server.ranges.append(start)
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(body)))
+                body = body[start:end + 1]
+            else:
+                server.ranges.append(start)
+                self.send_response(200)
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if head:
+            body = b""
+        with server.lock:
+            server.active -= 1
+            drop = server.drops > 0 and len(body) > 1
+            server.drops -= drop
+        if drop:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_http_pool(monkeypatch, tmp_path):
+    class TestAuthorizer():
+        token = "stale"
+        def set_authorization_header(self, headers):
+            headers["Authorization"] = "Bearer " + self.token
+        def handle_missing_authorization(self):
+            self.token = "fresh"
+            return True
+
+    servers = [_FileServer(), _FileServer()]
+    pool = toolbox.HTTPPool(TestAuthorizer())
+    # Retry with fresh authorization on 401
+    assert pool.get(servers[0].url + "/private").text == "private"
+
+    jobs = [(server.url + "/file" + str(i), str(tmp_path / (str(n) + "_" + str(i))))
+            for n, server in enumerate(servers) for i in range(12)]
+    jobs.append((servers[0].url + "/missing", str(tmp_path / "missing")))
+    # A file that cannot be written is an error for its job only
+    jobs.append((servers[1].url + "/unwritable", str(tmp_path / "no_such_dir" / "unwritable")))
+    results = dict(pool.map(pool.download, jobs, workers=6, per_host=2))
+    assert len(results) == len(jobs)
+    assert results[jobs[-2]] == 404
+    assert not os.path.exists(str(tmp_path / "missing"))
+    assert isinstance(results[jobs[-1]], OSError)
+    for (url, local_path), status in results.items():
+        if status == 200:
+            with open(local_path) as f:
+                assert f.read() == url.rsplit("/", 1)[1]
+    assert sum(status == 200 for status in results.values()) == 24
+    # Each host was limited to per_host requests at once
+    assert all(1 <= server.max_active <= 2 for server in servers)
+    # A pool used in a child process opens its own connections
+    session = pool._HTTPPool__session
+    monkeypatch.setattr(os, "getpid", lambda: -1)
+    assert pool.get(servers[0].url + "/file0").text == "file0"
+    assert pool._HTTPPool__session is not session
+    for server in servers:
+        server.shutdown()
+
+
+def test_http_pool_resume(tmp_path):
+    server = _FileServer()
+    pool = toolbox.HTTPPool()
+    # Whatever arrived in whole chunks is kept
+    pool.CHUNK_SIZE = 1024
+    local_path = str(tmp_path / "big")
+    # Interrupted downloads resume where they stopped
+    server.drops = 2
+    status, info = pool.download(server.url + "/big", local_path, info=True)
+    assert status == 200
+    assert info["retries"] == 2 and info["latency"] > 0 and info["seconds"] >= info["latency"]
+    assert len(server.ranges) == 3
+    assert 0 == server.ranges[0] < server.ranges[1] < server.ranges[2]
+    with open(local_path, "rb") as f:
+        assert f.read() == server.big
+    assert not os.path.exists(local_path + ".part")
+
+    # Partial files from earlier calls are resumed too, if they are of the same version of the file
+    etag = '"' + hashlib.md5(server.big).hexdigest() + '"'
+    with open(local_path + ".part", "wb") as f:
+        f.write(server.big[:1000])
+    with open(local_path + ".part.validator", "w") as f:
+        f.write(etag)
+    server.ranges = []
+    sha = hashlib.sha256(server.big).hexdigest()
+    assert pool.download(server.url + "/big", local_path, checksum=("sha256", sha)) == 200
+    assert server.ranges == [1000]
+    with open(local_path, "rb") as f:
+        assert f.read() == server.big
+    assert not os.path.exists(local_path + ".part.validator")
+    # Partial files of another version, or of an unknown one, are started over
+    for validator in ['"old"', None]:
+        with open(local_path + ".part", "wb") as f:
+            f.write(b"x" * 1000)
+        if validator:
+            with open(local_path + ".part.validator", "w") as f:
+                f.write(validator)
+        server.ranges = []
+        assert pool.download(server.url + "/big", local_path) == 200
+        assert server.ranges == [0]
+        with open(local_path, "rb") as f:
+            assert f.read() == server.big
+
+    # Bad checksums are not saved
+    os.remove(local_path)
+    assert isinstance(pool.download(server.url + "/big", local_path, checksum=("md5", "0")), ValueError)
+    assert not os.path.exists(local_path) and not os.path.exists(local_path + ".part")
+    # Give up after too many interruptions, keeping the partial file for next time
+    server.drops = pool.RETRIES + 1
+    assert not isinstance(pool.download(server.url + "/big", local_path), int)
+    assert os.path.getsize(local_path + ".part") < len(server.big)
+    assert pool.download(server.url + "/big", local_path) == 200
+    server.shutdown()
+
+
+def test_http_pool_segments(monkeypatch, tmp_path):
+    server = _FileServer()
+    pool = toolbox.HTTPPool()
+    pool.CHUNK_SIZE = 1024
+    size = len(server.big)
+    local_path = str(tmp_path / "big")
+    # Large files are fetched in segments, reassembled in place
+    status, info = pool.download(server.url + "/big", local_path, segments=4, segment_threshold=1000, info=True)
+    assert status == 200
+    assert info["bytes"] == size and info["retries"] == 0
+    assert sorted(server.ranges) == [0, size // 4, size // 2, 3 * size // 4]
+    with open(local_path, "rb") as f:
+        assert f.read() == server.big
+    assert not os.path.exists(local_path + ".part")
+    # Small files are not
+    server.ranges = []
+    assert pool.download(server.url + "/big", local_path, segments=4) == 200
+    assert server.ranges == [0]
+
+    # Partial files are resumed in segments, and interrupted segments resume where they stopped
+    with open(local_path + ".part", "wb") as f:
+        f.write(server.big[:1000])
+    with open(local_path + ".part.validator", "w") as f:
+        f.write('"' + hashlib.md5(server.big).hexdigest() + '"')
+    server.ranges = []
+    server.drops = 1
+    assert pool.download(server.url + "/big", local_path, segments=2, segment_threshold=1000) == 200
+    assert len(server.ranges) == 3
+    assert {1000, 1000 + (size - 1000) // 2} < set(server.ranges)
+    with open(local_path, "rb") as f:
+        assert f.read() == server.big
+    # Segments that fail for good fall back to one stream, from what is complete at the start of the file
+    os.remove(local_path)
+    server.ranges = []
+    server.drops = 2 * (pool.RETRIES + 1)
+    assert pool.download(server.url + "/big", local_path, segments=2, segment_threshold=1000) == 200
+    assert 0 < server.ranges[-1] < size // 2
+    with open(local_path, "rb") as f:
+        assert f.read() == server.big
+    # Partial files of another version are not resumed
+    with open(local_path + ".part", "wb") as f:
+        f.write(b"x" * 1000)
+    with open(local_path + ".part.validator", "w") as f:
+        f.write('"old"')
+    server.ranges = []
+    assert pool.download(server.url + "/big", local_path, segments=2, segment_threshold=1000) == 200
+    assert sorted(server.ranges) == [0, size // 2]
+    with open(local_path, "rb") as f:
+        assert f.read() == server.big
+
+    # A segmented download that was killed resumes the ranges it had left
+    def killed_download():
+        with open(local_path + ".part", "wb") as f:
+            f.write(server.big[:size // 2] + b"\0" * (size - size // 2))
+        with open(local_path + ".part.validator", "w") as f:
+            f.write('"' + hashlib.md5(server.big).hexdigest() + '"')
+        with open(local_path + ".part.segments", "w") as f:
+            json.dump({"size": size, "ranges": [[size // 2, size]]}, f)
+    killed_download()
+    server.ranges = []
+    assert pool.download(server.url + "/big", local_path, segments=2, segment_threshold=1000) == 200
+    assert server.ranges == [size // 2]
+    with open(local_path, "rb") as f:
+        assert f.read() == server.big
+    assert not os.path.exists(local_path + ".part.segments")
+    # In one stream, only what is complete from the start is kept
+    killed_download()
+    server.ranges = []
+    assert pool.download(server.url + "/big", local_path) == 200
+    assert server.ranges == [size // 2]
+    with open(local_path, "rb") as f:
+        assert f.read() == server.big
+    assert not os.path.exists(local_path + ".part.segments")
+    # Segments that cannot be written leave no holes behind for the single stream
+    def pwrite(fd, data, offset):
+        raise OSError("No space left on device")
+    monkeypatch.setattr(os, "pwrite", pwrite)
+    os.remove(local_path)
+    server.ranges = []
+    assert pool.download(server.url + "/big", local_path, segments=2, segment_threshold=1000) == 200
+    assert sorted(server.ranges) == [0, 0, size // 2]
+    with open(local_path, "rb") as f:
+        assert f.read() == server.big
+    server.shutdown()
+
+
+def test_data_cache(tmp_path):
+    server = _FileServer()
+    pool = toolbox.HTTPPool()
+    cache = toolbox.DataCache(path=str(tmp_path / "data"), max_bytes=1000, max_age=None)
+    url = server.url + "/file1"
+    # Fetch once, then serve from disk
+    assert cache.fetch(pool, url) == 200
+    assert cache.fetch(pool, url) == 200
+    assert server.ranges == [0]
+    with cache.open(url) as data:
+        assert bytes(data) == b"file1"
+    # Errors are not cached
+    assert cache.fetch(pool, server.url + "/missing") == 404
+    assert not os.path.exists(cache.file_path(server.url + "/missing"))
+
+    # Stale files are revalidated, and only downloaded again if they changed
+    cache.max_age = 0
+    assert cache.fetch(pool, url) == 200
+    assert server.ranges == [0]
+    server.files["/file1"] = b"changed"
+    assert cache.fetch(pool, url) == 200
+    assert server.ranges == [0, 0]
+    with cache.open(url) as data:
+        assert bytes(data) == b"changed"
+    server.files["/empty"] = b""
+    assert cache.fetch(pool, server.url + "/empty") == 200
+    with cache.open(server.url + "/empty") as data:
+        assert bytes(data) == b""
+
+    # Least recently used files are evicted past max_bytes
+    server.files["/a"] = b"a" * 600
+    server.files["/b"] = b"b" * 600
+    assert cache.fetch(pool, server.url + "/a") == 200
+    assert cache.fetch(pool, server.url + "/b") == 200
+    assert not os.path.exists(cache.file_path(server.url + "/a"))
+    assert os.path.exists(cache.file_path(server.url + "/b"))
+    # Pinned files are not evicted until the block ends
+    with cache.pinned(pool, server.url + "/b") as status:
+        assert status == 200
+        assert cache.fetch(pool, server.url + "/a") == 200
+        assert os.path.exists(cache.file_path(server.url + "/b"))
+        with cache.open(server.url + "/b") as data:
+            assert bytes(data) == b"b" * 600
+    # Locks are only kept for URLs in use
+    assert cache._DataCache__in_use == {}
+    # Persists across instances
+    assert os.path.exists(toolbox.DataCache(path=str(tmp_path / "data")).file_path(server.url + "/b"))
+    cache.clear()
+    assert os.listdir(str(tmp_path / "data")) == ["index.sqlite"]
+    server.shutdown()
+
+
+def test_transfer_metrics(capsys):
+    events = []
+    metrics = toolbox.TransferMetrics(events.append)
+    for i in range(10):
+        metrics.record_file("https://a.org/" + str(i), "/dest/" + str(i), 200,
+                            {"bytes": 100, "seconds": 0.5, "latency": (i + 1) / 100, "retries": i % 2})
+    metrics.record_file("https://a.org/same", "/dest/same", 304, {"bytes": 0, "seconds": 0.1, "latency": 0.01, "retries": 0})
+    metrics.record_file("https://b.org/missing", "/dest/missing", 404)
+    metrics.record_task({"task_id": "t1", "status": "ACTIVE", "source_endpoint_id": "ep1", "files": 5})
+    metrics.record_task({"task_id": "t1", "status": "FAILED", "files": 5, "files_transferred": 3, "files_skipped": 1,
+                         "bytes_transferred": 3000, "effective_bytes_per_second": 300})
+    # Every event is reported
+    assert [e["event"] for e in events] == ["file"] * 12 + ["task"] * 2
+    assert events[0]["host"] == "a.org" and events[0]["status"] == 200
+    assert events[-1]["source"] == "ep1"
+    # And summarized
+    summary = metrics.summary()
+    assert summary.files_completed == 13
+    assert summary.files_unchanged == 2
+    assert summary.files_failed == 2
+    assert summary.bytes == 4000
+    assert summary.retries == 5
+    assert summary.hosts["a.org"]["files"] == 10
+    assert summary.hosts["a.org"]["latency"] == {"p50": 0.05, "p90": 0.09, "p99": 0.1}
+    assert summary.hosts["a.org"]["bytes_per_second"] > 0
+    assert summary.hosts["b.org"]["failed"] == 1 and summary.hosts["b.org"]["latency"]["p50"] is None
+    assert summary.hosts["ep1"]["bytes"] == 3000
+    assert summary.tasks["t1"]["status"] == "FAILED"
+    # Errors in the callback do not stop anything
+    metrics.callback = lambda event: 1 / 0
+    metrics.record_file("https://a.org/more", "/dest/more", 200)
+    out, err = capsys.readouterr()
+    assert "Error in download callback" in out
+    assert metrics.summary().files_completed == 14
+
+
+def test_sync_manifest(tmp_path):
+    server = _FileServer()
+    pool = toolbox.HTTPPool()
+    manifest_path = str(tmp_path / "manifest.json")
+    manifest = toolbox.SyncManifest(manifest_path)
+    url = server.url + "/file1"
+    local_path = str(tmp_path / "file1")
+    # Unknown files are downloaded in full
+    assert manifest.conditions(url, local_path) is None
+    status, validators = pool.download(url, local_path, info=True)
+    manifest.record(url, local_path, validators)
+    manifest.save()
+    # Recorded files are revalidated, even by a new manifest
+    manifest = toolbox.SyncManifest(manifest_path)
+    assert manifest.conditions(url, local_path) == {"If-None-Match": validators["etag"]}
+    assert pool.download(url, local_path, headers=manifest.conditions(url, local_path)) == 304
+    # Unless they came from somewhere else, or were changed or removed locally
+    assert manifest.conditions(server.url + "/file2", local_path) is None
+    with open(local_path, "a") as local_file:
+        local_file.write("edited")
+    assert manifest.conditions(url, local_path) is None
+    os.remove(local_path)
+    assert manifest.conditions(url, local_path) is None
+    server.shutdown()
 
 
 '''